@@ -0,0 +1,473 @@
+"""Benchmark api endpoints against generated data.
+
+Generates players, maps with zones and checkpoints, and map times with
+Zipf distributed completions per map, then drives endpoints through the
+flask test client and writes latency, throughput and query statistics as json.
+
+Usage: python benchmark.py --players 2000 --maps 200 --output results.json
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCHMARK_USER = ("benchmark", "benchmark")
+COUNTRIES = ["FI", "US", "UK", "DE", "SE", "FR", "CA", "AU", "PL", "RU"]
+OPERATIONS = ["token_auth", "find_player", "map_info", "get_times", "insert_map"]
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database",
+        default=None,
+        help="database uri, defaults to a temporary sqlite database",
+    )
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="drop existing tables, required for databases that have data",
+    )
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--maps", type=int, default=100)
+    parser.add_argument(
+        "--checkpoints", type=int, default=5, help="maximum checkpoints per map"
+    )
+    parser.add_argument(
+        "--completions",
+        type=int,
+        default=20000,
+        help="total map times, distributed over maps by popularity",
+    )
+    parser.add_argument(
+        "--zipf", type=float, default=1.1, help="map popularity Zipf exponent"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="requests per operation"
+    )
+    parser.add_argument(
+        "--operations",
+        nargs="+",
+        choices=OPERATIONS,
+        default=OPERATIONS,
+        help="operations to benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="json output file")
+    return parser.parse_args(argv)
+
+
+def remove_file(path):
+    """Remove a file if it still exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def setup_environment(database):
+    """Set environment for the app, must run before importing jtimer."""
+    if database is None:
+        handle, path = tempfile.mkstemp(prefix="jtimer-bench-", suffix=".db")
+        os.close(handle)
+        atexit.register(remove_file, path)
+        database = f"sqlite:///{path}"
+
+    os.environ["DATABASE_URI"] = database
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("JWT_SECRET_KEY", "benchmark")
+    return database
+
+
+class Dataset:
+    """Generated data kept for driving the benchmark."""
+
+    def __init__(self, rng, players, maps, popularity, base_times, skill):
+        self.rng = rng
+        self.players = players
+        self.maps = maps
+        self.popularity = popularity
+        self.base_times = base_times
+        self.skill = skill
+
+    def random_map(self, rng=None):
+        """Random map id weighted by popularity."""
+        rng = rng or self.rng
+        return int(rng.choice(self.maps, p=self.popularity)) + 1
+
+    def random_player(self, rng=None):
+        """Random player id."""
+        rng = rng or self.rng
+        return int(rng.integers(self.players)) + 1
+
+    def run_duration(self, map_id, player_id, rng=None):
+        """Plausible run duration of a player on a map.
+        Pass rng when calling from multiple threads."""
+        rng = rng or self.rng
+        noise = 1 + abs(rng.normal(0, 0.15))
+        return float(self.base_times[map_id - 1] * self.skill[player_id - 1] * noise)
+
+
+def zipf_counts(total, amount, exponent, rng):
+    """Split total into amount Zipf distributed counts in random order."""
+    weights = 1 / np.arange(1, amount + 1) ** exponent
+    weights /= weights.sum()
+    rng.shuffle(weights)
+    return np.maximum(1, np.round(weights * total)).astype(int), weights
+
+
+def generate(args, rng):
+    """Generate players, maps, zones, checkpoints and times.
+    Returns Dataset."""
+    from jtimer.extensions import db
+    from jtimer.points import calc_points
+    from jtimer.models.database import (
+        Player,
+        Map,
+        Zone,
+        MapCheckpoint,
+        MapTimes,
+        MapCheckpointTimes,
+        User,
+        pack_splits,
+    )
+    from flask import current_app
+
+    def insert(model, rows):
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+
+    players = args.players
+    maps = args.maps
+
+    insert(
+        Player,
+        [
+            {
+                "id": i + 1,
+                "steam_id": f"STEAM_0:{i % 2}:{i}",
+                "username": f"player{i}",
+                "country": COUNTRIES[i % len(COUNTRIES)],
+            }
+            for i in range(players)
+        ],
+    )
+
+    # zones: start, end and checkpoints of each map
+    zones = []
+    map_rows = []
+    checkpoint_rows = []
+    cp_counts = rng.integers(0, args.checkpoints + 1, size=maps)
+    for i in range(maps):
+        map_id = i + 1
+        cp_count = int(cp_counts[i])
+        first_zone = len(zones) + 1
+        for j in range(cp_count + 2):
+            x = j * 1000
+            zones.append(
+                {
+                    "id": len(zones) + 1,
+                    "x1": x,
+                    "y1": 0,
+                    "z1": 0,
+                    "x2": x + 256,
+                    "y2": 256,
+                    "z2": 256,
+                    "orientation": 0,
+                }
+            )
+        for cp_index in range(1, cp_count + 1):
+            checkpoint_rows.append(
+                {
+                    "id": len(checkpoint_rows) + 1,
+                    "zone_id": first_zone + 1 + cp_index,
+                    "map_id": map_id,
+                    "cp_index": cp_index,
+                }
+            )
+        map_rows.append(
+            {
+                "id": map_id,
+                "mapname": f"jump_synthetic_{i}",
+                "stier": int(rng.integers(1, 7)),
+                "dtier": int(rng.integers(1, 7)),
+                "start_zone": first_zone,
+                "end_zone": first_zone + 1,
+            }
+        )
+
+    insert(Zone, zones)
+    insert(Map, map_rows)
+    insert(MapCheckpoint, checkpoint_rows)
+
+    counts, popularity = zipf_counts(args.completions, maps, args.zipf, rng)
+    base_times = rng.lognormal(np.log(300), 0.8, size=maps)
+    skill = rng.lognormal(0, 0.3, size=players)
+    dataset = Dataset(rng, players, maps, popularity, base_times, skill)
+
+    pack = current_app.config["PACK_CHECKPOINT_TIMES"]
+    checkpoints_by_map = {}
+    for row in checkpoint_rows:
+        checkpoints_by_map.setdefault(row["map_id"], []).append(row)
+
+    time_rows = []
+    checkpoint_time_rows = []
+    for i in range(maps):
+        map_id = i + 1
+        checkpoints = checkpoints_by_map.get(map_id, [])
+        fractions = np.sort(rng.uniform(0.05, 0.95, size=len(checkpoints)))
+
+        for player_class, column in ((2, "s_completions"), (4, "d_completions")):
+            share = 0.6 if player_class == 2 else 0.4
+            amount = min(players, max(1, int(counts[i] * share)))
+            player_ids = rng.choice(players, size=amount, replace=False) + 1
+            durations = np.array(
+                [dataset.run_duration(map_id, int(p)) for p in player_ids]
+            )
+            order = np.argsort(durations)
+            map_rows[i][column] = amount
+
+            for rank, k in enumerate(order, start=1):
+                run_id = len(time_rows) + 1
+                start = float(rng.uniform(0, 10000))
+                duration = float(durations[k])
+                splits = {
+                    cp["cp_index"]: float(f * duration)
+                    for cp, f in zip(checkpoints, fractions)
+                }
+                time_rows.append(
+                    {
+                        "id": run_id,
+                        "map_id": map_id,
+                        "player_id": int(player_ids[k]),
+                        "player_class": player_class,
+                        "start_time": start,
+                        "end_time": start + duration,
+                        "duration": duration,
+                        "rank": rank,
+                        "points": calc_points(
+                            float(durations[order[0]]), duration, amount
+                        ),
+                        "checkpoint_splits": pack_splits(splits) if pack else None,
+                    }
+                )
+                if not pack:
+                    for cp in checkpoints:
+                        checkpoint_time_rows.append(
+                            {
+                                "checkpoint_id": cp["id"],
+                                "time_id": run_id,
+                                "time": start + splits[cp["cp_index"]],
+                            }
+                        )
+
+    insert(MapTimes, time_rows)
+    insert(MapCheckpointTimes, checkpoint_time_rows)
+
+    table = Map.__table__
+    for row in map_rows:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == row["id"])
+            .values(
+                s_completions=row["s_completions"], d_completions=row["d_completions"]
+            )
+        )
+
+    username, password = BENCHMARK_USER
+    db.session.add(User(username=username, password=User.generate_hash(password)))
+    db.session.commit()
+
+    Player.calculate_ranks()
+    return dataset
+
+
+def pipeline_totals():
+    """Current (count, sum) of pipeline stage timings by stage."""
+    from jtimer.metrics import PIPELINE_LATENCY
+
+    totals = {}
+    for metric in PIPELINE_LATENCY.collect():
+        for sample in metric.samples:
+            stage = sample.labels.get("stage")
+            if sample.name.endswith("_count"):
+                totals.setdefault(stage, [0, 0.0])[0] = sample.value
+            elif sample.name.endswith("_sum"):
+                totals.setdefault(stage, [0, 0.0])[1] = sample.value
+    return totals
+
+
+def summarize(latencies, queries, elapsed, statuses):
+    """Summary statistics of an operation."""
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+        },
+        "queries_per_request": float(np.mean(queries)),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def run_operations(client, dataset, args, headers):
+    """Run each operation args.iterations times.
+    Returns results by operation."""
+    username, password = BENCHMARK_USER
+    rng = dataset.rng
+
+    def token_auth():
+        return client.post(
+            "/token/auth", json={"username": username, "password": password}
+        )
+
+    def find_player():
+        return client.get(f"/players/search?player_id={dataset.random_player()}")
+
+    def map_info():
+        return client.get(f"/maps/{dataset.random_map()}/info")
+
+    def get_times():
+        return client.get(f"/times/map/{dataset.random_map()}")
+
+    def insert_map():
+        map_id = dataset.random_map()
+        player_id = dataset.random_player()
+        start = float(rng.uniform(0, 10000))
+        duration = dataset.run_duration(map_id, player_id)
+        data = {
+            "player_id": player_id,
+            "player_class": int(rng.choice([2, 4])),
+            "start_time": start,
+            "end_time": start + duration,
+            "checkpoints": [],
+        }
+        return client.post(f"/times/insert/map/{map_id}", json=data, headers=headers)
+
+    operations = {
+        "token_auth": token_auth,
+        "find_player": find_player,
+        "map_info": map_info,
+        "get_times": get_times,
+        "insert_map": insert_map,
+    }
+
+    results = {}
+    for name in args.operations:
+        operation = operations[name]
+        latencies = []
+        queries = []
+        statuses = {}
+        pipeline_before = pipeline_totals()
+
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            request_start = time.perf_counter()
+            response = operation()
+            latencies.append(time.perf_counter() - request_start)
+            queries.append(int(response.headers.get("X-SQL-Queries", 0)))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        elapsed = time.perf_counter() - started
+
+        results[name] = summarize(latencies, queries, elapsed, statuses)
+
+        pipeline = {}
+        for stage, (count, total) in pipeline_totals().items():
+            before_count, before_total = pipeline_before.get(stage, (0, 0.0))
+            if count > before_count:
+                pipeline[stage] = {
+                    "calls": int(count - before_count),
+                    "mean_ms": (total - before_total) / (count - before_count) * 1000,
+                }
+        results[name]["pipeline"] = pipeline
+
+    return results
+
+
+def git_revision():
+    """Current git commit or None."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    """Generate data, run the benchmark and write results."""
+    args = parse_args(argv)
+    database = setup_environment(args.database)
+
+    # imported here so the app picks up DATABASE_URI
+    from jtimer import application
+    from jtimer.extensions import db
+
+    application.config["SQL_STATS_HEADERS"] = True
+    rng = np.random.default_rng(args.seed)
+
+    with application.app_context():
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        elif db.session.execute("SELECT COUNT(*) FROM player").scalar():
+            sys.exit("database has data, use --reset to drop it")
+
+        generate_start = time.perf_counter()
+        dataset = generate(args, rng)
+        generate_time = time.perf_counter() - generate_start
+
+    client = application.test_client()
+    username, password = BENCHMARK_USER
+    response = client.post(
+        "/token/auth", json={"username": username, "password": password}
+    )
+    headers = {"Authorization": f"Bearer {response.get_json()['access_token']}"}
+
+    results = run_operations(client, dataset, args, headers)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "database": database.split("://", 1)[0],
+            "generate_seconds": generate_time,
+            "parameters": {
+                key: value for key, value in vars(args).items() if key != "output"
+            },
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Relay run events between api worker processes.
+
+A stand-in for a message broker: workers started with
+EVENT_BROKER=host:port connect to the relay, send events of their run
+submissions as json lines and get every event back, so /events streams
+of all workers see all runs. Connections that don't keep up are closed,
+the worker reconnects.
+
+Usage: python event_relay.py --port 7010
+"""
+
+import argparse
+import queue
+import socketserver
+import threading
+
+# queued lines per connection before it is dropped
+QUEUE_SIZE = 1000
+
+
+class RelayHandler(socketserver.StreamRequestHandler):
+    """Broadcast lines of a connection to all connections."""
+
+    def setup(self):
+        super().setup()
+        self.lines = queue.Queue(maxsize=QUEUE_SIZE)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+        self.server.add(self)
+
+    def handle(self):
+        for line in self.rfile:
+            self.server.broadcast(line)
+
+    def finish(self):
+        self.server.remove(self)
+        self.lines.put(None)
+        super().finish()
+
+    def write(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except OSError:
+                return
+
+
+class RelayServer(socketserver.ThreadingTCPServer):
+    """TCP server keeping track of connections."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RelayHandler)
+        self.handlers = set()
+        self.lock = threading.Lock()
+
+    def add(self, handler):
+        with self.lock:
+            self.handlers.add(handler)
+
+    def remove(self, handler):
+        with self.lock:
+            self.handlers.discard(handler)
+
+    def broadcast(self, line):
+        with self.lock:
+            handlers = list(self.handlers)
+
+        for handler in handlers:
+            try:
+                handler.lines.put_nowait(line)
+            except queue.Full:
+                # slow worker, closing makes it reconnect
+                self.remove(handler)
+                self.shutdown_request(handler.request)
+
+
+def main(argv=None):
+    """Command line interface."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7010)
+    args = parser.parse_args(argv)
+
+    with RelayServer((args.host, args.port)) as server:
+        print(f"relaying events on {args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,15 @@ import json
 from importlib import import_module
 
 from flask import Flask, request, make_response, jsonify
+from sqlalchemy.exc import OperationalError
 
+from jtimer import instrumentation, metrics
 from jtimer.blueprints import all_blueprints
+from jtimer.events import event_hub
 from jtimer.extensions import db, jwt
-from jtimer.models.database import RevokedToken, User
+from jtimer.history import history_writer
+from jtimer.leaderboard import leaderboards
+from jtimer.models.database import RevokedToken, User, is_lock_error
 
 
 def get_config(config_class_string):
@@ -33,6 +38,11 @@ application.config.update(get_config("jtimer.config.config.Api"))
 # initialize extensions
 db.init_app(application)
 jwt.init_app(application)
+instrumentation.init_app(application)
+metrics.init_app(application)
+history_writer.init_app(application)
+leaderboards.init_app(application)
+event_hub.init_app(application)
 
 
 @jwt.token_in_blacklist_loader
@@ -42,6 +52,20 @@ def check_if_token_in_blacklist(decrypted_token):
     return RevokedToken.is_jti_blacklisted(jti)
 
 
+@application.errorhandler(OperationalError)
+def handle_operational_error(error):
+    """Return 503 for lock timeouts and deadlocks so clients can retry"""
+    db.session.rollback()
+
+    if is_lock_error(error):
+        response = {"message": "Database busy, try again."}
+        return make_response(jsonify(response), 503, {"Retry-After": "1"})
+
+    application.logger.exception(error)
+    response = {"message": "Internal server error."}
+    return make_response(jsonify(response), 500)
+
+
 # make sure we have context of current app before importing blueprints
 with application.app_context():
     # register blueprints
@@ -19,6 +19,7 @@ user_index = factory("user", "/user")
 maps_index = factory("maps", "/maps")
 times_index = factory("times", "/times")
 zones_index = factory("zones", "/zones")
+events_index = factory("events", "/events")
 
 all_blueprints = (
     application_index,
@@ -28,4 +29,5 @@ all_blueprints = (
     maps_index,
     times_index,
     zones_index,
+    events_index,
 )
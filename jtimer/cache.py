@@ -0,0 +1,64 @@
+"""In-process caches shared by views and models"""
+
+import threading
+from collections import OrderedDict
+
+# name -> LRUCache, for metrics
+all_caches = {}
+
+
+class LRUCache:
+    """Thread-safe least recently used cache.
+    Values should be immutable, they are shared between requests.
+    Named caches are listed in all_caches."""
+
+    def __init__(self, maxsize=1024, name=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name is not None:
+            all_caches[name] = self
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get cached value, marks it as recently used."""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key, value):
+        """Cache value, evicting the least recently used value if full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove value from the cache if it exists."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all values and reset statistics."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# (segment type, segment id) -> ZoneBundle
+zone_bundles = LRUCache(maxsize=1024, name="zone_bundles")
+
+# (segment type, run id, duration) -> ((cp_index, split time), ...)
+run_splits = LRUCache(maxsize=4096, name="run_splits")
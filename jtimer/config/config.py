@@ -31,6 +31,11 @@ class MySQL:
         + f":{os.environ.get('MYSQL_PORT')}"
         + f"/{os.environ.get('MYSQL_DB_NAME')}"
     )
+
+    # full database uri overrides the MYSQL_ variables,
+    # e.g. sqlite:///bench.db for benchmarks
+    if os.environ.get("DATABASE_URI"):
+        SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URI")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 
@@ -52,5 +57,89 @@ class Api:
     JWT_BLACKLIST_ENABLED = True
     JWT_BLACKLIST_TOKEN_CHECKS = ["access", "refresh"]
 
+    # store run checkpoint times packed in map_times.checkpoint_splits
+    # instead of one map_checkpoint_times row per checkpoint
+    PACK_CHECKPOINT_TIMES = False
+
+    # retries of a run submission on lock timeouts and deadlocks
+    RUN_INSERT_RETRIES = 3
+    # seconds to wait before the first retry, grows linearly
+    RUN_INSERT_RETRY_DELAY = 0.05
+
+    # finished runs are written to run_history in batches of this size,
+    # 1 writes each run immediately
+    RUN_HISTORY_BATCH_SIZE = 50
+    # seconds between flushes of partial batches
+    RUN_HISTORY_FLUSH_INTERVAL = 1.0
+    # most runs scanned for personal bests of a progression
+    # on databases without window functions
+    RUN_HISTORY_SCAN_LIMIT = 10000
+
+    # how leaderboards are re-ranked: "sql" updates all runs with one window
+    # function query, "python" loads and updates runs one by one,
+    # "auto" uses "sql" if the database supports it
+    RANK_BACKEND = "auto"
+
+    # concurrent identical requests to read views share one response
+    SINGLE_FLIGHT_VIEWS = True
+
+    # queued events per /events subscriber, full subscribers are dropped
+    EVENT_QUEUE_SIZE = 100
+    # /events streams per worker process
+    EVENT_MAX_SUBSCRIBERS = 100
+    # seconds between keep-alive comments on idle /events streams
+    EVENT_KEEPALIVE = 15.0
+    # "host:port" of an event_relay.py shared by worker processes,
+    # None only streams events of the same worker
+    EVENT_BROKER = os.environ.get("EVENT_BROKER")
+
+    # webhook urls announcing new records, comma separated in the environment,
+    # discord webhooks get messages, other urls json
+    NOTIFICATION_WEBHOOKS = [
+        url for url in os.environ.get("NOTIFICATION_WEBHOOKS", "").split(",") if url
+    ]
+    # notifications sent per webhook request
+    NOTIFICATION_BATCH_SIZE = 10
+    # failed sends are retried this many times with doubling delays
+    NOTIFICATION_MAX_ATTEMPTS = 8
+    NOTIFICATION_RETRY_DELAY = 5.0
+    NOTIFICATION_MAX_RETRY_DELAY = 600.0
+    # seconds to wait for a webhook response
+    NOTIFICATION_TIMEOUT = 5.0
+    # seconds between outbox polls of the dispatcher
+    NOTIFICATION_POLL_INTERVAL = 2.0
+    # days sent and given up notifications are kept in the outbox
+    NOTIFICATION_RETENTION_DAYS = 7
+
+    # seconds responses of requests with an Idempotency-Key are kept
+    IDEMPOTENCY_TTL = 24 * 60 * 60
+    # seconds before a retry takes over a request that never finished,
+    # longer than the slowest submission including lock retries
+    IDEMPOTENCY_LEASE = 60
+    # seconds between deletions of expired idempotency keys per process
+    IDEMPOTENCY_PURGE_INTERVAL = 600
+
+    # keep sorted leaderboards in memory for rank lookups
+    LEADERBOARD_CACHE = False
+    # bytes of leaderboards kept per process, least recently used are evicted
+    LEADERBOARD_MEMORY_BUDGET = 64 * 1024 * 1024
+    # seconds before a cached leaderboard is checked against the database
+    LEADERBOARD_MAX_AGE = 1.0
+
+    # validate run position traces against map zones
+    VALIDATE_RUN_TRACES = False
+    # reject runs without a trace when validating
+    REQUIRE_RUN_TRACES = False
+    # allowed difference between trace and submitted times in seconds
+    RUN_TRACE_TOLERANCE = 0.5
+
+    # add X-SQL-Queries, X-SQL-Time, X-SQL-Rows and X-SQL-Slowest headers
+    # (times in milliseconds) to responses
+    SQL_STATS_HEADERS = False
+    # log statements slower than this many seconds, None to disable
+    SQL_SLOW_QUERY_TIME = 0.25
+    # log all statements of requests running more queries than this, None to disable
+    SQL_QUERY_COUNT_WARNING = None
+
 
 __all__ = ("MySQL", "Api")
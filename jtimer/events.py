@@ -0,0 +1,212 @@
+"""Fan-out of run events to server-sent event streams.
+
+Run submissions that add or improve a time are published to every
+/events subscriber of the process. Each subscriber has a bounded queue,
+subscribers that don't keep up are dropped instead of slowing down run
+submissions or growing memory, clients are expected to reconnect.
+
+Subscribers only see events of their own worker process unless
+EVENT_BROKER is set to the "host:port" of a relay (see event_relay.py),
+workers then send events to the relay and dispatch what it broadcasts.
+"""
+
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+
+from jtimer.metrics import EVENT_SUBSCRIBERS, EVENTS_PUBLISHED, EVENTS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# seconds between broker reconnects
+RECONNECT_DELAY = 1.0
+
+# events waiting to be sent to the relay, more are dispatched locally
+SEND_QUEUE_SIZE = 1000
+
+
+class Subscriber:
+    """Bounded event queue of one stream with optional filters."""
+
+    __slots__ = ("queue", "map_id", "player_id", "dropped")
+
+    def __init__(self, size, map_id=None, player_id=None):
+        self.queue = queue.Queue(maxsize=size)
+        self.map_id = map_id
+        self.player_id = player_id
+        self.dropped = False
+
+    def matches(self, event):
+        """True if the event passes the filters."""
+        if self.map_id is not None and event.get("map_id") != self.map_id:
+            return False
+        if self.player_id is not None and event.get("player_id") != self.player_id:
+            return False
+        return True
+
+
+class BrokerClient:
+    """Connection to an event relay.
+    A background thread keeps the connection open and passes received
+    events to dispatch, another sends queued events so a stalled relay
+    never blocks run submissions."""
+
+    def __init__(self, address, dispatch):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.dispatch = dispatch
+        self._socket = None
+        self._lock = threading.Lock()
+        self._outbox = queue.Queue(maxsize=SEND_QUEUE_SIZE)
+        self._threads = None
+
+    def start(self):
+        """Start the connection threads if not running."""
+        # started lazily so forked workers get their own connection
+        with self._lock:
+            if self._threads is None:
+                self._threads = [
+                    threading.Thread(target=self._run, daemon=True),
+                    threading.Thread(target=self._write, daemon=True),
+                ]
+                for thread in self._threads:
+                    thread.start()
+
+    def send(self, event):
+        """Queue event to the relay without blocking.
+        Returns False if not connected or the queue is full."""
+        with self._lock:
+            if self._socket is None:
+                return False
+        try:
+            self._outbox.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def _write(self):
+        while True:
+            event = self._outbox.get()
+            with self._lock:
+                connection = self._socket
+
+            if connection is not None:
+                try:
+                    connection.sendall((json.dumps(event) + "\n").encode())
+                    continue
+                except OSError:
+                    with self._lock:
+                        if self._socket is connection:
+                            self._close()
+
+            # lost the relay after queueing, this worker's subscribers still get it
+            self.dispatch(event)
+
+    def _close(self):
+        """Close the connection, caller holds the lock."""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _run(self):
+        while True:
+            try:
+                connection = socket.create_connection(self.address, timeout=5)
+                connection.settimeout(None)
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+
+            with self._lock:
+                self._socket = connection
+
+            try:
+                for line in connection.makefile("rb"):
+                    self.dispatch(json.loads(line))
+            except (OSError, ValueError):
+                logger.exception("event relay connection failed")
+
+            with self._lock:
+                if self._socket is connection:
+                    self._close()
+            time.sleep(RECONNECT_DELAY)
+
+
+class EventHub:
+    """Thread-safe publisher of events to subscribers."""
+
+    def __init__(self):
+        self.queue_size = 100
+        self.max_subscribers = 100
+        self.broker = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def init_app(self, app):
+        """Read config."""
+        self.queue_size = app.config["EVENT_QUEUE_SIZE"]
+        self.max_subscribers = app.config["EVENT_MAX_SUBSCRIBERS"]
+        if app.config["EVENT_BROKER"]:
+            self.broker = BrokerClient(app.config["EVENT_BROKER"], self.dispatch)
+
+    def subscribe(self, map_id=None, player_id=None):
+        """Add a subscriber, returns None if there are too many."""
+        if self.broker is not None:
+            self.broker.start()
+
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(self.queue_size, map_id, player_id)
+            self._subscribers.add(subscriber)
+
+        EVENT_SUBSCRIBERS.inc()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Remove a subscriber."""
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+            self._subscribers.discard(subscriber)
+
+        EVENT_SUBSCRIBERS.dec()
+
+    def publish(self, event):
+        """Publish event to subscribers of all workers."""
+        EVENTS_PUBLISHED.inc()
+        if self.broker is not None:
+            self.broker.start()
+            if self.broker.send(event):
+                return
+
+        # no relay, only this worker's subscribers get the event
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        """Queue event to matching subscribers of this worker,
+        dropping subscribers whose queue is full."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+
+        event_id = next(self._ids)
+        for subscriber in subscribers:
+            if not subscriber.matches(event):
+                continue
+
+            try:
+                subscriber.queue.put_nowait((event_id, event))
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+                EVENTS_DROPPED.inc()
+
+
+event_hub = EventHub()
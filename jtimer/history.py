@@ -0,0 +1,76 @@
+"""Batched writes to the append-only run history.
+
+Finished runs are buffered per process and inserted with a single
+executemany when RUN_HISTORY_BATCH_SIZE runs are buffered,
+or by a background thread every RUN_HISTORY_FLUSH_INTERVAL seconds.
+Buffered runs are flushed at exit, but are lost if the process is killed.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from jtimer.extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    """Thread-safe buffer of run_history rows."""
+
+    def __init__(self):
+        self.batch_size = 1
+        self.interval = 1.0
+        self._engine = None
+        self._table = None
+        self._rows = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        """Read config and register the exit flush."""
+        self.batch_size = app.config["RUN_HISTORY_BATCH_SIZE"]
+        self.interval = app.config["RUN_HISTORY_FLUSH_INTERVAL"]
+        self._engine = db.get_engine(app)
+        self._table = db.metadata.tables["run_history"]
+        atexit.register(self.flush)
+
+    def append(self, row):
+        """Buffer a row, flushing if the batch is full."""
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.batch_size
+
+            # started lazily so forked workers get their own thread
+            if self._thread is None and self.batch_size > 1:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Insert buffered rows.
+        Rows are kept for the next flush if the insert fails."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(self._table.insert(), rows)
+        except Exception:
+            logger.exception("failed to write %d runs to history", len(rows))
+            with self._lock:
+                # don't grow without bound while the database is down
+                self._rows = (rows + self._rows)[-self.batch_size * 100 :]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+history_writer = HistoryWriter()
@@ -0,0 +1,124 @@
+"""Idempotency-Key support for submission endpoints.
+
+Game servers retry submissions on timeouts. When a request has an
+Idempotency-Key header, its response is stored for IDEMPOTENCY_TTL
+seconds and requests repeating the key get the stored response without
+running the view again. Keys are scoped to the authenticated user.
+Server errors aren't stored so the request can be retried.
+
+While the first request is in progress, repeats get 409. A request that
+never finishes, e.g. because its worker was killed, holds the key for
+IDEMPOTENCY_LEASE seconds; the next retry then runs the view again. If
+the first request had already committed its changes, they are applied
+again: a repeated run submission is kept as is and reported as not
+improved, and run history gets the run twice.
+"""
+
+import hashlib
+import time
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from jtimer.extensions import db
+from jtimer.metrics import IDEMPOTENT_REQUESTS
+from jtimer.models.database import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 128
+
+_last_purge = 0.0
+
+
+def request_hash():
+    """Hash of the request method, path and body."""
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.full_path}\n".encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def replay(stored):
+    """Response of a stored key."""
+    IDEMPOTENT_REQUESTS.labels("replayed").inc()
+    response = make_response(stored.response, stored.status_code)
+    response.headers["Content-Type"] = "application/json"
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def purge_expired():
+    """Delete expired keys at most every IDEMPOTENCY_PURGE_INTERVAL seconds."""
+    global _last_purge
+
+    now = time.monotonic()
+    if now - _last_purge > current_app.config["IDEMPOTENCY_PURGE_INTERVAL"]:
+        _last_purge = now
+        IdempotencyKey.remove_expired()
+
+
+def idempotent(view_function):
+    """Honor the Idempotency-Key header, place below @jwt_required."""
+
+    @wraps(view_function)
+    def wrapped(**kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view_function(**kwargs)
+
+        if not key or len(key) > MAX_KEY_LENGTH:
+            error = {"message": f"{HEADER} must be 1-{MAX_KEY_LENGTH} characters."}
+            return make_response(jsonify(error), 422)
+
+        purge_expired()
+
+        user = str(get_jwt_identity())
+        digest = request_hash()
+
+        stored = IdempotencyKey.find(user, key)
+        claimed_at = None
+        if stored is None or (
+            stored.status_code is None and stored.request_hash == digest
+        ):
+            # new key, or take over a claim older than the lease
+            claimed_at = IdempotencyKey.claim(
+                user,
+                key,
+                digest,
+                current_app.config["IDEMPOTENCY_TTL"],
+                current_app.config["IDEMPOTENCY_LEASE"],
+            )
+            stored = IdempotencyKey.find(user, key) if claimed_at is None else None
+
+        if stored is not None:
+            if stored.request_hash != digest:
+                IDEMPOTENT_REQUESTS.labels("mismatch").inc()
+                error = {"message": f"{HEADER} was used for a different request."}
+                return make_response(jsonify(error), 422)
+
+            if stored.status_code is None:
+                IDEMPOTENT_REQUESTS.labels("in_progress").inc()
+                error = {"message": f"Request with this {HEADER} is in progress."}
+                return make_response(jsonify(error), 409, {"Retry-After": "1"})
+
+            return replay(stored)
+
+        try:
+            response = make_response(view_function(**kwargs))
+        except Exception:
+            db.session.rollback()
+            IdempotencyKey.release(user, key, claimed_at)
+            raise
+
+        if response.status_code >= 500:
+            IdempotencyKey.release(user, key, claimed_at)
+            return response
+
+        IdempotencyKey.store(
+            user, key, claimed_at, response.status_code, response.get_data()
+        )
+        IDEMPOTENT_REQUESTS.labels("stored").inc()
+        return response
+
+    return wrapped
@@ -0,0 +1,175 @@
+"""Per-request SQL instrumentation.
+
+Statements, database time and loaded model instances of each request
+are counted with sqlalchemy engine and mapper events,
+and aggregated per endpoint.
+"""
+
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from jtimer.extensions import db
+
+
+class RequestStats:
+    """SQL statistics of a single request."""
+
+    __slots__ = ("queries", "db_time", "rows", "slowest", "slowest_time", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.slowest = None
+        self.slowest_time = 0.0
+        self.statements = []
+
+
+class EndpointStats:
+    """SQL statistics aggregated over requests to an endpoint."""
+
+    __slots__ = (
+        "requests",
+        "queries",
+        "db_time",
+        "rows",
+        "max_queries",
+        "slowest",
+        "slowest_time",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.max_queries = 0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def add(self, stats):
+        """Add statistics of a request."""
+        self.requests += 1
+        self.queries += stats.queries
+        self.db_time += stats.db_time
+        self.rows += stats.rows
+        self.max_queries = max(self.max_queries, stats.queries)
+        if stats.slowest_time > self.slowest_time:
+            self.slowest = stats.slowest
+            self.slowest_time = stats.slowest_time
+
+    @property
+    def json(self):
+        """Json serializable dictionary of the statistics"""
+        return {
+            "requests": self.requests,
+            "queries": self.queries,
+            "queries_per_request": self.queries / self.requests,
+            "max_queries": self.max_queries,
+            "db_time": self.db_time,
+            "db_time_per_request": self.db_time / self.requests,
+            "rows": self.rows,
+            "slowest_time": self.slowest_time,
+            "slowest": self.slowest,
+        }
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def current_stats():
+    """Get SQL statistics of the current request, None outside requests."""
+    if not has_request_context():
+        return None
+    return g.get("sql_stats")
+
+
+def endpoint_stats():
+    """Get aggregated SQL statistics by endpoint."""
+    with _endpoints_lock:
+        return {endpoint: stats.json for endpoint, stats in _endpoints.items()}
+
+
+def reset():
+    """Clear aggregated statistics."""
+    with _endpoints_lock:
+        _endpoints.clear()
+
+
+def init_app(app):
+    """Register engine, mapper and request hooks."""
+    engine = db.get_engine(app)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+
+        slow_time = app.config["SQL_SLOW_QUERY_TIME"]
+        if slow_time is not None and elapsed > slow_time:
+            endpoint = request.endpoint if has_request_context() else None
+            app.logger.warning(
+                "slow query (%.1f ms, endpoint %s): %s",
+                elapsed * 1000,
+                endpoint,
+                statement,
+            )
+
+        stats = current_stats()
+        if stats is None:
+            return
+
+        stats.queries += 1
+        stats.db_time += elapsed
+        if elapsed > stats.slowest_time:
+            stats.slowest = statement
+            stats.slowest_time = elapsed
+        if app.config["SQL_QUERY_COUNT_WARNING"] is not None:
+            stats.statements.append(statement)
+
+    @event.listens_for(db.Model, "load", propagate=True)
+    def load(target, context):
+        stats = current_stats()
+        if stats is not None:
+            stats.rows += 1
+
+    @app.before_request
+    def start_request_stats():
+        g.sql_stats = RequestStats()
+
+    @app.after_request
+    def finish_request_stats(response):
+        stats = g.pop("sql_stats", None)
+        if stats is None:
+            return response
+
+        endpoint = request.endpoint or "unknown"
+        with _endpoints_lock:
+            if endpoint not in _endpoints:
+                _endpoints[endpoint] = EndpointStats()
+            _endpoints[endpoint].add(stats)
+
+        count_warning = app.config["SQL_QUERY_COUNT_WARNING"]
+        if count_warning is not None and stats.queries > count_warning:
+            app.logger.warning(
+                "%d queries (%.1f ms) on endpoint %s:\n%s",
+                stats.queries,
+                stats.db_time * 1000,
+                endpoint,
+                "\n".join(stats.statements),
+            )
+
+        if app.config["SQL_STATS_HEADERS"]:
+            response.headers["X-SQL-Queries"] = str(stats.queries)
+            response.headers["X-SQL-Time"] = f"{stats.db_time * 1000:.3f}"
+            response.headers["X-SQL-Rows"] = str(stats.rows)
+            response.headers["X-SQL-Slowest"] = f"{stats.slowest_time * 1000:.3f}"
+
+        return response
@@ -0,0 +1,284 @@
+"""In-process sorted leaderboards.
+
+Keeps durations, player ids and run ids of each (segment, class) leaderboard in
+sorted arrays so would-be rank lookups of runs not yet submitted, see
+SegmentTimesMixin.would_be_rank, are bisections instead of database
+queries. Leaderboards are loaded lazily, replaced with updated
+copies by run submissions of this process and checked against the segment's
+times_version at most every LEADERBOARD_MAX_AGE seconds, which catches
+submissions handled by other processes.
+Least recently used leaderboards are evicted to stay within
+LEADERBOARD_MEMORY_BUDGET bytes.
+"""
+
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from jtimer.cache import all_caches
+from jtimer.extensions import db
+from jtimer.singleflight import SingleFlight
+
+# estimated bytes per entry of the player index dictionary
+INDEX_ENTRY_SIZE = 100
+
+
+class Leaderboard:
+    """Sorted durations of one leaderboard.
+    durations, player_ids and run_ids are parallel arrays ordered by
+    (duration, run id) like the ranks.
+    Cached leaderboards are read without locks, so they are never changed,
+    see LeaderboardStore.record."""
+
+    __slots__ = ("durations", "player_ids", "run_ids", "best", "version", "checked")
+
+    def __init__(self, rows, version):
+        self.durations = array("d", (duration for _, _, duration in rows))
+        self.player_ids = array("l", (player_id for _, player_id, _ in rows))
+        self.run_ids = array("l", (run_id for run_id, _, _ in rows))
+        self.best = {player_id: duration for _, player_id, duration in rows}
+        self.version = version
+        self.checked = time.monotonic()
+
+    def __len__(self):
+        return len(self.durations)
+
+    @property
+    def nbytes(self):
+        """Estimated memory use."""
+        return (
+            sys.getsizeof(self.durations)
+            + sys.getsizeof(self.player_ids)
+            + sys.getsizeof(self.run_ids)
+            + len(self.best) * INDEX_ENTRY_SIZE
+        )
+
+    def position(self, player_id):
+        """Index of the player's run, None if the player has no run."""
+        duration = self.best.get(player_id)
+        if duration is None:
+            return None
+
+        i = bisect_left(self.durations, duration)
+        while self.player_ids[i] != player_id:
+            i += 1
+        return i
+
+    def rank_for(self, duration, player_id=None):
+        """Rank a run with duration would get.
+        The run of player_id is left out as if it was replaced."""
+        rank = bisect_right(self.durations, duration) + 1
+
+        best = self.best.get(player_id)
+        if best is not None and best <= duration:
+            rank -= 1
+        return rank
+
+    def copy(self):
+        """Copy that can be changed with set."""
+        board = Leaderboard((), self.version)
+        board.durations = array("d", self.durations)
+        board.player_ids = array("l", self.player_ids)
+        board.run_ids = array("l", self.run_ids)
+        board.best = dict(self.best)
+        board.checked = self.checked
+        return board
+
+    def set(self, player_id, duration, run_id):
+        """Add or replace the run of a player, only on uncached copies."""
+        i = self.position(player_id)
+        if i is not None:
+            del self.durations[i]
+            del self.player_ids[i]
+            del self.run_ids[i]
+
+        # ties are ordered by run id, updated runs keep their id
+        i = bisect_left(self.durations, duration)
+        while (
+            i < len(self.durations)
+            and self.durations[i] == duration
+            and self.run_ids[i] < run_id
+        ):
+            i += 1
+        self.durations.insert(i, duration)
+        self.player_ids.insert(i, player_id)
+        self.run_ids.insert(i, run_id)
+        self.best[player_id] = duration
+
+
+class LeaderboardStore:
+    """LRU store of leaderboards within a memory budget."""
+
+    def __init__(self, name="leaderboards"):
+        self.budget = 64 * 1024 * 1024
+        self.max_age = 1.0
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._boards = OrderedDict()
+        self._lock = threading.Lock()
+        # concurrent misses of a leaderboard are loaded once
+        self._fills = SingleFlight(name)
+        all_caches[name] = self
+
+    def __len__(self):
+        return len(self._boards)
+
+    def init_app(self, app):
+        """Read config."""
+        self.enabled = app.config["LEADERBOARD_CACHE"]
+        self.budget = app.config["LEADERBOARD_MEMORY_BUDGET"]
+        self.max_age = app.config["LEADERBOARD_MAX_AGE"]
+
+    @staticmethod
+    def load(segment, segment_id, player_class):
+        """Load a leaderboard from the database."""
+        model = segment.times
+        version = (
+            db.session.query(segment.model.times_version)
+            .filter(segment.model.id_ == segment_id)
+            .scalar()
+        )
+        rows = (
+            db.session.query(model.id_, model.player_id, model.duration)
+            .filter(
+                getattr(model, segment.key) == segment_id,
+                model.player_class == player_class,
+            )
+            .order_by(model.duration, model.id_)
+            .all()
+        )
+        return Leaderboard(rows, version)
+
+    def get(self, segment, segment_id, player_class):
+        """Get a leaderboard, loading it if not cached or outdated.
+        Returns None if the store is disabled or the segment doesn't exist."""
+        if not self.enabled:
+            return None
+
+        key = (segment.name, segment_id, player_class)
+        with self._lock:
+            board = self._boards.get(key)
+            if board is not None:
+                self._boards.move_to_end(key)
+
+        if board is not None and time.monotonic() - board.checked > self.max_age:
+            version = (
+                db.session.query(segment.model.times_version)
+                .filter(segment.model.id_ == segment_id)
+                .scalar()
+            )
+            if version == board.version:
+                board.checked = time.monotonic()
+            else:
+                board = None
+
+        if board is not None:
+            self.hits += 1
+            return board
+
+        self.misses += 1
+
+        def load():
+            board = self.load(segment, segment_id, player_class)
+            if board.version is not None:
+                self._store(key, board)
+            return board
+
+        board = self._fills.do(key, load)
+        if board.version is None:
+            return None
+        return board
+
+    def record(
+        self, segment, segment_id, player_class, player_id, duration, run_id, version
+    ):
+        """Apply a committed run to a cached leaderboard.
+        version is the segment's times_version after the run, leaderboards
+        that missed other changes are dropped instead."""
+        key = (segment.name, segment_id, player_class)
+        with self._lock:
+            board = self._boards.get(key)
+            if board is None:
+                return
+
+            if board.version != version - 1:
+                self._remove(key)
+                return
+
+            # readers may be using the cached leaderboard, replace it
+            updated = board.copy()
+            updated.set(player_id, duration, run_id)
+            updated.version = version
+            self._boards[key] = updated
+            self.nbytes += updated.nbytes - board.nbytes
+
+        self._evict()
+
+    def clear(self):
+        """Drop all leaderboards and reset statistics."""
+        with self._lock:
+            self._boards.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def reconcile(self, segments):
+        """Compare cached leaderboards with the database, reloading ones that differ.
+        segments maps segment type to Segment.
+        Returns list of (segment type, segment id, class) that differed."""
+        with self._lock:
+            keys = list(self._boards)
+
+        differing = []
+        for key in keys:
+            segment_type, segment_id, player_class = key
+            with self._lock:
+                board = self._boards.get(key)
+            if board is None:
+                continue
+
+            fresh = self.load(segments[segment_type], segment_id, player_class)
+            if fresh.version is None:
+                with self._lock:
+                    self._remove(key)
+                differing.append(key)
+                continue
+
+            if (
+                fresh.durations != board.durations
+                or fresh.run_ids != board.run_ids
+                or fresh.best != board.best
+                or fresh.version != board.version
+            ):
+                differing.append(key)
+                self._store(key, fresh)
+
+        return differing
+
+    def _store(self, key, board):
+        with self._lock:
+            self._remove(key)
+            self._boards[key] = board
+            self.nbytes += board.nbytes
+        self._evict()
+
+    def _remove(self, key):
+        """Remove leaderboard, caller holds the lock."""
+        board = self._boards.pop(key, None)
+        if board is not None:
+            self.nbytes -= board.nbytes
+
+    def _evict(self):
+        with self._lock:
+            # keep at least the most recent leaderboard
+            while self.nbytes > self.budget and len(self._boards) > 1:
+                _, board = self._boards.popitem(last=False)
+                self.nbytes -= board.nbytes
+
+
+leaderboards = LeaderboardStore()
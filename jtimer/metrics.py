@@ -0,0 +1,174 @@
+"""Prometheus metrics.
+
+Metrics are kept per process by default. When running multiple worker
+processes, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by
+the workers before starting them, the values are then stored in memory
+mapped files and /metrics aggregates all workers. Call
+``prometheus_client.multiprocess.mark_process_dead(pid)`` when a worker
+exits (e.g. gunicorn's child_exit hook).
+"""
+
+import os
+import time
+from functools import wraps
+
+from flask import g, request
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+from jtimer.cache import all_caches
+from jtimer.extensions import db
+
+# process gauges are refreshed at most this often, in seconds
+REFRESH_INTERVAL = 1.0
+
+REQUEST_LATENCY = Histogram(
+    "jtimer_request_duration_seconds",
+    "Request latency by endpoint.",
+    ["endpoint", "method"],
+)
+REQUEST_COUNT = Counter(
+    "jtimer_requests_total",
+    "Requests by endpoint and status code.",
+    ["endpoint", "method", "status"],
+)
+PIPELINE_LATENCY = Histogram(
+    "jtimer_pipeline_duration_seconds",
+    "Time spent in stages of request handling.",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+SINGLE_FLIGHT_CALLS = Counter(
+    "jtimer_single_flight_calls_total",
+    "Coalesced work by group, leaders did the work and coalesced calls waited for it.",
+    ["group", "role"],
+)
+EVENTS_PUBLISHED = Counter(
+    "jtimer_events_published_total",
+    "Run events published to /events subscribers.",
+)
+EVENTS_DROPPED = Counter(
+    "jtimer_event_subscribers_dropped_total",
+    "/events subscribers dropped for not keeping up.",
+)
+EVENT_SUBSCRIBERS = Gauge(
+    "jtimer_event_subscribers",
+    "Connected /events subscribers.",
+    multiprocess_mode="livesum",
+)
+IDEMPOTENT_REQUESTS = Counter(
+    "jtimer_idempotent_requests_total",
+    "Requests with an Idempotency-Key header by outcome.",
+    ["outcome"],
+)
+POOL_CONNECTIONS = Gauge(
+    "jtimer_db_pool_connections",
+    "Database connection pool connections by state.",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+CACHE_HITS = Gauge(
+    "jtimer_cache_hits",
+    "Cache hits since the process started.",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+CACHE_MISSES = Gauge(
+    "jtimer_cache_misses",
+    "Cache misses since the process started.",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+CACHE_SIZE = Gauge(
+    "jtimer_cache_entries",
+    "Cached values.",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+
+_last_refresh = 0.0
+
+
+def timed(stage):
+    """Decorator recording function duration as a pipeline stage."""
+    histogram = PIPELINE_LATENCY.labels(stage)
+
+    def decorator(function):
+        @wraps(function)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return wrapped
+
+    return decorator
+
+
+def refresh_process_gauges(engine):
+    """Update connection pool and cache gauges of this process."""
+    pool = engine.pool
+    for state, getter in (
+        ("size", "size"),
+        ("checked_in", "checkedin"),
+        ("checked_out", "checkedout"),
+        ("overflow", "overflow"),
+    ):
+        # not all pool classes keep statistics
+        if hasattr(pool, getter):
+            POOL_CONNECTIONS.labels(state).set(getattr(pool, getter)())
+
+    for name, cache in all_caches.items():
+        CACHE_HITS.labels(name).set(cache.hits)
+        CACHE_MISSES.labels(name).set(cache.misses)
+        CACHE_SIZE.labels(name).set(len(cache))
+
+
+def render():
+    """Render metrics of all processes in the text format.
+    Returns (body, content type)."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_app(app):
+    """Register request hooks."""
+    engine = db.get_engine(app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        global _last_refresh
+
+        start = g.pop("request_start", None)
+        if start is None:
+            return response
+
+        now = time.perf_counter()
+        endpoint = request.endpoint or "unknown"
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(now - start)
+        REQUEST_COUNT.labels(endpoint, request.method, response.status_code).inc()
+
+        if now - _last_refresh > REFRESH_INTERVAL:
+            _last_refresh = now
+            refresh_process_gauges(engine)
+
+        return response
@@ -0,0 +1,409 @@
+"""Additive schema migrations for existing databases.
+
+``db.create_all()`` only creates missing tables, so columns and indexes
+added to existing models are created here instead.
+
+Usage: python -m jtimer.migrations [command]
+"""
+
+import argparse
+from datetime import date
+
+from sqlalchemy import inspect, bindparam, func
+
+from jtimer import application
+from jtimer.extensions import db
+from jtimer.models.database import (
+    SEGMENTS,
+    MapTimes,
+    MapCheckpoint,
+    MapCheckpointTimes,
+    pack_splits,
+)
+
+
+def add_missing_columns(engine):
+    """Add model columns missing from existing tables.
+    Returns list of added columns."""
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            ddl = (
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                + column.type.compile(dialect=engine.dialect)
+            )
+
+            # existing rows need a value for non-nullable columns
+            default = column.default
+            if default is not None and default.is_scalar:
+                ddl += f" DEFAULT {default.arg!r}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+
+            engine.execute(ddl)
+            added.append(f"{table.name}.{column.name}")
+
+    return added
+
+
+def relax_not_null_columns(engine):
+    """Drop NOT NULL from existing columns that are nullable in the models.
+    Only MySQL is supported, other dialects are skipped.
+    Returns list of modified columns."""
+    if engine.dialect.name != "mysql":
+        return []
+
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    quote = engine.dialect.identifier_preparer.quote
+    modified = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing = {c["name"]: c for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing or not column.nullable:
+                continue
+            if existing[column.name]["nullable"]:
+                continue
+
+            engine.execute(
+                f"ALTER TABLE {quote(table.name)} MODIFY {quote(column.name)} "
+                + column.type.compile(dialect=engine.dialect)
+                + " NULL"
+            )
+            modified.append(f"{table.name}.{column.name}")
+
+    return modified
+
+
+def add_missing_indexes(engine):
+    """Create model indexes missing from existing tables.
+    Returns list of created indexes."""
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+
+            index.create(bind=engine)
+            created.append(index.name)
+
+    return created
+
+
+def remove_duplicate_runs():
+    """Keep only the fastest run of each player and class on a segment,
+    needed before the unique (segment, player, class) indexes can be created.
+    Affected leaderboards are re-ranked.
+    Returns amount of removed runs."""
+    removed = 0
+
+    for segment in SEGMENTS.values():
+        model = segment.times
+        key = getattr(model, segment.key)
+
+        duplicates = (
+            db.session.query(key, model.player_id, model.player_class)
+            .group_by(key, model.player_id, model.player_class)
+            .having(func.count(model.id_) > 1)
+            .all()
+        )
+
+        for segment_id, player_id, player_class in duplicates:
+            runs = (
+                model.query.filter(
+                    key == segment_id,
+                    model.player_id == player_id,
+                    model.player_class == player_class,
+                )
+                .order_by(model.duration, model.id_)
+                .all()
+            )
+            run_ids = [run.id_ for run in runs[1:]]
+
+            segment.checkpoint_times.query.filter(
+                segment.checkpoint_times.time_id.in_(run_ids)
+            ).delete(synchronize_session=False)
+            model.query.filter(model.id_.in_(run_ids)).delete(synchronize_session=False)
+            removed += len(run_ids)
+
+        for segment_id in {segment_id for segment_id, _, _ in duplicates}:
+            model.rank_segment(segment_id)
+
+        db.session.commit()
+
+    return removed
+
+
+def backfill_completions():
+    """Set completions of all maps, courses and bonuses from their times
+    with one UPDATE per segment type."""
+    for segment in SEGMENTS.values():
+        model = segment.times
+        key = getattr(model, segment.key)
+
+        def count(player_class):
+            return (
+                db.session.query(func.count(model.id_))
+                .filter(key == segment.model.id_, model.player_class == player_class)
+                .correlate(segment.model)
+                .as_scalar()
+            )
+
+        segment.model.query.update(
+            {"s_completions": count(2), "d_completions": count(4)},
+            synchronize_session=False,
+        )
+
+    db.session.commit()
+
+
+def verify_ranks(limit=None):
+    """Rank segments with both the sql and python backends and compare
+    ranks and points, rolling back all changes.
+    Returns list of (segment type, segment id, differing runs)."""
+    differing = []
+
+    for segment in SEGMENTS.values():
+        model = segment.times
+        key = getattr(model, segment.key)
+        segment_ids = [
+            segment_id
+            for segment_id, in db.session.query(key).distinct().limit(limit).all()
+        ]
+
+        for segment_id in segment_ids:
+            results = []
+            for backend in ("sql", "python"):
+                model.rank_segment(segment_id, backend)
+                db.session.flush()
+                results.append(
+                    set(
+                        db.session.query(model.id_, model.rank, model.points)
+                        .filter(key == segment_id)
+                        .all()
+                    )
+                )
+                db.session.rollback()
+
+            sql, python = results
+            if sql != python:
+                differing.append((segment.name, segment_id, len(sql - python)))
+
+    return differing
+
+
+def pack_checkpoint_times(batch_size=1000, delete=False):
+    """Pack map_checkpoint_times rows of existing runs into
+    map_times.checkpoint_splits, optionally deleting the rows.
+    Runs that are already packed are skipped.
+    Returns amount of packed runs."""
+    packed = 0
+    last_id = 0
+
+    while True:
+        runs = (
+            db.session.query(MapTimes.id_, MapTimes.start_time)
+            .filter(MapTimes.id_ > last_id, MapTimes.checkpoint_splits.is_(None))
+            .order_by(MapTimes.id_)
+            .limit(batch_size)
+            .all()
+        )
+        if not runs:
+            break
+
+        run_ids = [run_id for run_id, _ in runs]
+        last_id = run_ids[-1]
+
+        splits = {run_id: {} for run_id in run_ids}
+        starts = dict(runs)
+        rows = (
+            db.session.query(
+                MapCheckpointTimes.time_id,
+                MapCheckpoint.cp_index,
+                MapCheckpointTimes.time,
+            )
+            .join(MapCheckpoint, MapCheckpoint.id_ == MapCheckpointTimes.checkpoint_id)
+            .filter(MapCheckpointTimes.time_id.in_(run_ids))
+            .all()
+        )
+        for run_id, cp_index, time in rows:
+            splits[run_id][cp_index] = time - starts[run_id]
+
+        table = MapTimes.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam("b_id"))
+            .values(checkpoint_splits=bindparam("b_splits")),
+            [
+                {"b_id": run_id, "b_splits": pack_splits(run_splits)}
+                for run_id, run_splits in splits.items()
+            ],
+        )
+
+        if delete:
+            MapCheckpointTimes.query.filter(
+                MapCheckpointTimes.time_id.in_(run_ids)
+            ).delete(synchronize_session=False)
+
+        db.session.commit()
+        packed += len(run_ids)
+
+    return packed
+
+
+def month_partitions(start, months):
+    """(name, exclusive upper bound) of monthly partitions from start's month."""
+    year, month = start.year, start.month
+    partitions = []
+    for _ in range(months):
+        name = f"p{year}{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        partitions.append((name, f"{year}-{month:02d}-01"))
+    return partitions
+
+
+def partition_run_history(engine, months=12):
+    """Partition run_history by month of finished_at on MySQL.
+    Converts the table on the first run, later runs add partitions
+    for upcoming months by splitting the catch-all partition.
+    Returns list of added partitions."""
+    if engine.dialect.name != "mysql":
+        return []
+
+    existing = [
+        row[0]
+        for row in engine.execute(
+            "SELECT partition_name FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = 'run_history' "
+            "AND partition_name IS NOT NULL"
+        )
+    ]
+
+    partitions = [
+        (name, bound)
+        for name, bound in month_partitions(date.today(), months)
+        if name not in existing
+    ]
+    if not partitions:
+        return []
+
+    definitions = ", ".join(
+        f"PARTITION {name} VALUES LESS THAN ('{bound}')" for name, bound in partitions
+    )
+    definitions += ", PARTITION p_future VALUES LESS THAN (MAXVALUE)"
+
+    if not existing:
+        # the partitioning column has to be part of the primary key
+        engine.execute(
+            "ALTER TABLE run_history "
+            "DROP PRIMARY KEY, ADD PRIMARY KEY (id, finished_at) "
+            f"PARTITION BY RANGE COLUMNS(finished_at) ({definitions})"
+        )
+    else:
+        engine.execute(
+            "ALTER TABLE run_history "
+            f"REORGANIZE PARTITION p_future INTO ({definitions})"
+        )
+
+    return [name for name, _ in partitions]
+
+
+def migrate():
+    """Bring an existing database up to date with the models."""
+    engine = db.engine
+    db.create_all()
+
+    for column in add_missing_columns(engine):
+        print(f"added column {column}")
+
+    for column in relax_not_null_columns(engine):
+        print(f"made column {column} nullable")
+
+    # has to run before add_missing_indexes, the unique (segment, player,
+    # class) indexes of the times tables can't be created over duplicate runs
+    removed = remove_duplicate_runs()
+    if removed:
+        print(f"removed {removed} duplicate runs")
+
+    for index in add_missing_indexes(engine):
+        print(f"created index {index}")
+
+
+def main():
+    """Command line interface."""
+    parser = argparse.ArgumentParser(prog="python -m jtimer.migrations")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("schema", help="add missing columns and indexes (default)")
+    pack = commands.add_parser(
+        "pack-checkpoint-times",
+        help="pack checkpoint time rows of existing runs into map_times",
+    )
+    pack.add_argument("--batch-size", type=int, default=1000)
+    pack.add_argument(
+        "--delete", action="store_true", help="delete the packed checkpoint rows"
+    )
+    partition = commands.add_parser(
+        "partition-run-history",
+        help="partition run_history by month (MySQL), run monthly to add partitions",
+    )
+    partition.add_argument(
+        "--months", type=int, default=12, help="months of partitions to create ahead"
+    )
+    commands.add_parser(
+        "backfill-completions",
+        help="set completions of maps, courses and bonuses from their times",
+    )
+    verify = commands.add_parser(
+        "verify-ranks",
+        help="check that sql and python ranking give identical ranks and points",
+    )
+    verify.add_argument(
+        "--limit", type=int, default=None, help="segments to check per segment type"
+    )
+    args = parser.parse_args()
+
+    with application.app_context():
+        migrate()
+
+        if args.command == "pack-checkpoint-times":
+            packed = pack_checkpoint_times(args.batch_size, args.delete)
+            print(f"packed checkpoint times of {packed} runs")
+
+        if args.command == "backfill-completions":
+            backfill_completions()
+            print("updated completions")
+
+        if args.command == "verify-ranks":
+            differing = verify_ranks(args.limit)
+            for segment_type, segment_id, runs in differing:
+                print(f"{segment_type} {segment_id}: {runs} runs differ")
+            print(f"{len(differing)} segments differ")
+
+        if args.command == "partition-run-history":
+            for name in partition_run_history(db.engine, args.months):
+                print(f"added partition {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,120 @@
 """sqlalchemy models for flask application"""
 
+import logging
 import operator
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
 from enum import IntEnum
+import numpy as np
+from flask import json, g, current_app
 from passlib.hash import bcrypt
-from sqlalchemy import func, or_, desc, literal_column
-
+from sqlalchemy import func, and_, or_, desc, literal_column, bindparam, case
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from jtimer.cache import zone_bundles, run_splits
+from jtimer.events import event_hub
 from jtimer.extensions import db
+from jtimer.history import history_writer
+from jtimer.leaderboard import leaderboards
+from jtimer.metrics import timed
 from jtimer.points import calc_points
+from jtimer.singleflight import SingleFlight
+
+# mysql lock wait timeout and deadlock error codes
+LOCK_ERROR_CODES = (1205, 1213)
+
+
+# loads of cache misses, concurrent misses of a key are loaded once
+zone_bundle_fills = SingleFlight("zone_bundles")
+run_splits_fills = SingleFlight("run_splits")
+
+logger = logging.getLogger(__name__)
+
+
+def is_lock_error(error):
+    """True if a sqlalchemy OperationalError is a lock timeout or deadlock."""
+    args = getattr(error.orig, "args", ())
+    if args and args[0] in LOCK_ERROR_CODES:
+        return True
+
+    # sqlite busy timeout
+    return "database is locked" in str(error.orig)
+
+
+# rank, completions and record of each run on a segment, see rank_segment_sql
+RANKED_RUNS = """
+SELECT id,
+    ROW_NUMBER() OVER (PARTITION BY player_class ORDER BY duration, id) AS new_rank,
+    COUNT(*) OVER (PARTITION BY player_class) AS completions,
+    MIN(duration) OVER (PARTITION BY player_class) AS record,
+    duration
+FROM {table}
+WHERE {key} = :segment_id
+"""
+
+# rounds half up like round_points
+ROUND_POINTS = "FLOOR({points} + 0.5)"
+
+# same formula as calc_points
+RANKED_POINTS = ROUND_POINTS.format(
+    points="200 * (5 + LN(ranked.completions)) * ranked.record"
+    " / (ranked.record + (ranked.duration - ranked.record) * LN(ranked.completions))"
+)
+
+RANK_STATEMENTS = {
+    "mysql": "UPDATE {table} JOIN ({ranked}) AS ranked ON {table}.id = ranked.id"
+    " SET {table}.{rank} = ranked.new_rank, {table}.points = {points}",
+    "sqlite": "UPDATE {table} SET {rank} = ranked.new_rank, points = {points}"
+    " FROM ({ranked}) AS ranked WHERE {table}.id = ranked.id",
+}
+
+# set-based ranking support by database url, see supports_window_ranking
+_window_ranking = {}
+
+
+def supports_window_ranking(bind):
+    """True if the database can rank with window functions and UPDATE joins,
+    MySQL 8 or sqlite 3.33 with math functions."""
+    key = str(bind.engine.url)
+    if key not in _window_ranking:
+        dialect = bind.dialect
+        if dialect.name == "mysql":
+            version = dialect.server_version_info or (0,)
+            supported = getattr(dialect, "_is_mariadb", False) or version >= (8, 0)
+        elif dialect.name == "sqlite":
+            try:
+                version = bind.execute("SELECT sqlite_version(), ln(1)").scalar()
+                supported = tuple(map(int, version.split("."))) >= (3, 33)
+            except OperationalError:
+                # sqlite built without math functions
+                supported = False
+        else:
+            supported = False
+        _window_ranking[key] = supported
+
+    return _window_ranking[key]
+
+
+def pack_splits(splits):
+    """Pack {cp_index: split time} into float64 bytes indexed by cp_index - 1.
+    Missing checkpoints are stored as nan."""
+    if not splits:
+        return b""
+
+    array = np.full(max(splits), np.nan, dtype="<f8")
+    for cp_index, split in splits.items():
+        array[cp_index - 1] = split
+
+    return array.tobytes()
+
+
+def unpack_splits(data):
+    """Read-only float64 view of packed split times, indexed by cp_index - 1."""
+    return np.frombuffer(data, dtype="<f8")
 
 
 class Player(db.Model):
@@ -21,6 +129,14 @@ class Player(db.Model):
     s_rank = db.Column(db.Integer, default=0, nullable=False)
     d_rank = db.Column(db.Integer, default=0, nullable=False)
 
+    __table_args__ = (
+        db.Index("ix_player_steam_id", "steam_id", unique=True),
+        db.Index("ix_player_s_rank", "s_rank"),
+        db.Index("ix_player_d_rank", "d_rank"),
+        db.Index("ix_player_country_s_rank", "country", "s_rank"),
+        db.Index("ix_player_country_d_rank", "country", "d_rank"),
+    )
+
     @property
     def json(self):
         """Json serializable dictionary of the model"""
@@ -47,6 +163,127 @@ class Player(db.Model):
         db.session.commit()
 
     @staticmethod
+    def get_many(player_ids=(), steam_ids=()):
+        """Get players by id or steam id with one query.
+        Returns ({player_id: player}, {steam_id: player})."""
+        conditions = []
+        if player_ids:
+            conditions.append(Player.id_.in_(player_ids))
+        if steam_ids:
+            conditions.append(Player.steam_id.in_(steam_ids))
+        if not conditions:
+            return {}, {}
+
+        players = Player.query.filter(or_(*conditions)).all()
+        by_id = {player.id_: player for player in players}
+        by_steam_id = {player.steam_id: player for player in players}
+        return by_id, by_steam_id
+
+    @staticmethod
+    def upsert_many(players):
+        """Insert or update players by steam_id and commit.
+        players is a list of (steam_id, username, country) tuples,
+        later duplicates of a steam_id win.
+        Returns list of player ids in input order."""
+        rows = {}
+        for steam_id, username, country in players:
+            rows[steam_id] = {
+                "steam_id": steam_id,
+                "username": username,
+                "country": country,
+            }
+
+        table = Player.__table__
+
+        if db.engine.dialect.name == "mysql":
+            statement = mysql.insert(table).values(list(rows.values()))
+            statement = statement.on_duplicate_key_update(
+                username=statement.inserted.username,
+                country=statement.inserted.country,
+            )
+            db.session.execute(statement)
+        else:
+            # no upsert statement, update existing and insert the rest
+            existing = {
+                steam_id
+                for steam_id, in db.session.query(Player.steam_id).filter(
+                    Player.steam_id.in_(rows)
+                )
+            }
+            if existing:
+                db.session.execute(
+                    table.update()
+                    .where(table.c.steam_id == bindparam("b_steam_id"))
+                    .values(
+                        username=bindparam("b_username"),
+                        country=bindparam("b_country"),
+                    ),
+                    [
+                        {f"b_{k}": v for k, v in rows[steam_id].items()}
+                        for steam_id in existing
+                    ],
+                )
+            missing = [row for key, row in rows.items() if key not in existing]
+            if missing:
+                db.session.execute(table.insert(), missing)
+
+        ids = dict(
+            db.session.query(Player.steam_id, Player.id_).filter(
+                Player.steam_id.in_(rows)
+            )
+        )
+        db.session.commit()
+
+        return [ids[steam_id] for steam_id, _, _ in players]
+
+    @staticmethod
+    def rank_column(player_class):
+        """Get the rank column for a class.
+        Returns None for unknown classes."""
+        if player_class == 2:
+            return Player.s_rank
+        if player_class == 4:
+            return Player.d_rank
+        return None
+
+    @staticmethod
+    def leaderboard(player_class, after=0, limit=50, country=None):
+        """Get ranked players ordered by rank, starting after rank 'after'.
+        Uses keyset pagination on the rank indexes,
+        pass the rank of the last player to get the next page."""
+        rank = Player.rank_column(player_class)
+        query = Player.query.filter(rank > max(0, after))
+        if country is not None:
+            query = query.filter(Player.country == country)
+
+        return query.order_by(rank).limit(limit).all()
+
+    @staticmethod
+    def leaderboard_around(player, player_class, radius=10, country=None):
+        """Get up to 'radius' ranked players on both sides of player.
+        Returns an empty list if the player is unranked."""
+        rank = Player.rank_column(player_class)
+        player_rank = getattr(player, rank.key)
+        if player_rank < 1:
+            return []
+
+        query = Player.query
+        if country is not None:
+            query = query.filter(Player.country == country)
+
+        # two range scans on the rank index, one in each direction
+        before = (
+            query.filter(rank > 0, rank < player_rank)
+            .order_by(desc(rank))
+            .limit(radius)
+            .all()
+        )
+        after = query.filter(rank >= player_rank).order_by(rank).limit(radius + 1).all()
+
+        return before[::-1] + after
+
+    @staticmethod
+    @timed("calculate_ranks")
     def calculate_ranks():
         """Calculate player ranks and points"""
 
@@ -132,10 +369,325 @@ class Zone(db.Model):
 
         db.session.commit()
 
+    @staticmethod
+    def as_tuple(zone):
+        """Get zone as an immutable (x1, y1, z1, x2, y2, z2, orientation) tuple.
+        Returns None for None."""
+        if zone is None:
+            return None
+        return (
+            zone.x1,
+            zone.y1,
+            zone.z1,
+            zone.x2,
+            zone.y2,
+            zone.z2,
+            zone.orientation,
+        )
+
+    def set_points(self, point1, point2, orientation=0):
+        """Set zone corners and orientation without committing.
+        Returns True if any value changed."""
+        values = (*point1, *point2, orientation)
+        current = (self.x1, self.y1, self.z1, self.x2, self.y2, self.z2)
+        if current + (self.orientation,) == values:
+            return False
+
+        self.x1, self.y1, self.z1, self.x2, self.y2, self.z2, self.orientation = values
+        return True
+
+
+# Models of a segment type.
+# Maps, courses and bonuses share zones, checkpoints and leaderboards,
+# key is the name of the segment id column in checkpoint and times models.
+Segment = namedtuple(
+    "Segment", ["name", "model", "checkpoint", "times", "checkpoint_times", "key"]
+)
+
+# Immutable zones of a segment.
+# start and end are (x1, y1, z1, x2, y2, z2, orientation) tuples or None,
+# checkpoints is a tuple of (cp_index, checkpoint id, zone tuple or None),
+# json is the serialized GET /zones/<segment>/<id> response.
+ZoneBundle = namedtuple(
+    "ZoneBundle", ["version", "start", "end", "checkpoints", "json"]
+)
+
+
+class SegmentMixin:
+    """Zone handling shared by maps, courses and bonuses.
+    Models set segment_type to a key of SEGMENTS."""
+
+    segment_type = None
+
+    def add(self):
+        """Adds the model to the sqlalchemy session and commits."""
+        db.session.add(self)
+        db.session.commit()
+
+    def replace_zones(self, start, end, checkpoints):
+        """Replace all zones of the segment and commit once.
+        start and end are zone dictionaries or None to remove the zone,
+        checkpoints is a list of zone dictionaries with a cp_index.
+        Zones that didn't change are not rewritten.
+        Returns zone counts by change."""
+        segment = SEGMENTS[self.segment_type]
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        removed_zones = []
+
+        def replace(zone, data):
+            """Update, create or remove a single zone, returns the zone."""
+            if data is None:
+                if zone is not None:
+                    removed_zones.append(zone)
+                    counts["removed"] += 1
+                return None
+
+            if zone is None:
+                zone = Zone()
+                db.session.add(zone)
+                counts["added"] += 1
+                zone.set_points(data["p1"], data["p2"], data.get("orientation", 0))
+            elif zone.set_points(data["p1"], data["p2"], data.get("orientation", 0)):
+                counts["updated"] += 1
+            else:
+                counts["unchanged"] += 1
+
+            return zone
+
+        try:
+            existing_zones = {}
+            zone_ids = [z for z in (self.start_zone, self.end_zone) if z is not None]
+            if zone_ids:
+                existing_zones = {
+                    zone.id_: zone
+                    for zone in Zone.query.filter(Zone.id_.in_(zone_ids)).all()
+                }
+
+            existing_checkpoints = (
+                db.session.query(segment.checkpoint, Zone)
+                .outerjoin(Zone, Zone.id_ == segment.checkpoint.zone_id)
+                .filter(getattr(segment.checkpoint, segment.key) == self.id_)
+                .all()
+            )
+
+            start_zone = replace(existing_zones.get(self.start_zone), start)
+            end_zone = replace(existing_zones.get(self.end_zone), end)
+
+            new_checkpoints = {cp["cp_index"]: cp for cp in checkpoints}
+            checkpoint_zones = []
+            removed_checkpoints = []
+            for checkpoint, zone in existing_checkpoints:
+                zone = replace(zone, new_checkpoints.pop(checkpoint.cp_index, None))
+                if zone is None:
+                    removed_checkpoints.append(checkpoint)
+                else:
+                    checkpoint_zones.append((checkpoint, zone))
+
+            for cp_index, data in new_checkpoints.items():
+                checkpoint = segment.checkpoint(cp_index=cp_index)
+                setattr(checkpoint, segment.key, self.id_)
+                checkpoint_zones.append((checkpoint, replace(None, data)))
+
+            # flush new zones to get their ids
+            db.session.flush()
+
+            self.start_zone = None if start_zone is None else start_zone.id_
+            self.end_zone = None if end_zone is None else end_zone.id_
+            for checkpoint, zone in checkpoint_zones:
+                checkpoint.zone_id = zone.id_
+                db.session.add(checkpoint)
+
+            if removed_checkpoints:
+                checkpoint_ids = [checkpoint.id_ for checkpoint in removed_checkpoints]
+                segment.checkpoint_times.query.filter(
+                    segment.checkpoint_times.checkpoint_id.in_(checkpoint_ids)
+                ).delete(synchronize_session=False)
+                for checkpoint in removed_checkpoints:
+                    db.session.delete(checkpoint)
+
+            # references have to be gone before zones can be deleted
+            db.session.flush()
+            for zone in removed_zones:
+                db.session.delete(zone)
+
+            if counts["added"] or counts["updated"] or counts["removed"]:
+                self.invalidate_zones()
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return counts
+
+    @classmethod
+    def lock(cls, segment_id):
+        """Lock the segment row until the transaction ends.
+        sqlite has no row locks, the database write lock is taken instead.
+        Returns times_version of the segment."""
+        query = db.session.query(cls.times_version).filter(cls.id_ == segment_id)
+
+        if db.session.get_bind().dialect.name == "sqlite":
+            db.session.execute(
+                cls.__table__.update()
+                .where(cls.__table__.c.id == segment_id)
+                .values(id=cls.__table__.c.id)
+            )
+            return query.scalar()
 
-class Map(db.Model):
+        return query.with_for_update().scalar()
+
+    @classmethod
+    def bump_times_version(cls, segment_id, version):
+        """Set times_version to version + 1 after a leaderboard change.
+        Doesn't commit. Returns the new version."""
+        version = (version or 0) + 1
+        db.session.execute(
+            cls.__table__.update()
+            .where(cls.__table__.c.id == segment_id)
+            .values(times_version=version)
+        )
+        return version
+
+    @classmethod
+    def set_completions(cls, segment_id, completions):
+        """Store completions by class returned by rank_segment.
+        Doesn't commit."""
+        cls.query.filter(cls.id_ == segment_id).update(
+            {
+                "s_completions": completions["soldier"],
+                "d_completions": completions["demoman"],
+            },
+            synchronize_session="evaluate",
+        )
+
+    def invalidate_zones(self):
+        """Bump zone version so cached zone bundles get reloaded.
+        Doesn't commit."""
+        # incremented in SQL so concurrent edits can't write the same version
+        self.zone_version = type(self).zone_version + 1
+        zone_bundles.invalidate((self.segment_type, self.id_))
+        g.pop("zone_bundles", None)
+
+    @classmethod
+    def get_zone_bundle(cls, segment_id):
+        """Get zones of a segment as a ZoneBundle.
+        Cached bundles are reused while the segment's zone_version matches,
+        otherwise all zones are loaded with a single query.
+        Returns None if the segment doesn't exist."""
+        key = (cls.segment_type, segment_id)
+
+        # bundles are only validated once per request
+        validated = g.setdefault("zone_bundles", {})
+        if key in validated:
+            return validated[key]
+
+        cached = zone_bundles.get(key)
+        if cached is not None:
+            version = (
+                db.session.query(cls.zone_version)
+                .filter(cls.id_ == segment_id)
+                .scalar()
+            )
+            if version is None:
+                zone_bundles.invalidate(key)
+                return None
+            if version == cached.version:
+                validated[key] = cached
+                return cached
+
+        def load():
+            bundle = cls.load_zone_bundle(segment_id)
+            if bundle is not None:
+                zone_bundles.set(key, bundle)
+            return bundle
+
+        bundle = zone_bundle_fills.do(key, load)
+        if bundle is not None:
+            validated[key] = bundle
+
+        return bundle
+
+    @classmethod
+    def get_checkpoint_ids(cls, segment_id):
+        """Get checkpoint ids of a segment by cp_index."""
+        bundle = cls.get_zone_bundle(segment_id)
+        if bundle is None:
+            return {}
+
+        return {cp_index: id_ for cp_index, id_, _ in bundle.checkpoints}
+
+    @classmethod
+    def load_zone_bundle(cls, segment_id):
+        """Load zones of a segment with a single query.
+        Returns None if the segment doesn't exist."""
+        segment = SEGMENTS[cls.segment_type]
+        checkpoint_model = segment.checkpoint
+        start_zone = aliased(Zone)
+        end_zone = aliased(Zone)
+        checkpoint_zone = aliased(Zone)
+
+        rows = (
+            db.session.query(
+                cls.zone_version,
+                start_zone,
+                end_zone,
+                checkpoint_model,
+                checkpoint_zone,
+            )
+            .select_from(cls)
+            .outerjoin(start_zone, start_zone.id_ == cls.start_zone)
+            .outerjoin(end_zone, end_zone.id_ == cls.end_zone)
+            .outerjoin(
+                checkpoint_model, getattr(checkpoint_model, segment.key) == cls.id_
+            )
+            .outerjoin(checkpoint_zone, checkpoint_zone.id_ == checkpoint_model.zone_id)
+            .filter(cls.id_ == segment_id)
+            .order_by(checkpoint_model.cp_index)
+            .all()
+        )
+        if not rows:
+            return None
+
+        version, start, end, _, _ = rows[0]
+
+        zones = []
+        if start is not None:
+            zones.append({**start.json, "zone_type": "start"})
+        if end is not None:
+            zones.append({**end.json, "zone_type": "end"})
+
+        checkpoints = []
+        for _, _, _, checkpoint, zone in rows:
+            if checkpoint is None:
+                continue
+            zones.append(
+                {
+                    "id": checkpoint.id_,
+                    "zone_type": "cp",
+                    segment.key: segment_id,
+                    "cp_index": checkpoint.cp_index,
+                    "zone": None if zone is None else zone.json,
+                }
+            )
+            checkpoints.append(
+                (checkpoint.cp_index, checkpoint.id_, Zone.as_tuple(zone))
+            )
+
+        return ZoneBundle(
+            version=version,
+            start=Zone.as_tuple(start),
+            end=Zone.as_tuple(end),
+            checkpoints=tuple(checkpoints),
+            json=json.dumps(zones).encode(),
+        )
+
+
+class Map(SegmentMixin, db.Model):
     """Map table sqlalchemy model"""
 
+    segment_type = "map"
+
     id_ = db.Column("id", db.Integer, primary_key=True)
     mapname = db.Column(db.String(128), nullable=False)
     stier = db.Column(db.Integer, default=0, nullable=False)
@@ -144,6 +696,26 @@ class Map(db.Model):
     d_completions = db.Column(db.Integer, default=0, nullable=False)
     start_zone = db.Column(None, db.ForeignKey("zone.id"), default=None)
     end_zone = db.Column(None, db.ForeignKey("zone.id"), default=None)
+    zone_version = db.Column(db.Integer, default=0, nullable=False)
+    times_version = db.Column(db.Integer, default=0, nullable=False)
+
+    authors = db.relationship("Author", order_by="Author.id_", lazy="select")
+
+    __table_args__ = (
+        db.Index("ix_map_mapname", "mapname"),
+        db.Index("ix_map_s_completions", "s_completions", "id"),
+        db.Index("ix_map_d_completions", "d_completions", "id"),
+        db.Index("ix_map_stier_mapname", "stier", "mapname"),
+        db.Index("ix_map_dtier_mapname", "dtier", "mapname"),
+        db.Index("ix_map_stier_s_completions", "stier", "s_completions", "id"),
+        db.Index("ix_map_dtier_d_completions", "dtier", "d_completions", "id"),
+    )
+
+    # query parameter to column for list_maps
+    SORT_COLUMNS = {
+        2: {"name": "mapname", "completions": "s_completions", "tier": "stier"},
+        4: {"name": "mapname", "completions": "d_completions", "tier": "dtier"},
+    }
 
     @property
     def json(self):
@@ -158,11 +730,72 @@ class Map(db.Model):
             },
         }
 
+    @staticmethod
+    def list_maps(player_class=2, tier=None, sort="name", after=None, limit=50):
+        """Get a page of maps filtered by class tier and ordered by name
+        or by class completions, most completed and newest first.
+        Uses keyset pagination, after is (sort value, map id) of the last
+        map of the previous page."""
+        columns = Map.SORT_COLUMNS[player_class]
+        column = getattr(Map, columns[sort])
+
+        query = Map.query
+        if tier is not None:
+            query = query.filter(getattr(Map, columns["tier"]) == tier)
+
+        if sort == "completions":
+            if after is not None:
+                value, map_id = after
+                query = query.filter(
+                    or_(column < value, (column == value) & (Map.id_ < map_id))
+                )
+            # both descending so the (completions, id) indexes are read backwards
+            query = query.order_by(desc(column), desc(Map.id_))
+        else:
+            if after is not None:
+                value, map_id = after
+                query = query.filter(
+                    or_(column > value, (column == value) & (Map.id_ > map_id))
+                )
+            query = query.order_by(column, Map.id_)
+
+        return query.limit(limit).all()
+
+    @staticmethod
+    def get_many(map_ids):
+        """Get maps with authors by id with one query.
+        Returns {map_id: map}, missing maps are left out."""
+        maps = Map.with_authors().filter(Map.id_.in_(map_ids)).all()
+        return {map_.id_: map_ for map_ in maps}
+
+    @staticmethod
+    def with_authors():
+        """Map query loading authors and their players in the same query."""
+        return Map.query.options(joinedload(Map.authors).joinedload(Author.player))
+
+    @staticmethod
+    def attach_authors(maps):
+        """Load authors of already loaded maps with one query."""
+        if not maps:
+            return
+
+        authors = {map_.id_: [] for map_ in maps}
+        query = (
+            Author.query.options(joinedload(Author.player))
+            .filter(Author.map_id.in_(list(authors)))
+            .order_by(Author.id_)
+        )
+        for author in query:
+            authors[author.map_id].append(author)
+
+        for map_ in maps:
+            set_committed_value(map_, "authors", authors[map_.id_])
+
     def add(self):
         """Adds the model to the sqlalchemy session and commits.
         Updates the existing model if it already exists in the database."""
         query = Map.query.filter(
-            Map.mapname == self.mapname or Map.id_ == self.id_
+            or_(Map.mapname == self.mapname, Map.id_ == self.id_)
         ).first()
         if not query:
             db.session.add(self)
@@ -178,10 +811,14 @@ class Author(db.Model):
     player_id = db.Column(None, db.ForeignKey("player.id"), nullable=True)
     map_id = db.Column(None, db.ForeignKey("map.id"), nullable=False)
 
+    player = db.relationship("Player", lazy="select")
+
+    __table_args__ = (db.Index("ix_author_map_id", "map_id"),)
+
     @property
     def json(self):
         """Json serializable dictionary of the model"""
-        player = Player.query.filter_by(id_=self.player_id).first()
+        player = self.player
         if player:
             player_dict = player.json
             del player_dict["rank_info"]
@@ -191,9 +828,11 @@ class Author(db.Model):
         return {"name": self.name}
 
 
-class Course(db.Model):
+class Course(SegmentMixin, db.Model):
     """Course table sqlalchemy model"""
 
+    segment_type = "course"
+
     id_ = db.Column("id", db.Integer, primary_key=True)
     map_id = db.Column(None, db.ForeignKey("map.id"), nullable=False)
     course_index = db.Column(db.Integer, nullable=False)
@@ -203,11 +842,29 @@ class Course(db.Model):
     d_completions = db.Column(db.Integer, default=0, nullable=False)
     start_zone = db.Column(None, db.ForeignKey("zone.id"), default=None)
     end_zone = db.Column(None, db.ForeignKey("zone.id"), default=None)
+    zone_version = db.Column(db.Integer, default=0, nullable=False)
+    times_version = db.Column(db.Integer, default=0, nullable=False)
 
+    @property
+    def json(self):
+        """Json serializable dictionary of the model"""
+        return {
+            "id": self.id_,
+            "map_id": self.map_id,
+            "index": self.course_index,
+            "tiers": {"soldier": self.stier, "demoman": self.dtier},
+            "completions": {
+                "soldier": self.s_completions,
+                "demoman": self.d_completions,
+            },
+        }
 
-class Bonus(db.Model):
+
+class Bonus(SegmentMixin, db.Model):
     """Bonus table sqlalchemy model"""
 
+    segment_type = "bonus"
+
     id_ = db.Column("id", db.Integer, primary_key=True)
     map_id = db.Column(None, db.ForeignKey("map.id"), nullable=False)
     bonus_index = db.Column(db.Integer, nullable=False)
@@ -217,6 +874,22 @@ class Bonus(db.Model):
     d_completions = db.Column(db.Integer, default=0, nullable=False)
     start_zone = db.Column(None, db.ForeignKey("zone.id"), default=None)
     end_zone = db.Column(None, db.ForeignKey("zone.id"), default=None)
+    zone_version = db.Column(db.Integer, default=0, nullable=False)
+    times_version = db.Column(db.Integer, default=0, nullable=False)
+
+    @property
+    def json(self):
+        """Json serializable dictionary of the model"""
+        return {
+            "id": self.id_,
+            "map_id": self.map_id,
+            "index": self.bonus_index,
+            "tiers": {"soldier": self.stier, "demoman": self.dtier},
+            "completions": {
+                "soldier": self.s_completions,
+                "demoman": self.d_completions,
+            },
+        }
 
 
 class MapCheckpoint(db.Model):
@@ -260,6 +933,11 @@ class CourseCheckpoint(db.Model):
     course_id = db.Column(None, db.ForeignKey("course.id"), nullable=False)
     cp_index = db.Column(db.Integer, nullable=False)
 
+    def add(self):
+        """Adds the model to the sqlalchemy session and commits."""
+        db.session.add(self)
+        db.session.commit()
+
 
 class BonusCheckpoint(db.Model):
     """bonus_checkpoint table sqlalchemy model"""
@@ -269,32 +947,38 @@ class BonusCheckpoint(db.Model):
     bonus_id = db.Column(None, db.ForeignKey("bonus.id"), nullable=False)
     cp_index = db.Column(db.Integer, nullable=False)
 
+    def add(self):
+        """Adds the model to the sqlalchemy session and commits."""
+        db.session.add(self)
+        db.session.commit()
 
-class MapTimes(db.Model):
-    """map_times table sqlalchemy model"""
 
-    id_ = db.Column("id", db.Integer, primary_key=True)
-    map_id = db.Column(None, db.ForeignKey("map.id"), nullable=False)
-    player_id = db.Column(None, db.ForeignKey("player.id"), nullable=False)
-    player_class = db.Column(db.Integer, nullable=False)
-    start_time = db.Column(db.Float(precision=53), nullable=False)
-    end_time = db.Column(db.Float(precision=53), nullable=False)
-    duration = db.Column(db.Float(precision=53), nullable=False)
-    rank = db.Column(db.Integer, nullable=True)
-    points = db.Column(db.Integer, nullable=True)
+class SegmentTimesMixin:
+    """Leaderboard engine shared by map, course and bonus times.
+    Models set segment_type to a key of SEGMENTS."""
+
+    segment_type = None
+
+    @property
+    def segment_id(self):
+        """Id of the map, course or bonus of the run."""
+        return getattr(self, SEGMENTS[self.segment_type].key)
 
     @property
     def json(self):
         """Json serializable dictionary of the model"""
         player = Player.query.filter_by(id_=self.player_id).first()
+        return self.json_with(player, self.get_checkpoint_times())
+
+    def json_with(self, player, checkpoints):
+        """json with an already loaded player and checkpoint times."""
         player_json = None
         if player is not None:
             player_json = player.json
-        checkpoints = self.get_checkpoint_times()
 
         return {
             "id": self.id_,
-            "map_id": self.map_id,
+            SEGMENTS[self.segment_type].key: self.segment_id,
             "player": player_json,
             "class": self.player_class,
             "time": self.end_time - self.start_time,
@@ -303,226 +987,778 @@ class MapTimes(db.Model):
         }
 
     def get_checkpoint_times(self):
-        checkpoint_times = MapCheckpointTimes.query.filter_by(time_id=self.id_).all()
-        checkpoint_times_json = []
-        if checkpoint_times is not None:
-            for checkpoint_time in checkpoint_times:
-                map_checkpoint = MapCheckpoint.query.filter_by(
-                    id_=checkpoint_time.checkpoint_id
-                ).first()
-                if map_checkpoint is not None:
-                    checkpoint_times_json.append(checkpoint_time.json)
-                    checkpoint_times_json[-1]["cp_index"] = map_checkpoint.cp_index
-                    checkpoint_times_json[-1]["time"] -= self.start_time
-
-        return checkpoint_times_json
+        """Get checkpoint times relative to run start, ordered by cp_index."""
+        segment = SEGMENTS[self.segment_type]
+
+        if self.checkpoint_splits is not None:
+            splits = unpack_splits(self.checkpoint_splits)
+            checkpoint_ids = segment.model.get_checkpoint_ids(self.segment_id)
+            return [
+                {
+                    "id": checkpoint_ids[cp_index],
+                    "time": float(splits[cp_index - 1]),
+                    "cp_index": cp_index,
+                }
+                for cp_index in sorted(checkpoint_ids)
+                if cp_index <= len(splits) and not np.isnan(splits[cp_index - 1])
+            ]
+
+        checkpoint_times = (
+            db.session.query(segment.checkpoint_times, segment.checkpoint.cp_index)
+            .join(
+                segment.checkpoint,
+                segment.checkpoint.id_ == segment.checkpoint_times.checkpoint_id,
+            )
+            .filter(segment.checkpoint_times.time_id == self.id_)
+            .order_by(segment.checkpoint.cp_index)
+            .all()
+        )
+
+        return [
+            {
+                "id": checkpoint_time.checkpoint_id,
+                "time": checkpoint_time.time - self.start_time,
+                "cp_index": cp_index,
+            }
+            for checkpoint_time, cp_index in checkpoint_times
+        ]
+
+    @classmethod
+    def json_many(cls, runs):
+        """json of many runs, players and checkpoint times are loaded with
+        one query each."""
+        if not runs:
+            return []
+
+        player_ids = {run.player_id for run in runs}
+        players = {
+            player.id_: player
+            for player in Player.query.filter(Player.id_.in_(player_ids)).all()
+        }
+        checkpoints = cls.get_checkpoint_times_many(runs)
+        return [
+            run.json_with(players.get(run.player_id), checkpoints[run.id_])
+            for run in runs
+        ]
+
+    @classmethod
+    def get_checkpoint_times_many(cls, runs):
+        """get_checkpoint_times of many runs, rows of unpacked runs are
+        loaded with one query.
+        Returns {run id: checkpoint times}."""
+        segment = SEGMENTS[cls.segment_type]
+        checkpoints = {}
+        unpacked = {}
+        for run in runs:
+            if run.checkpoint_splits is not None:
+                checkpoints[run.id_] = run.get_checkpoint_times()
+            else:
+                checkpoints[run.id_] = []
+                unpacked[run.id_] = run
+        if not unpacked:
+            return checkpoints
+
+        checkpoint_times = (
+            db.session.query(segment.checkpoint_times, segment.checkpoint.cp_index)
+            .join(
+                segment.checkpoint,
+                segment.checkpoint.id_ == segment.checkpoint_times.checkpoint_id,
+            )
+            .filter(segment.checkpoint_times.time_id.in_(list(unpacked)))
+            .order_by(segment.checkpoint.cp_index)
+            .all()
+        )
+        for checkpoint_time, cp_index in checkpoint_times:
+            run = unpacked[checkpoint_time.time_id]
+            checkpoints[run.id_].append(
+                {
+                    "id": checkpoint_time.checkpoint_id,
+                    "time": checkpoint_time.time - run.start_time,
+                    "cp_index": cp_index,
+                }
+            )
+
+        return checkpoints
+
+    def get_splits(self):
+        """Get cached ((cp_index, split time), ...) of the run."""
+        key = (self.segment_type, self.id_, self.duration)
+        splits = run_splits.get(key)
+        if splits is None:
+
+            def load():
+                splits = tuple(
+                    (checkpoint["cp_index"], checkpoint["time"])
+                    for checkpoint in self.get_checkpoint_times()
+                )
+                run_splits.set(key, splits)
+                return splits
+
+            splits = run_splits_fills.do(key, load)
+
+        return splits
+
+    def filter_checkpoints(self, checkpoints):
+        """Get {cp_index: time} of checkpoints that exist on the segment."""
+        segment = SEGMENTS[self.segment_type]
+        checkpoint_ids = segment.model.get_checkpoint_ids(self.segment_id)
+        return {
+            checkpoint["cp_index"]: checkpoint["time"]
+            for checkpoint in checkpoints
+            if checkpoint["cp_index"] in checkpoint_ids
+        }
+
+    def history_row(self, checkpoints):
+        """Column values of the run for run_history."""
+        splits = {
+            cp_index: time - self.start_time
+            for cp_index, time in self.filter_checkpoints(checkpoints).items()
+        }
+        return {
+            "segment_type": self.segment_type,
+            "segment_id": self.segment_id,
+            "player_id": self.player_id,
+            "player_class": self.player_class,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": self.duration,
+            "checkpoint_splits": pack_splits(splits) or None,
+            "finished_at": datetime.utcnow(),
+        }
+
+    def event(self, result):
+        """Run event for /events subscribers from the result of add."""
+        segment = SEGMENTS[self.segment_type]
+        map_id = self.segment_id
+        if self.segment_type != "map":
+            map_id = (
+                db.session.query(segment.model.map_id)
+                .filter(segment.model.id_ == self.segment_id)
+                .scalar()
+            )
+
+        event = {
+            "type": "run",
+            "segment": self.segment_type,
+            segment.key: self.segment_id,
+            "map_id": map_id,
+            "player_id": self.player_id,
+            "class": self.player_class,
+            "result": int(result["result"]),
+        }
+        for key in ("rank", "duration", "improvement", "records", "old_records"):
+            if key in result:
+                event[key] = result[key]
+
+        return event
+
+    def beats_record(self, records):
+        """True if the run is faster than the record before it.
+        records are the records before the run, as returned by get_records.
+        First completions of a class aren't records worth announcing."""
+        name = "soldier" if self.player_class == 2 else "demoman"
+        previous = records.get(name)
+        return previous is not None and self.duration < previous["time"]
+
+    def record_notification(self, records):
+        """Notification payload of a new record.
+        records are the records before the run, as returned by get_records."""
+        name = "soldier" if self.player_class == 2 else "demoman"
+        previous = records.get(name)
+        return {
+            "segment": self.segment_type,
+            "segment_id": self.segment_id,
+            "player_id": self.player_id,
+            "class": self.player_class,
+            "duration": self.duration,
+            "previous_record": None if previous is None else previous["time"],
+            "previous_holder": (
+                None
+                if previous is None or previous["player"] is None
+                else previous["player"]["name"]
+            ),
+        }
+
+    def add_checkpoint_times(self, checkpoints):
+        """Store checkpoint times of the run without committing.
+        Times are packed into checkpoint_splits if PACK_CHECKPOINT_TIMES is set.
+        Checkpoints that don't exist on the segment are ignored."""
+        segment = SEGMENTS[self.segment_type]
+        checkpoint_ids = segment.model.get_checkpoint_ids(self.segment_id)
+        times = self.filter_checkpoints(checkpoints)
+
+        if current_app.config["PACK_CHECKPOINT_TIMES"]:
+            self.checkpoint_splits = pack_splits(
+                {cp_index: time - self.start_time for cp_index, time in times.items()}
+            )
+            return
+
+        # need the id of this run
+        db.session.flush()
+
+        for cp_index, time in times.items():
+            checkpoint_time = segment.checkpoint_times(
+                checkpoint_id=checkpoint_ids[cp_index], time_id=self.id_, time=time
+            )
+            db.session.add(checkpoint_time)
 
+    @timed("times_add")
     def add(self, checkpoints=[]):
         """Adds the model to the sqlalchemy session and commits.
         Updates the existing model if it already exists in the database.
-        Existing time is only updated if the new one is faster."""
-        query = MapTimes.query.filter(
-            MapTimes.map_id == self.map_id
-            and MapTimes.player_id == self.player_id
-            and MapTimes.player_class == self.player_class
-        ).first()
+        Existing time is only updated if the new one is faster.
+        Retried on lock timeouts and deadlocks up to RUN_INSERT_RETRIES times."""
+        retries = current_app.config["RUN_INSERT_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                result = self.add_locked(checkpoints)
+                break
+            except OperationalError as error:
+                db.session.rollback()
+                if attempt == retries or not is_lock_error(error):
+                    raise
+                time.sleep(current_app.config["RUN_INSERT_RETRY_DELAY"] * (attempt + 1))
+
+        # every finished run is kept, not only improvements
+        history_writer.append(self.history_row(checkpoints))
+
+        if result["result"] != InsertResult.NONE:
+            event_hub.publish(self.event(result))
+
+        if result["result"] != InsertResult.NONE and self.segment_type == "map":
+            self.update_player_ranks()
+
+        return result
 
-        records = MapTimes.get_records(self.map_id)
+    @staticmethod
+    def update_player_ranks():
+        """Update player ranks and points after a stored map run.
+        Retried on lock errors, the run is already committed so a failure is
+        only logged and the next map run recalculates them."""
+        retries = current_app.config["RUN_INSERT_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                Player.calculate_ranks()
+                return
+            except OperationalError as error:
+                db.session.rollback()
+                if not is_lock_error(error):
+                    raise
+                if attempt == retries:
+                    logger.warning("player ranks not updated: %s", error.orig)
+                    return
+                time.sleep(current_app.config["RUN_INSERT_RETRY_DELAY"] * (attempt + 1))
+
+    def add_locked(self, checkpoints):
+        """Insert the run and re-rank the leaderboard in one transaction,
+        holding the segment row lock until commit."""
+        cls = type(self)
+        segment = SEGMENTS[self.segment_type]
+        key_filter = (
+            getattr(cls, segment.key) == self.segment_id,
+            cls.player_id == self.player_id,
+            cls.player_class == self.player_class,
+        )
 
-        if not bool(query):
-            # no existing run, add this
-            db.session.add(self)
+        # end the transaction of earlier reads, with REPEATABLE READ its
+        # snapshot would hide runs committed while waiting for the lock
+        db.session.commit()
 
-            # add new checkpoints
-            for checkpoint in checkpoints:
-                map_checkpoint = MapCheckpoint.query.filter_by(
-                    map_id=self.map_id, cp_index=checkpoint["cp_index"]
-                ).first()
-                if map_checkpoint is not None:
-                    map_checkpoint_time = MapCheckpointTimes(
-                        checkpoint_id=map_checkpoint.id_,
-                        time_id=self.id_,
-                        time=checkpoint["time"],
-                    )
-                    db.session.add(map_checkpoint_time)
+        # serializes submissions to the same leaderboard,
+        # reads after this see everything committed before it
+        version = segment.model.lock(self.segment_id)
+
+        # old values for the response, the upsert overwrites the run
+        existing = cls.query.filter(*key_filter).first()
+        if existing is not None:
+            old_time = existing.end_time - existing.start_time
+            old_points = existing.points
+
+        records = cls.get_records(self.segment_id)
+
+        packed = current_app.config["PACK_CHECKPOINT_TIMES"]
+        if packed:
+            # sets checkpoint_splits, stored by the upsert
+            self.add_checkpoint_times(checkpoints)
+
+        result = cls.upsert_best(
+            {
+                segment.key: self.segment_id,
+                "player_id": self.player_id,
+                "player_class": self.player_class,
+                "start_time": self.start_time,
+                "end_time": self.end_time,
+                "duration": self.duration,
+                "checkpoint_splits": self.checkpoint_splits,
+            }
+        )
+        if result == InsertResult.ADDED and existing is not None:
+            # MySQL reports a kept row as one affected row like an insert
+            result = InsertResult.NONE
 
+        if result == InsertResult.NONE:
+            # slower, release the lock
             db.session.commit()
 
-            # update ranks
-            completions = MapTimes.update_ranks(self.map_id)
-
             return {
-                "result": InsertResult.ADDED,
-                "rank": self.rank,
-                "completions": completions,
-                "points_gained": self.points,
+                "result": InsertResult.NONE,
                 "duration": self.duration,
                 "records": records,
+                "old_time": old_time,
             }
 
-        # time already exists, check if faster
-        old_time = query.end_time - query.start_time
-        new_time = self.end_time - self.start_time
-        old_points = query.points
+        run = cls.query.filter(*key_filter).populate_existing().one()
 
-        if new_time < old_time:
-            improvement = old_time - new_time
+        if result == InsertResult.UPDATED:
+            # remove old checkpoints
+            segment.checkpoint_times.query.filter_by(time_id=run.id_).delete(
+                synchronize_session=False
+            )
 
-            # faster, add this
-            db.session.add(self)
+        if not packed:
+            run.add_checkpoint_times(checkpoints)
 
-            # add new checkpoints
-            for checkpoint in checkpoints:
-                map_checkpoint = MapCheckpoint.query.filter_by(
-                    map_id=self.map_id, cp_index=checkpoint["cp_index"]
-                ).first()
-                if map_checkpoint is not None:
-                    map_checkpoint_time = MapCheckpointTimes(
-                        checkpoint_id=map_checkpoint.id_,
-                        time_id=self.id_,
-                        time=checkpoint["time"],
-                    )
-                    db.session.add(map_checkpoint_time)
+        # update ranks
+        completions = cls.rank_segment(self.segment_id)
+        version = segment.model.bump_times_version(self.segment_id, version)
 
-            # remove old checkpoints
-            old_checkpoints = MapCheckpointTimes.query.filter_by(
-                time_id=query.id_
-            ).all()
-            if old_checkpoints is not None:
-                for old_checkpoint in old_checkpoints:
-                    db.session.delete(old_checkpoint)
-
-                # have to commit checkpoint deletions first
-                # to avoid foreign key constraint errors
-                db.session.commit()
-
-            # remove old time
-            db.session.delete(query)
-            db.session.commit()
+        webhooks = current_app.config["NOTIFICATION_WEBHOOKS"]
+        if webhooks and run.beats_record(records):
+            # sent by jtimer.notifications after commit
+            NotificationOutbox.enqueue(run.record_notification(records), webhooks)
 
-            # update ranks
-            completions = MapTimes.update_ranks(self.map_id)
-
-            if self.rank == 1:
-                # separate old records if time is new record
-                new_records = records.copy()
-                if self.player_class == 2:
-                    new_records["soldier"] = self.json
-                elif self.player_class == 4:
-                    new_records["demoman"] = self.json
-                return {
-                    "result": InsertResult.UPDATED,
-                    "rank": self.rank,
-                    "points_gained": self.points - old_points,
-                    "completions": completions,
-                    "improvement": improvement,
-                    "duration": self.duration,
-                    "records": new_records,
-                    "old_records": records,
-                }
+        db.session.commit()
 
+        leaderboards.record(
+            segment,
+            self.segment_id,
+            self.player_class,
+            self.player_id,
+            run.duration,
+            run.id_,
+            version,
+        )
+
+        if result == InsertResult.ADDED:
             return {
-                "result": InsertResult.UPDATED,
-                "rank": self.rank,
-                "points_gained": self.points - old_points,
+                "result": InsertResult.ADDED,
+                "rank": run.rank,
                 "completions": completions,
-                "improvement": improvement,
-                "duration": self.duration,
+                "points_gained": run.points,
+                "duration": run.duration,
                 "records": records,
             }
 
-        # slower
-        return {
-            "result": InsertResult.NONE,
-            "duration": self.duration,
+        response = {
+            "result": InsertResult.UPDATED,
+            "rank": run.rank,
+            "points_gained": run.points - old_points,
+            "completions": completions,
+            "improvement": old_time - (run.end_time - run.start_time),
+            "duration": run.duration,
             "records": records,
-            "old_time": old_time,
         }
 
-    @staticmethod
-    def get_records(map_id):
-        """Get map record for both classes."""
-        swr = (
-            MapTimes.query.filter(MapTimes.map_id == map_id, MapTimes.player_class == 2)
-            .order_by(MapTimes.duration)
-            .first()
+        if run.rank == 1:
+            # separate old records if time is new record
+            new_records = records.copy()
+            if run.player_class == 2:
+                new_records["soldier"] = run.json
+            elif run.player_class == 4:
+                new_records["demoman"] = run.json
+            response["records"] = new_records
+            response["old_records"] = records
+
+        return response
+
+    @classmethod
+    def upsert_best(cls, values):
+        """Insert a run, or replace the player's existing run if the new one is faster.
+        values is a dictionary of column values including the unique key.
+        Single statement on MySQL, otherwise a conditional update followed by
+        an insert if the player has no run.
+        Returns InsertResult decided by the affected rows. The MySQL
+        connection counts found rows, so a kept run is reported as ADDED
+        like an insert there."""
+        table = cls.__table__
+        key = SEGMENTS[cls.segment_type].key
+        replaced = [c for c in values if c not in (key, "player_id", "player_class")]
+
+        if db.session.get_bind().dialect.name == "mysql":
+            statement = mysql.insert(table).values(**values)
+            faster = statement.inserted.duration < table.c.duration
+
+            # assignments are applied in order, duration has to be compared last
+            replaced.remove("duration")
+            replaced.append("duration")
+            result = db.session.execute(
+                statement.on_duplicate_key_update(
+                    [
+                        (
+                            table.c[column],
+                            func.if_(
+                                faster, statement.inserted[column], table.c[column]
+                            ),
+                        )
+                        for column in replaced
+                    ]
+                )
+            )
+            # 1 for an insert or a kept row, 2 for a replaced row
+            if result.rowcount == 2:
+                return InsertResult.UPDATED
+            return InsertResult.ADDED
+
+        result = db.session.execute(
+            table.update()
+            .where(table.c[key] == values[key])
+            .where(table.c.player_id == values["player_id"])
+            .where(table.c.player_class == values["player_class"])
+            .where(table.c.duration > values["duration"])
+            .values({column: values[column] for column in replaced})
         )
-        dwr = (
-            MapTimes.query.filter(MapTimes.map_id == map_id, MapTimes.player_class == 4)
-            .order_by(MapTimes.duration)
+        if result.rowcount:
+            return InsertResult.UPDATED
+
+        exists = (
+            db.session.query(table.c.id)
+            .filter(
+                table.c[key] == values[key],
+                table.c.player_id == values["player_id"],
+                table.c.player_class == values["player_class"],
+            )
             .first()
         )
-        swr_json = None
-        if swr is not None:
-            swr_json = swr.json
-        dwr_json = None
-        if dwr is not None:
-            dwr_json = dwr.json
-        return {"soldier": swr_json, "demoman": dwr_json}
+        if exists is not None:
+            return InsertResult.NONE
 
-    @staticmethod
-    def update_ranks(map_id):
-        """Update ranks and points for all times on map."""
-        completions = {"soldier": 0, "demoman": 0}
+        db.session.execute(table.insert().values(**values))
+        return InsertResult.ADDED
 
-        soldier_times = (
-            MapTimes.query.filter(MapTimes.map_id == map_id, MapTimes.player_class == 2)
-            .order_by(MapTimes.duration)
+    @classmethod
+    def get_times(cls, segment_id, player_class, start=1, limit=50):
+        """Get a page of times for a class ordered by rank."""
+        segment = SEGMENTS[cls.segment_type]
+        return (
+            cls.query.filter(
+                getattr(cls, segment.key) == segment_id,
+                cls.player_class == player_class,
+                cls.rank >= start,
+            )
+            .order_by(cls.rank)
+            .limit(limit)
             .all()
         )
-        if soldier_times:
-            completions["soldier"] = len(soldier_times)
-            for i in range(0, len(soldier_times)):
-                soldier_times[i].rank = i + 1
-                soldier_times[i].points = calc_points(
-                    soldier_times[0].duration,
-                    soldier_times[i].duration,
-                    len(soldier_times),
+
+    @classmethod
+    def get_leaderboard(cls, segment_id, player_class):
+        """Get the in-memory sorted leaderboard of a class.
+        Returns None if LEADERBOARD_CACHE is disabled or the segment doesn't exist."""
+        return leaderboards.get(SEGMENTS[cls.segment_type], segment_id, player_class)
+
+    @classmethod
+    def would_be_rank(cls, segment_id, player_class, duration, player_id=None):
+        """Rank and points a run with duration would get, without inserting it.
+        The current run of player_id is left out as if it was replaced.
+        Uses the in-memory leaderboard if enabled, otherwise a single
+        aggregate query on the duration index."""
+        board = cls.get_leaderboard(segment_id, player_class)
+        if board is not None:
+            current = board.best.get(player_id)
+            others = [
+                d
+                for d, p in zip(board.durations[:2], board.player_ids)
+                if p != player_id
+            ]
+            rank = board.rank_for(duration, player_id)
+            completions = len(board)
+            record = board.durations[0] if completions else None
+            record_without = others[0] if others else None
+        else:
+            segment = SEGMENTS[cls.segment_type]
+            is_player = cls.player_id == (player_id or 0)
+            completions, record, record_without, current, faster = (
+                db.session.query(
+                    func.count(cls.id_),
+                    func.min(cls.duration),
+                    func.min(case([(is_player, None)], else_=cls.duration)),
+                    func.max(case([(is_player, cls.duration)], else_=None)),
+                    func.coalesce(
+                        func.sum(
+                            case(
+                                [(is_player, 0), (cls.duration <= duration, 1)],
+                                else_=0,
+                            )
+                        ),
+                        0,
+                    ),
+                )
+                .filter(
+                    getattr(cls, segment.key) == segment_id,
+                    cls.player_class == player_class,
+                )
+                .one()
+            )
+            rank = int(faster) + 1
+
+        if current is None:
+            new_completions = completions + 1
+        else:
+            new_completions = completions
+        new_record = (
+            duration if record_without is None else min(record_without, duration)
+        )
+
+        response = {
+            "rank": rank,
+            "points": calc_points(new_record, duration, new_completions),
+            "completions": new_completions,
+            "personal_best": current,
+            "improves": current is None or duration < current,
+        }
+        if current is not None:
+            current_points = calc_points(record, current, completions)
+            response["points_gained"] = response["points"] - current_points
+
+        return response
+
+    @classmethod
+    def get_compare_runs(cls, segment_id, player_class, player_id, rank=1):
+        """Get the run of a player and the run at rank with one query.
+        Returns (run, target), either is None if not found."""
+        segment = SEGMENTS[cls.segment_type]
+        times = cls.query.filter(
+            getattr(cls, segment.key) == segment_id,
+            cls.player_class == player_class,
+            or_(cls.player_id == player_id, cls.rank == rank),
+        ).all()
+
+        run = next((t for t in times if t.player_id == player_id), None)
+        target = next((t for t in times if t.rank == rank), None)
+        return run, target
+
+    @classmethod
+    def get_records(cls, segment_id):
+        """Get segment record for both classes."""
+        segment = SEGMENTS[cls.segment_type]
+        records = {}
+        for player_class, name in ((2, "soldier"), (4, "demoman")):
+            record = (
+                cls.query.filter(
+                    getattr(cls, segment.key) == segment_id,
+                    cls.player_class == player_class,
                 )
+                .order_by(cls.duration)
+                .first()
+            )
+            records[name] = None if record is None else record.json
+
+        return records
+
+    @classmethod
+    def get_records_many(cls, segment_ids):
+        """Get records for both classes of many segments with one query,
+        batching the player and checkpoint queries.
+        Returns {segment_id: records} like get_records."""
+        segment = SEGMENTS[cls.segment_type]
+        key = getattr(cls, segment.key)
+        records = {
+            segment_id: {"soldier": None, "demoman": None} for segment_id in segment_ids
+        }
+        if not records:
+            return records
+
+        runs = cls.query.filter(key.in_(list(records)), cls.rank == 1).all()
+        if not runs:
+            return records
+
+        for run, run_json in zip(runs, cls.json_many(runs)):
+            name = "soldier" if run.player_class == 2 else "demoman"
+            records[run.segment_id][name] = run_json
+
+        return records
 
-        demo_times = (
-            MapTimes.query.filter(MapTimes.map_id == map_id, MapTimes.player_class == 4)
-            .order_by(MapTimes.duration)
+    @classmethod
+    @timed("update_ranks")
+    def rank_segment(cls, segment_id, backend=None):
+        """Update ranks and points for all times on segment without committing.
+        backend is "sql", "python" or None for RANK_BACKEND.
+        Stores completions on the segment and returns them by class."""
+        backend = backend or current_app.config["RANK_BACKEND"]
+        if backend == "auto":
+            bind = db.session.get_bind()
+            backend = "sql" if supports_window_ranking(bind) else "python"
+
+        if backend == "sql":
+            completions = cls.rank_segment_sql(segment_id)
+        else:
+            completions = cls.rank_segment_python(segment_id)
+
+        SEGMENTS[cls.segment_type].model.set_completions(segment_id, completions)
+        return completions
+
+    @classmethod
+    def rank_segment_sql(cls, segment_id):
+        """Rank with a single UPDATE joined to a window function query.
+        Ranks and points of loaded runs are expired.
+        Returns completions by class."""
+        segment = SEGMENTS[cls.segment_type]
+        dialect = db.session.get_bind().dialect
+        quote = dialect.identifier_preparer.quote_identifier
+
+        ranked = RANKED_RUNS.format(table=cls.__tablename__, key=segment.key)
+        statement = RANK_STATEMENTS[dialect.name].format(
+            table=cls.__tablename__,
+            ranked=ranked,
+            rank=quote("rank"),
+            points=RANKED_POINTS,
+        )
+        db.session.execute(statement, {"segment_id": segment_id})
+
+        for run in list(db.session.identity_map.values()):
+            if isinstance(run, cls):
+                db.session.expire(run, ["rank", "points"])
+
+        counts = dict(
+            db.session.query(cls.player_class, func.count(cls.id_))
+            .filter(getattr(cls, segment.key) == segment_id)
+            .group_by(cls.player_class)
             .all()
         )
-        if demo_times:
-            completions["demoman"] = len(demo_times)
-            for i in range(0, len(demo_times)):
-                demo_times[i].rank = i + 1
-                demo_times[i].points = calc_points(
-                    demo_times[0].duration, demo_times[i].duration, len(demo_times)
-                )
+        return {"soldier": counts.get(2, 0), "demoman": counts.get(4, 0)}
 
-        db.session.commit()
+    @classmethod
+    def rank_segment_python(cls, segment_id):
+        """Rank by loading all runs and updating them one by one.
+        Returns completions by class."""
+        segment = SEGMENTS[cls.segment_type]
+        completions = {"soldier": 0, "demoman": 0}
 
-        # Update player ranks and points
-        Player.calculate_ranks()
+        for player_class, name in ((2, "soldier"), (4, "demoman")):
+            times = (
+                cls.query.filter(
+                    getattr(cls, segment.key) == segment_id,
+                    cls.player_class == player_class,
+                )
+                .order_by(cls.duration, cls.id_)
+                .all()
+            )
+            completions[name] = len(times)
+            for i, run in enumerate(times):
+                run.rank = i + 1
+                run.points = calc_points(times[0].duration, run.duration, len(times))
 
         return completions
 
 
-class CourseTimes(db.Model):
+class MapTimes(SegmentTimesMixin, db.Model):
+    """map_times table sqlalchemy model"""
+
+    segment_type = "map"
+
+    id_ = db.Column("id", db.Integer, primary_key=True)
+    map_id = db.Column(None, db.ForeignKey("map.id"), nullable=False)
+    player_id = db.Column(None, db.ForeignKey("player.id"), nullable=False)
+    player_class = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.Float(precision=53), nullable=False)
+    end_time = db.Column(db.Float(precision=53), nullable=False)
+    duration = db.Column(db.Float(precision=53), nullable=False)
+    rank = db.Column(db.Integer, nullable=True)
+    points = db.Column(db.Integer, nullable=True)
+    # packed split times, see pack_splits
+    checkpoint_splits = db.Column(db.LargeBinary, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_map_times_map_class_rank", "map_id", "player_class", "rank"),
+        db.Index(
+            "ix_map_times_map_player_class",
+            "map_id",
+            "player_id",
+            "player_class",
+            unique=True,
+        ),
+        db.Index(
+            "ix_map_times_map_class_duration",
+            "map_id",
+            "player_class",
+            "duration",
+            "player_id",
+        ),
+    )
+
+
+class CourseTimes(SegmentTimesMixin, db.Model):
     """course_times table sqlalchemy model"""
 
+    segment_type = "course"
+
     id_ = db.Column("id", db.Integer, primary_key=True)
     course_id = db.Column(None, db.ForeignKey("course.id"), nullable=False)
     player_id = db.Column(None, db.ForeignKey("player.id"), nullable=False)
     player_class = db.Column(db.Integer, nullable=False)
     start_time = db.Column(db.Float(precision=53), nullable=False)
     end_time = db.Column(db.Float(precision=53), nullable=False)
-    rank = db.Column(db.Integer, nullable=False)
+    duration = db.Column(db.Float(precision=53), default=0, nullable=False)
+    rank = db.Column(db.Integer, nullable=True)
+    points = db.Column(db.Integer, nullable=True)
+    # packed split times, see pack_splits
+    checkpoint_splits = db.Column(db.LargeBinary, nullable=True)
+
+    __table_args__ = (
+        db.Index(
+            "ix_course_times_course_class_rank", "course_id", "player_class", "rank"
+        ),
+        db.Index(
+            "ix_course_times_course_player_class",
+            "course_id",
+            "player_id",
+            "player_class",
+            unique=True,
+        ),
+        db.Index(
+            "ix_course_times_course_class_duration",
+            "course_id",
+            "player_class",
+            "duration",
+            "player_id",
+        ),
+    )
 
 
-class BonusTimes(db.Model):
+class BonusTimes(SegmentTimesMixin, db.Model):
     """bonus_times table sqlalchemy model"""
 
+    segment_type = "bonus"
+
     id_ = db.Column("id", db.Integer, primary_key=True)
     bonus_id = db.Column(None, db.ForeignKey("bonus.id"), nullable=False)
     player_id = db.Column(None, db.ForeignKey("player.id"), nullable=False)
     player_class = db.Column(db.Integer, nullable=False)
     start_time = db.Column(db.Float(precision=53), nullable=False)
     end_time = db.Column(db.Float(precision=53), nullable=False)
-    rank = db.Column(db.Integer, nullable=False)
+    duration = db.Column(db.Float(precision=53), default=0, nullable=False)
+    rank = db.Column(db.Integer, nullable=True)
+    points = db.Column(db.Integer, nullable=True)
+    # packed split times, see pack_splits
+    checkpoint_splits = db.Column(db.LargeBinary, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_bonus_times_bonus_class_rank", "bonus_id", "player_class", "rank"),
+        db.Index(
+            "ix_bonus_times_bonus_player_class",
+            "bonus_id",
+            "player_id",
+            "player_class",
+            unique=True,
+        ),
+        db.Index(
+            "ix_bonus_times_bonus_class_duration",
+            "bonus_id",
+            "player_class",
+            "duration",
+            "player_id",
+        ),
+    )
 
 
 class MapCheckpointTimes(db.Model):
@@ -565,6 +1801,305 @@ class BonusCheckpointTimes(db.Model):
     time = db.Column(db.Float(precision=53), nullable=False)
 
 
+class RunHistory(db.Model):
+    """run_history table sqlalchemy model.
+    Append-only log of all finished runs, written in batches by
+    jtimer.history. Has no foreign keys so MySQL can partition it."""
+
+    id_ = db.Column(
+        "id", db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True
+    )
+    segment_type = db.Column(db.String(8), nullable=False)
+    segment_id = db.Column(db.Integer, nullable=False)
+    player_id = db.Column(db.Integer, nullable=False)
+    player_class = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.Float(precision=53), nullable=False)
+    end_time = db.Column(db.Float(precision=53), nullable=False)
+    duration = db.Column(db.Float(precision=53), nullable=False)
+    # packed split times, see pack_splits
+    checkpoint_splits = db.Column(db.LargeBinary, nullable=True)
+    finished_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index(
+            "ix_run_history_player_segment",
+            "player_id",
+            "segment_type",
+            "segment_id",
+            "player_class",
+            "finished_at",
+        ),
+    )
+
+    @property
+    def json(self):
+        """Json serializable dictionary of the model"""
+        checkpoints = []
+        if self.checkpoint_splits:
+            splits = unpack_splits(self.checkpoint_splits)
+            checkpoints = [
+                {"cp_index": i + 1, "time": float(split)}
+                for i, split in enumerate(splits)
+                if not np.isnan(split)
+            ]
+
+        return {
+            "id": self.id_,
+            "time": self.duration,
+            "finished_at": self.finished_at.isoformat(),
+            "checkpoints": checkpoints,
+        }
+
+    @staticmethod
+    def progression(
+        segment_type, segment_id, player_id, player_class, limit=100, pb_only=False
+    ):
+        """Get runs of a player on a segment ordered by finish time.
+        With pb_only only runs that improved on all earlier runs are returned,
+        found with a running minimum in SQL. Without window functions at most
+        RUN_HISTORY_SCAN_LIMIT runs are scanned instead."""
+        filters = (
+            RunHistory.player_id == player_id,
+            RunHistory.segment_type == segment_type,
+            RunHistory.segment_id == segment_id,
+            RunHistory.player_class == player_class,
+        )
+        order = (RunHistory.finished_at, RunHistory.id_)
+        query = RunHistory.query.filter(*filters).order_by(*order)
+
+        if not pb_only:
+            return query.limit(limit).all()
+
+        if supports_window_ranking(db.session.get_bind()):
+            # fastest of the earlier runs, null for the first run
+            previous_best = func.min(RunHistory.duration).over(
+                order_by=order, rows=(None, -1)
+            )
+            runs = (
+                db.session.query(
+                    RunHistory.id_.label("id"),
+                    RunHistory.duration.label("duration"),
+                    previous_best.label("previous_best"),
+                )
+                .filter(*filters)
+                .subquery()
+            )
+            return (
+                RunHistory.query.join(runs, runs.c.id == RunHistory.id_)
+                .filter(
+                    or_(
+                        runs.c.previous_best.is_(None),
+                        runs.c.duration < runs.c.previous_best,
+                    )
+                )
+                .order_by(*order)
+                .limit(limit)
+                .all()
+            )
+
+        runs = []
+        best = None
+        for run in query.limit(current_app.config["RUN_HISTORY_SCAN_LIMIT"]):
+            if best is None or run.duration < best:
+                best = run.duration
+                runs.append(run)
+                if len(runs) == limit:
+                    break
+
+        return runs
+
+
+class NotificationOutbox(db.Model):
+    """notification_outbox table sqlalchemy model.
+    Record notifications waiting to be sent to webhooks by
+    jtimer.notifications, one row per notification and destination."""
+
+    id_ = db.Column("id", db.Integer, primary_key=True)
+    destination = db.Column(db.String(512), nullable=False)
+    # json payload, see SegmentTimesMixin.record_notification
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # null once sent or given up on
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    # set when given up on after NOTIFICATION_MAX_ATTEMPTS
+    failed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_notification_outbox_due", "sent_at", "next_attempt_at"),
+        db.Index("ix_notification_outbox_failed_at", "failed_at"),
+    )
+
+    @staticmethod
+    def enqueue(payload, destinations):
+        """Insert a notification for each destination with one statement.
+        Doesn't commit."""
+        now = datetime.utcnow()
+        data = json.dumps(payload)
+        db.session.execute(
+            NotificationOutbox.__table__.insert(),
+            [
+                {
+                    "destination": destination,
+                    "payload": data,
+                    "created_at": now,
+                    "attempts": 0,
+                    "next_attempt_at": now,
+                }
+                for destination in destinations
+            ],
+        )
+
+    @staticmethod
+    def due(limit=100):
+        """Get unsent notifications whose next attempt is due, oldest first."""
+        return (
+            NotificationOutbox.query.filter(
+                NotificationOutbox.sent_at.is_(None),
+                NotificationOutbox.next_attempt_at <= datetime.utcnow(),
+            )
+            .order_by(NotificationOutbox.id_)
+            .limit(limit)
+            .all()
+        )
+
+    @staticmethod
+    def remove_finished(before):
+        """Delete notifications sent or given up on before a datetime.
+        Doesn't commit."""
+        NotificationOutbox.query.filter(
+            or_(
+                NotificationOutbox.sent_at < before,
+                NotificationOutbox.failed_at < before,
+            )
+        ).delete(synchronize_session=False)
+
+
+class IdempotencyKey(db.Model):
+    """idempotency_key table sqlalchemy model.
+    Responses of requests with an Idempotency-Key header, see jtimer.idempotency."""
+
+    id_ = db.Column("id", db.Integer, primary_key=True)
+    user = db.Column(db.String(64), nullable=False)
+    key = db.Column(db.String(128), nullable=False)
+    # sha256 of method, path and body
+    request_hash = db.Column(db.String(64), nullable=False)
+    # null while the first request is in progress
+    status_code = db.Column(db.Integer, nullable=True)
+    response = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    # start of the in-progress request, whole seconds so it also identifies
+    # the claim, retries take over claims older than IDEMPOTENCY_LEASE
+    claimed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_idempotency_key_user_key", "user", "key", unique=True),
+        db.Index("ix_idempotency_key_expires_at", "expires_at"),
+    )
+
+    @staticmethod
+    def find(user, key):
+        """Get an unexpired key of user, None if not found."""
+        return IdempotencyKey.query.filter(
+            IdempotencyKey.user == user,
+            IdempotencyKey.key == key,
+            IdempotencyKey.expires_at > datetime.utcnow(),
+        ).first()
+
+    @staticmethod
+    def claim(user, key, request_hash, ttl, lease):
+        """Insert an in-progress key and commit, replacing an expired one or
+        one that has been in progress for more than lease seconds.
+        Returns claimed_at of the claim, None if claimed concurrently."""
+        now = datetime.utcnow().replace(microsecond=0)
+        IdempotencyKey.query.filter(
+            IdempotencyKey.user == user,
+            IdempotencyKey.key == key,
+            or_(
+                IdempotencyKey.expires_at <= now,
+                and_(
+                    IdempotencyKey.status_code.is_(None),
+                    or_(
+                        IdempotencyKey.claimed_at.is_(None),
+                        IdempotencyKey.claimed_at <= now - timedelta(seconds=lease),
+                    ),
+                ),
+            ),
+        ).delete(synchronize_session=False)
+
+        try:
+            db.session.execute(
+                IdempotencyKey.__table__.insert().values(
+                    user=user,
+                    key=key,
+                    request_hash=request_hash,
+                    created_at=now,
+                    expires_at=now + timedelta(seconds=ttl),
+                    claimed_at=now,
+                )
+            )
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return None
+
+        return now
+
+    @staticmethod
+    def store(user, key, claimed_at, status_code, response):
+        """Store the response of a claimed key and commit.
+        Nothing is stored if the claim was taken over."""
+        IdempotencyKey.query.filter(
+            IdempotencyKey.user == user,
+            IdempotencyKey.key == key,
+            IdempotencyKey.claimed_at == claimed_at,
+            IdempotencyKey.status_code.is_(None),
+        ).update(
+            {"status_code": status_code, "response": response},
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+    @staticmethod
+    def release(user, key, claimed_at):
+        """Remove a claimed key so the request can be retried, commits.
+        Claims taken over by a retry are kept."""
+        IdempotencyKey.query.filter(
+            IdempotencyKey.user == user,
+            IdempotencyKey.key == key,
+            IdempotencyKey.claimed_at == claimed_at,
+            IdempotencyKey.status_code.is_(None),
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def remove_expired():
+        """Delete expired keys and commit."""
+        IdempotencyKey.query.filter(
+            IdempotencyKey.expires_at <= datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+SEGMENTS = {
+    "map": Segment("map", Map, MapCheckpoint, MapTimes, MapCheckpointTimes, "map_id"),
+    "course": Segment(
+        "course",
+        Course,
+        CourseCheckpoint,
+        CourseTimes,
+        CourseCheckpointTimes,
+        "course_id",
+    ),
+    "bonus": Segment(
+        "bonus", Bonus, BonusCheckpoint, BonusTimes, BonusCheckpointTimes, "bonus_id"
+    ),
+}
+
+
 class User(db.Model):
     """user table sqlalchemy model
     for authenticating restricted views"""
@@ -578,6 +2113,7 @@ class User(db.Model):
         """Returns a new hash for the password."""
         return bcrypt.hash(password)
 
+    @timed("bcrypt_verify")
     def verify_hash(self, password):
         """Checks password against stored password hash of the user.
         Returns bool."""
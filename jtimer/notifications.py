@@ -0,0 +1,253 @@
+"""Send record notifications from the outbox to webhooks.
+
+Run submissions only insert rows to notification_outbox in the run's
+transaction, this dispatcher sends them in a separate process. Due
+notifications are grouped by destination and sent in batches of
+NOTIFICATION_BATCH_SIZE, discord batches are also split to fit in one
+message. Failed batches are retried with doubling delays (or the webhook's
+Retry-After) up to NOTIFICATION_MAX_ATTEMPTS times. Sent and given up
+notifications are deleted after NOTIFICATION_RETENTION_DAYS.
+Run a single dispatcher, concurrent dispatchers would send duplicates.
+
+Usage: python -m jtimer.notifications [--once]
+"""
+
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from jtimer import application
+from jtimer.extensions import db
+from jtimer.models.database import SEGMENTS, Map, NotificationOutbox, Player
+
+CLASS_NAMES = {2: "soldier", 4: "demoman"}
+
+# discord message length limit
+DISCORD_MAX_LENGTH = 2000
+
+
+class DeliveryError(Exception):
+    """Webhook request failed, retry_after is the requested delay if any."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_discord(url):
+    """True if url is a discord webhook."""
+    return "discord.com/api/webhooks" in url or "discordapp.com/api/webhooks" in url
+
+
+def format_time(seconds):
+    """Format duration as [h:]mm:ss.sss"""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:06.3f}"
+    return f"{minutes:02d}:{seconds:06.3f}"
+
+
+def describe(payloads):
+    """Add player and segment names to payloads with a query per model."""
+    player_ids = {payload["player_id"] for payload in payloads}
+    players = {
+        player.id_: player.username
+        for player in Player.query.filter(Player.id_.in_(player_ids)).all()
+    }
+
+    segments = {}
+    for payload in payloads:
+        key = (payload["segment"], payload["segment_id"])
+        if key not in segments:
+            segments[key] = SEGMENTS[payload["segment"]].model.query.get(key[1])
+
+    map_ids = {
+        s.id_ if isinstance(s, Map) else s.map_id for s in segments.values() if s
+    }
+    maps = {
+        map_.id_: map_.mapname for map_ in Map.query.filter(Map.id_.in_(map_ids)).all()
+    }
+
+    for payload in payloads:
+        segment = segments[(payload["segment"], payload["segment_id"])]
+        name = None
+        if isinstance(segment, Map):
+            name = maps.get(segment.id_)
+        elif segment is not None:
+            index = getattr(segment, f"{payload['segment']}_index")
+            name = f"{maps.get(segment.map_id)} {payload['segment']} {index}"
+
+        payload["player_name"] = players.get(payload["player_id"])
+        payload["segment_name"] = name
+
+    return payloads
+
+
+def message(payload):
+    """Human readable line of a record notification."""
+    line = (
+        f"{payload['player_name'] or 'Unknown player'} set a new "
+        f"{CLASS_NAMES.get(payload['class'], 'class')} record on "
+        f"{payload['segment_name'] or payload['segment']}: "
+        f"{format_time(payload['duration'])}"
+    )
+    previous = payload["previous_record"]
+    if previous is not None:
+        line += f" (-{previous - payload['duration']:.3f}s"
+        if payload["previous_holder"]:
+            line += f", previous record by {payload['previous_holder']}"
+        line += ")"
+    return line
+
+
+def batches(destination, notifications, batch_size):
+    """Split notifications of a destination into batches of at most
+    batch_size, discord batches also have to fit in one message.
+    Yields lists of (notification, described payload)."""
+    payloads = describe([json.loads(n.payload) for n in notifications])
+
+    batch = []
+    length = 0
+    for notification, payload in zip(notifications, payloads):
+        # line and its newline
+        size = len(message(payload)) + 1 if is_discord(destination) else 0
+        if batch and (
+            len(batch) == batch_size or length + size > DISCORD_MAX_LENGTH + 1
+        ):
+            yield batch
+            batch = []
+            length = 0
+
+        batch.append((notification, payload))
+        length += size
+
+    if batch:
+        yield batch
+
+
+def request_body(url, payloads):
+    """Webhook request body of a batch."""
+    if is_discord(url):
+        content = "\n".join(message(payload) for payload in payloads)
+        # only a single line can be too long, batches are split to fit
+        return {"content": content[:DISCORD_MAX_LENGTH]}
+
+    return {"records": payloads}
+
+
+def post(url, body, timeout):
+    """POST json body, raises DeliveryError on failure."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json", "User-Agent": "jtimer-api"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+    except urllib.error.HTTPError as error:
+        retry_after = error.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise DeliveryError(f"HTTP {error.code}", retry_after) from error
+    except (urllib.error.URLError, OSError) as error:
+        raise DeliveryError(str(error)) from error
+
+
+def retry_delay(attempts, retry_after=None):
+    """Seconds to wait before the next attempt."""
+    config = application.config
+    delay = config["NOTIFICATION_RETRY_DELAY"] * 2 ** (attempts - 1)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return min(delay, config["NOTIFICATION_MAX_RETRY_DELAY"])
+
+
+def dispatch_once():
+    """Send due notifications, one request per batch and destination.
+    Returns (sent, failed) notification counts."""
+    config = application.config
+    batch_size = config["NOTIFICATION_BATCH_SIZE"]
+    sent = failed = 0
+
+    by_destination = OrderedDict()
+    for notification in NotificationOutbox.due(limit=batch_size * 20):
+        by_destination.setdefault(notification.destination, []).append(notification)
+
+    for destination, notifications in by_destination.items():
+        for described in batches(destination, notifications, batch_size):
+            batch = [notification for notification, _ in described]
+            payloads = [payload for _, payload in described]
+            now = datetime.utcnow()
+
+            try:
+                post(
+                    destination,
+                    request_body(destination, payloads),
+                    config["NOTIFICATION_TIMEOUT"],
+                )
+            except DeliveryError as error:
+                for notification in batch:
+                    notification.attempts += 1
+                    notification.last_error = str(error)[:255]
+                    if notification.attempts >= config["NOTIFICATION_MAX_ATTEMPTS"]:
+                        notification.next_attempt_at = None
+                        notification.failed_at = now
+                    else:
+                        delay = retry_delay(notification.attempts, error.retry_after)
+                        notification.next_attempt_at = now + timedelta(seconds=delay)
+                failed += len(batch)
+                db.session.commit()
+
+                # skip the rest of the batches of a failing destination
+                break
+
+            for notification in batch:
+                notification.attempts += 1
+                notification.sent_at = now
+                notification.next_attempt_at = None
+            sent += len(batch)
+            db.session.commit()
+
+    return sent, failed
+
+
+def remove_finished():
+    """Delete notifications sent or given up on more than
+    NOTIFICATION_RETENTION_DAYS ago."""
+    days = application.config["NOTIFICATION_RETENTION_DAYS"]
+    NotificationOutbox.remove_finished(datetime.utcnow() - timedelta(days=days))
+    db.session.commit()
+
+
+def main():
+    """Command line interface."""
+    parser = argparse.ArgumentParser(prog="python -m jtimer.notifications")
+    parser.add_argument(
+        "--once", action="store_true", help="send due notifications and exit"
+    )
+    args = parser.parse_args()
+
+    with application.app_context():
+        while True:
+            sent, failed = dispatch_once()
+            if sent or failed:
+                print(f"sent {sent} notifications, {failed} failed")
+
+            if args.once:
+                break
+
+            remove_finished()
+            time.sleep(application.config["NOTIFICATION_POLL_INTERVAL"])
+
+
+if __name__ == "__main__":
+    main()
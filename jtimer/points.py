@@ -7,5 +7,11 @@ def calc_points(wr_time, pr_time, completions):
     """Tom "Tim" Sinister's point weight scaling algorithm"""
     wr_points = 200 * (5 + math.log(completions))
     scale_factor = wr_time / (wr_time + (pr_time - wr_time) * math.log(completions))
-    points_awarded = round(wr_points * scale_factor)
+    points_awarded = round_points(wr_points * scale_factor)
     return points_awarded
+
+
+def round_points(points):
+    """Round half up, same as ROUND_POINTS in SQL ranking.
+    round() rounds halves to even and SQL ROUND differs by database."""
+    return math.floor(points + 0.5)
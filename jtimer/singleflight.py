@@ -0,0 +1,87 @@
+"""Coalescing of concurrent identical work within a process.
+
+When many game servers refresh the same leaderboard at once, the first
+request computes the response and concurrent identical requests wait for
+it instead of running the same queries. Cache fills are coalesced the
+same way, so a cache miss after invalidation is loaded once.
+"""
+
+import threading
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+from jtimer.metrics import SINGLE_FLIGHT_CALLS
+
+
+class _Call:
+    """In-flight computation."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs a function once per key for all concurrent callers."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._leaders = SINGLE_FLIGHT_CALLS.labels(name, "leader")
+        self._coalesced = SINGLE_FLIGHT_CALLS.labels(name, "coalesced")
+
+    def do(self, key, function):
+        """Call function, or wait for the result of a concurrent call with
+        the same key. Exceptions are raised to all callers."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._coalesced.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self._leaders.inc()
+        try:
+            call.result = function()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def coalesce(view_function):
+    """Share responses of concurrent identical GET requests to a view.
+    Only for views whose response depends on nothing but the url.
+    Disabled by setting SINGLE_FLIGHT_VIEWS to False."""
+    flight = SingleFlight(view_function.__name__)
+
+    @wraps(view_function)
+    def wrapped(**kwargs):
+        if not current_app.config["SINGLE_FLIGHT_VIEWS"]:
+            return view_function(**kwargs)
+
+        def render():
+            # responses are modified by after_request hooks,
+            # share the parts needed to build a copy instead
+            response = make_response(view_function(**kwargs))
+            return response.get_data(), response.status_code, list(response.headers)
+
+        data, status, headers = flight.do(request.full_path, render)
+        return make_response(data, status, headers)
+
+    return wrapped
@@ -0,0 +1,192 @@
+"""Server-side run validation against map, course and bonus zones.
+
+Game servers can send a position trace of the run with the submission.
+The trace is base64 encoded little-endian float32 (time, x, y, z) samples
+ordered by time, with times relative to the run's start_time.
+"""
+
+import base64
+import binascii
+from collections import namedtuple
+
+import numpy as np
+
+from jtimer.cache import LRUCache
+from jtimer.models.database import SEGMENTS
+
+# maximum amount of boxes in a leaf of the zone index
+LEAF_SIZE = 8
+
+# (segment type, segment id) -> ZoneIndex
+zone_indexes = LRUCache(maxsize=256, name="zone_indexes")
+
+TraceResult = namedtuple("TraceResult", ["valid", "message"])
+
+
+class ZoneIndex:
+    """Packed single level R-tree over the axis-aligned zone boxes of a segment.
+
+    Box columns are ordered start, checkpoints by cp_index, end.
+    Boxes are packed into leaves by their x center,
+    samples are only tested against boxes of the leaves they fall in."""
+
+    def __init__(self, bundle):
+        self.version = bundle.version
+        self.cp_indexes = tuple(cp_index for cp_index, _, _ in bundle.checkpoints)
+
+        zones = [bundle.start] + [zone for _, _, zone in bundle.checkpoints]
+        zones.append(bundle.end)
+
+        # missing zones stay nan and never contain anything
+        self.boxes = np.full((len(zones), 2, 3), np.nan)
+        for column, zone in enumerate(zones):
+            if zone is not None:
+                corners = np.array(zone[:6], dtype=np.float64).reshape(2, 3)
+                self.boxes[column, 0] = corners.min(axis=0)
+                self.boxes[column, 1] = corners.max(axis=0)
+
+        present = np.flatnonzero(~np.isnan(self.boxes[:, 0, 0]))
+        centers = self.boxes[present, :, 0].mean(axis=1)
+        order = present[np.argsort(centers, kind="stable")]
+
+        self.leaves = []
+        for i in range(0, len(order), LEAF_SIZE):
+            columns = order[i : i + LEAF_SIZE]
+            low = self.boxes[columns, 0].min(axis=0)
+            high = self.boxes[columns, 1].max(axis=0)
+            self.leaves.append((columns, low, high))
+
+    @property
+    def start(self):
+        """Column of the start zone."""
+        return 0
+
+    @property
+    def end(self):
+        """Column of the end zone."""
+        return len(self.boxes) - 1
+
+    @property
+    def complete(self):
+        """True if the segment has both start and end zones."""
+        return not np.isnan(self.boxes[[self.start, self.end], 0, 0]).any()
+
+    def contains(self, points):
+        """Test which zones contain which points.
+        points is an (N, 3) array.
+        Returns an (N, zones) bool array."""
+        inside = np.zeros((len(points), len(self.boxes)), dtype=bool)
+
+        for columns, low, high in self.leaves:
+            rows = np.flatnonzero(np.all((points >= low) & (points <= high), axis=1))
+            if rows.size == 0:
+                continue
+
+            candidates = points[rows, None, :]
+            boxes = self.boxes[columns]
+            inside[np.ix_(rows, columns)] = np.all(
+                (candidates >= boxes[None, :, 0]) & (candidates <= boxes[None, :, 1]),
+                axis=2,
+            )
+
+        return inside
+
+
+def get_zone_index(segment, segment_id):
+    """Get spatial index of segment zones, rebuilt when zones change.
+    segment is a key of SEGMENTS.
+    Returns None if the segment doesn't exist."""
+    bundle = SEGMENTS[segment].model.get_zone_bundle(segment_id)
+    if bundle is None:
+        return None
+
+    key = (segment, segment_id)
+    index = zone_indexes.get(key)
+    if index is None or index.version != bundle.version:
+        index = ZoneIndex(bundle)
+        zone_indexes.set(key, index)
+
+    return index
+
+
+def decode_trace(data):
+    """Decode base64 trace to an (N, 4) array of (time, x, y, z).
+    Raises ValueError for malformed traces."""
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except binascii.Error as error:
+        raise ValueError("trace is not valid base64") from error
+
+    if not raw or len(raw) % 16:
+        raise ValueError("trace must contain (time, x, y, z) float32 samples")
+
+    trace = np.frombuffer(raw, dtype="<f4").reshape(-1, 4).astype(np.float64)
+    if not np.isfinite(trace).all():
+        raise ValueError("trace contains non-finite values")
+    if (np.diff(trace[:, 0]) < 0).any():
+        raise ValueError("trace samples must be ordered by time")
+
+    return trace
+
+
+def validate_run(segment, segment_id, data, duration, checkpoints, tolerance):
+    """Decode and validate a base64 trace against segment zones.
+    Returns TraceResult."""
+    index = get_zone_index(segment, segment_id)
+    if index is None:
+        return TraceResult(False, f"{segment} not found")
+
+    try:
+        trace = decode_trace(data)
+    except ValueError as error:
+        return TraceResult(False, str(error))
+
+    return validate_trace(index, trace, duration, checkpoints, tolerance)
+
+
+def validate_trace(index, trace, duration, checkpoints, tolerance):
+    """Check that the trace goes through start, checkpoints in order and end,
+    and that its timing agrees with the submitted run.
+    checkpoints maps cp_index to time relative to run start.
+    Returns TraceResult."""
+    if not index.complete:
+        return TraceResult(True, "no start or end zone, not validated")
+
+    times = trace[:, 0]
+    inside = index.contains(trace[:, 1:])
+
+    in_start = np.flatnonzero(inside[:, index.start])
+    if in_start.size == 0:
+        return TraceResult(False, "trace never enters the start zone")
+
+    # the run starts when leaving the start zone for the last time
+    run_start = in_start[-1]
+    in_end = np.flatnonzero(inside[run_start:, index.end]) + run_start
+    if in_end.size == 0:
+        return TraceResult(False, "trace never reaches the end zone")
+    run_end = in_end[0]
+
+    if abs(times[run_start]) > tolerance:
+        return TraceResult(False, "trace start doesn't match start_time")
+
+    if abs(times[run_end] - duration) > tolerance:
+        return TraceResult(False, "trace end doesn't match end_time")
+
+    # first entry into each checkpoint after entering the previous one,
+    # routes may pass through later checkpoints early
+    previous = run_start
+    for column, cp_index in enumerate(index.cp_indexes, start=1):
+        hits = np.flatnonzero(inside[previous:run_end, column])
+        if hits.size == 0:
+            if inside[run_start:previous, column].any():
+                return TraceResult(False, f"checkpoint {cp_index} reached out of order")
+            return TraceResult(False, f"trace misses checkpoint {cp_index}")
+
+        entry = hits[0] + previous
+        previous = entry
+
+        reported = checkpoints.get(cp_index)
+        if reported is not None and abs(times[entry] - reported) > tolerance:
+            return TraceResult(False, f"checkpoint {cp_index} time doesn't match")
+
+    return TraceResult(True, "ok")
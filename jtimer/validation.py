@@ -5,6 +5,8 @@ from functools import wraps
 from flask import jsonify, make_response, request
 from cerberus import Validator
 
+from jtimer.metrics import timed
+
 
 class ExtendedValidator(Validator):
     """Extend cerberus validator"""
@@ -49,6 +51,19 @@ class ExtendedValidator(Validator):
         return not bool(self._errors)
 
 
+def list_arg(name, type=str):
+    """Get a comma separated query parameter as a list.
+    Raises ValueError if a value can't be converted with type."""
+    value = request.args.get(name, default="", type=str)
+    return [type(item.strip()) for item in value.split(",") if item.strip()]
+
+
+@timed("cerberus_validate")
+def validate(validator, document, schema):
+    """Validate document, returns True if valid."""
+    return validator.validate(document, schema)
+
+
 def validate_json(schema):
     """cerberus json validation decorator for flask views"""
 
@@ -70,7 +85,7 @@ def validate_json(schema):
 
             # If valid, run view function
             validator = ExtendedValidator()
-            if validator.validate(document, schema):
+            if validate(validator, document, schema):
                 return view_function(**kwargs)
 
             # Invalid json, return errors
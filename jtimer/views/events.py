@@ -0,0 +1,86 @@
+"""flask views for /events endpoint"""
+
+import json
+import queue
+
+from flask import Response, current_app, jsonify, make_response, request
+
+from jtimer.blueprints import events_index
+from jtimer.events import event_hub
+
+
+@events_index.route("", methods=["GET"])
+def stream_events():
+    """Stream run events as server-sent events.
+
+    .. :quickref: Events; Stream new times and records.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /events?map_id=1 HTTP/1.1
+      Accept: text/event-stream
+
+    **Example response**:
+
+    .. sourcecode:: text
+
+      id: 42
+      event: run
+      data: {"type": "run", "segment": "map", "map_id": 1, "player_id": 24,
+             "class": 2, "result": 2, "rank": 1, "duration": 10424.51525167,
+             "improvement": 200.0, "records": {...}, "old_records": {...}}
+
+      : keep-alive
+
+      event: dropped
+      data: {}
+
+    **Note**: An event is sent when a run is added (result 1) or improves
+    a time (result 2), "records" and "old_records" are as in the insert
+    response. Course and bonus events have "course_id" or "bonus_id" and
+    the "map_id" of the course or bonus. Streams that don't keep up get a
+    "dropped" event and are closed, reconnect to continue.
+
+    :query map_id: only stream events of this map. (optional)
+    :query player_id: only stream events of this player. (optional)
+
+    :status 200: Success.
+    :status 503: Too many streams, try again later.
+    :returns: Event stream
+    """
+    map_id = request.args.get("map_id", default=None, type=int)
+    player_id = request.args.get("player_id", default=None, type=int)
+
+    subscriber = event_hub.subscribe(map_id, player_id)
+    if subscriber is None:
+        response = {"message": "Too many event streams, try again later."}
+        return make_response(jsonify(response), 503, {"Retry-After": "5"})
+
+    keepalive = current_app.config["EVENT_KEEPALIVE"]
+
+    def generate():
+        try:
+            # sent right away so clients know the stream is open
+            yield ": connected\n\n"
+            while True:
+                try:
+                    event_id, event = subscriber.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    if subscriber.dropped:
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield f"id: {event_id}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+                if subscriber.dropped and subscriber.queue.empty():
+                    break
+
+            yield "event: dropped\ndata: {}\n\n"
+        finally:
+            event_hub.unsubscribe(subscriber)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(generate(), mimetype="text/event-stream", headers=headers)
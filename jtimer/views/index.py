@@ -2,8 +2,14 @@
 
 from configparser import ConfigParser
 from flask import jsonify, make_response
+from flask_jwt_extended import jwt_required
 
+from jtimer import metrics
 from jtimer.blueprints import application_index
+from jtimer.extensions import db
+from jtimer.instrumentation import endpoint_stats
+from jtimer.leaderboard import leaderboards
+from jtimer.models.database import SEGMENTS
 
 
 @application_index.route("/", methods=["GET"])
@@ -22,3 +28,124 @@ def info():
     config.read("jtimer/config/info.ini")
     info_dict = dict(config.items("root"))
     return make_response(jsonify(info_dict), 200)
+
+
+@application_index.route("/stats/sql", methods=["GET"])
+@jwt_required
+def sql_stats():
+    """Get SQL statistics aggregated by endpoint.
+
+    .. :quickref: Stats; Get SQL statistics by endpoint.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /stats/sql HTTP/1.1
+      Authorization: Bearer <access_token>
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "times.get_times": {
+              "requests": 10,
+              "queries": 1020,
+              "queries_per_request": 102.0,
+              "max_queries": 102,
+              "db_time": 0.51,
+              "db_time_per_request": 0.051,
+              "rows": 1010,
+              "slowest_time": 0.004,
+              "slowest": "SELECT map_times.id AS map_times_id, ..."
+          }
+      }
+
+    **Note**: Statistics are per process and ordered by total database time.
+    Times are in seconds.
+
+    :status 200: Success.
+    :returns: SQL statistics by endpoint
+    """
+    stats = sorted(
+        endpoint_stats().items(), key=lambda item: item[1]["db_time"], reverse=True
+    )
+    return make_response(jsonify(dict(stats)), 200)
+
+
+@application_index.route("/stats/leaderboards/reconcile", methods=["POST"])
+@jwt_required
+def reconcile_leaderboards():
+    """Compare in-memory leaderboards with the database.
+    Leaderboards that differ are reloaded.
+
+    .. :quickref: Stats; Reconcile in-memory leaderboards.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      POST /stats/leaderboards/reconcile HTTP/1.1
+      Authorization: Bearer <access_token>
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "checked": 12,
+          "bytes": 48210,
+          "differing": [
+              {"segment": "map", "segment_id": 3, "class": 2}
+          ]
+      }
+
+    **Note**: Leaderboards are per process, only the process handling the
+    request is reconciled.
+
+    :status 200: Success.
+    :returns: Reconciled leaderboards
+    """
+    checked = len(leaderboards)
+    differing = leaderboards.reconcile(SEGMENTS)
+    response = {
+        "checked": checked,
+        "bytes": leaderboards.nbytes,
+        "differing": [
+            {"segment": segment, "segment_id": segment_id, "class": player_class}
+            for segment, segment_id, player_class in differing
+        ],
+    }
+    return make_response(jsonify(response), 200)
+
+
+@application_index.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Get metrics in the Prometheus text format.
+
+    .. :quickref: Stats; Get Prometheus metrics.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /metrics HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: text
+
+      # HELP jtimer_request_duration_seconds Request latency by endpoint.
+      # TYPE jtimer_request_duration_seconds histogram
+      jtimer_request_duration_seconds_bucket{endpoint="times.get_times",le="0.005",method="GET"} 10.0
+      ...
+
+    **Note**: Includes all worker processes when PROMETHEUS_MULTIPROC_DIR is set.
+
+    :status 200: Success.
+    :returns: Metrics
+    """
+    metrics.refresh_process_gauges(db.engine)
+    body, content_type = metrics.render()
+    return make_response(body, 200, {"Content-Type": content_type})
@@ -4,11 +4,98 @@ from flask import jsonify, make_response, request
 from flask_jwt_extended import jwt_required
 
 from jtimer.blueprints import maps_index
-from jtimer.models.database import Map, Author, MapTimes
-from jtimer.validation import validate_json
+from jtimer.models.database import Map, MapTimes, Course, Bonus, SEGMENTS
+from jtimer.singleflight import coalesce
+from jtimer.validation import validate_json, list_arg
+
+# maps per /maps request
+MAX_MAPS = 50
+
+
+@maps_index.route("", methods=["GET"])
+@coalesce
+def get_maps():
+    """Get info of many maps by id.
+
+    .. :quickref: Maps; Get info of many maps.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /maps?ids=1,4 HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "maps": [
+              {
+                  "id": 1,
+                  "name": "jump_soar_a4",
+                  "tiers": {
+                      "soldier": 5,
+                      "demoman": 3
+                  },
+                  "completions": {
+                      "soldier": 1402,
+                      "demoman": 2401
+                  },
+                  "records": {
+                      "soldier": <time object>
+                      "demoman": <time object>
+                  },
+                  "authors": [
+                      {
+                          "id": 5,
+                          "name": "Matti",
+                          "country": "UK"
+                      }
+                  ]
+              },
+              null
+          ]
+      }
+
+    :query ids: comma separated map ids. (max: 50)
+
+    **Note**: Maps are returned in the order of ids, maps that don't exist are null.
+
+    :status 200: Success.
+    :status 422: Invalid or too many ids.
+    :returns: Map info
+    """
+    try:
+        map_ids = list_arg("ids", int)
+    except ValueError:
+        error = {"message": "ids must be comma separated integers."}
+        return make_response(jsonify(error), 422)
+
+    if len(map_ids) > MAX_MAPS:
+        error = {"message": f"At most {MAX_MAPS} maps per request."}
+        return make_response(jsonify(error), 422)
+
+    maps = Map.get_many(map_ids)
+    records = MapTimes.get_records_many(list(maps))
+
+    response = {"maps": []}
+    for map_id in map_ids:
+        map_ = maps.get(map_id)
+        if map_ is None:
+            response["maps"].append(None)
+            continue
+
+        map_json = map_.json
+        map_json["records"] = records[map_id]
+        map_json["authors"] = [author.json for author in map_.authors]
+        response["maps"].append(map_json)
+
+    return make_response(jsonify(response), 200)
 
 
 @maps_index.route("/<int:map_id>/info", methods=["GET"])
+@coalesce
 def map_info(map_id):
     """Get map info with id.
 
@@ -54,18 +141,14 @@ def map_info(map_id):
     :status 404: Map not found.
     :returns: Map info
     """
-    map_ = Map.query.filter_by(id_=map_id).first()
-    authors = Author.query.filter_by(id_=map_id).all()
+    map_ = Map.with_authors().filter(Map.id_ == map_id).first()
 
     if map_ is None:
         response = {"message": "Map not found."}
         return make_response(jsonify(response), 404)
 
     response = map_.json
-    response["authors"] = []
-    if authors is not None:
-        for author in authors:
-            response["authors"].append(author.json)
+    response["authors"] = [author.json for author in map_.authors]
 
     records = MapTimes.get_records(map_.id_)
     response["records"] = records
@@ -73,7 +156,113 @@ def map_info(map_id):
     return make_response(jsonify(response), 200)
 
 
+@maps_index.route("/list", methods=["GET"])
+@coalesce
+def list_maps():
+    """Get a page of maps.
+
+    .. :quickref: Maps; Get list of maps.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /maps/list?class=2&tier=5&sort=completions&limit=2 HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "maps": [
+              {
+                  "id": 1,
+                  "name": "jump_soar_a4",
+                  "tiers": {
+                      "soldier": 5,
+                      "demoman": 3
+                  },
+                  "completions": {
+                      "soldier": 1402,
+                      "demoman": 2401
+                  }
+              },
+              {
+                  "id": 7,
+                  "name": "jump_beef",
+                  "tiers": {
+                      "soldier": 5,
+                      "demoman": 4
+                  },
+                  "completions": {
+                      "soldier": 980,
+                      "demoman": 1200
+                  }
+              }
+          ],
+          "next": "980:7"
+      }
+
+    :query class: class of the tier filter and completions sort. (default: 2)
+    :query tier: tier to filter by. (optional)
+    :query sort: "name" or "completions", completions are sorted most completed first, then newest. (default: "name")
+    :query limit: amount of maps to get. (default: 50, min: 1, max: 100)
+    :query after: map to start the list after, use "next" of the previous page. (optional)
+    :query authors: include map authors. (default: 0)
+
+    **Note**: "next" is null on the last page.
+
+    :status 200: Success.
+    :status 422: Invalid parameters.
+    :returns: Maps
+    """
+    player_class = request.args.get("class", default=2, type=int)
+    tier = request.args.get("tier", default=None, type=int)
+    sort = request.args.get("sort", default="name", type=str)
+    limit = request.args.get("limit", default=50, type=int)
+    after = request.args.get("after", default=None, type=str)
+    authors = request.args.get("authors", default=0, type=int)
+
+    if player_class not in (2, 4):
+        error = {"message": "class must be 2 or 4."}
+        return make_response(jsonify(error), 422)
+
+    if sort not in ("name", "completions"):
+        error = {"message": "sort must be 'name' or 'completions'."}
+        return make_response(jsonify(error), 422)
+
+    limit = max(1, min(limit, 100))
+
+    if after is not None:
+        try:
+            value, map_id = after.rsplit(":", 1)
+            after = (int(value) if sort == "completions" else value, int(map_id))
+        except ValueError:
+            error = {"message": "Invalid 'after', use 'next' of the previous page."}
+            return make_response(jsonify(error), 422)
+
+    maps = Map.list_maps(player_class, tier, sort, after, limit)
+    if authors:
+        Map.attach_authors(maps)
+
+    next_after = None
+    if len(maps) == limit:
+        last = maps[-1]
+        column = Map.SORT_COLUMNS[player_class][sort]
+        next_after = f"{getattr(last, column)}:{last.id_}"
+
+    response = {"maps": [], "next": next_after}
+    for map_ in maps:
+        map_json = map_.json
+        if authors:
+            map_json["authors"] = [author.json for author in map_.authors]
+        response["maps"].append(map_json)
+
+    return make_response(jsonify(response), 200)
+
+
 @maps_index.route("/name/<string:mapname>", methods=["GET"])
+@coalesce
 def map_info_name(mapname):
     """Get map by name.
 
@@ -119,22 +308,17 @@ def map_info_name(mapname):
     :status 404: Map not found.
     :returns: Map info
     """
-    map_ = Map.query.filter_by(mapname=mapname).first()
+    map_ = Map.with_authors().filter(Map.mapname == mapname).first()
 
     if map_ is None:
-        map_ = Map.query.filter(Map.mapname.like(f"%{mapname}%")).first()
+        map_ = Map.with_authors().filter(Map.mapname.like(f"%{mapname}%")).first()
 
     if map_ is None:
         response = {"message": "Map not found."}
         return make_response(jsonify(response), 404)
 
-    authors = Author.query.filter_by(id_=map_.id_).all()
-
     response = map_.json
-    response["authors"] = []
-    if authors is not None:
-        for author in authors:
-            response["authors"].append(author.json)
+    response["authors"] = [author.json for author in map_.authors]
 
     records = MapTimes.get_records(map_.id_)
     response["records"] = records
@@ -219,6 +403,155 @@ def add_map():
     return make_response(jsonify(response), 200)
 
 
+@maps_index.route("/<int:map_id>/segments", methods=["GET"])
+@coalesce
+def map_segments(map_id):
+    """Get courses and bonuses of a map.
+
+    .. :quickref: Maps; Get map courses and bonuses.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /maps/1/segments HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "map_id": 1,
+          "courses": [
+              {
+                  "id": 3,
+                  "map_id": 1,
+                  "index": 1,
+                  "tiers": {
+                      "soldier": 2,
+                      "demoman": 1
+                  },
+                  "completions": {
+                      "soldier": 140,
+                      "demoman": 240
+                  }
+              }
+          ],
+          "bonuses": []
+      }
+
+    :query map_id: map id.
+
+    :status 200: Success.
+    :status 404: Map not found.
+    :returns: Courses and bonuses
+    """
+    if Map.query.filter_by(id_=map_id).first() is None:
+        response = {"message": "Map not found."}
+        return make_response(jsonify(response), 404)
+
+    courses = Course.query.filter_by(map_id=map_id).order_by(Course.course_index).all()
+    bonuses = Bonus.query.filter_by(map_id=map_id).order_by(Bonus.bonus_index).all()
+
+    response = {
+        "map_id": map_id,
+        "courses": [course.json for course in courses],
+        "bonuses": [bonus.json for bonus in bonuses],
+    }
+    return make_response(jsonify(response), 200)
+
+
+@maps_index.route("/<int:map_id>/add/<any(course, bonus):segment>", methods=["POST"])
+@validate_json(
+    {
+        "index": {"type": "integer", "min": 1, "required": True},
+        "stier": {
+            "type": "integer",
+            "min": 0,
+            "max": 10,
+            "required": False,
+            "default": 0,
+        },
+        "dtier": {
+            "type": "integer",
+            "min": 0,
+            "max": 10,
+            "required": False,
+            "default": 0,
+        },
+    }
+)
+@jwt_required
+def add_segment(map_id, segment):
+    """Add a course or bonus to a map.
+
+    .. :quickref: Maps; Add a course or bonus.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      POST /maps/1/add/course HTTP/1.1
+      Authorization: Bearer <access_token>
+      {
+          "index": 1,
+          "stier": 2
+      }
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "message": "course 1 added to map 1!",
+          "course_id": 3
+      }
+
+    :query map_id: map id.
+    :query segment: "course" or "bonus".
+    :query index: course or bonus number on the map. (min: 1)
+    :query stier: soldier tier. (default: 0, min: 0, max: 10)
+    :query dtier: demoman tier. (default: 0, min: 0, max: 10)
+
+    :status 200: Success.
+    :status 404: Map not found.
+    :status 409: Course or bonus index already exists.
+    :status 415: Missing 'Content-Type: application/json' header.
+    :status 422: Missing or invalid json content.
+
+    :returns: Course or bonus added result.
+    """
+
+    data = request.get_json()
+
+    index = data.get("index")
+    stier = data.get("stier")
+    dtier = data.get("dtier")
+
+    if Map.query.filter_by(id_=map_id).first() is None:
+        response = {"message": "Map not found."}
+        return make_response(jsonify(response), 404)
+
+    model = SEGMENTS[segment].model
+    index_column = f"{segment}_index"
+
+    # check if index is already taken
+    query = model.query.filter_by(map_id=map_id, **{index_column: index}).first()
+    if query:
+        error = {
+            "message": f"{segment} {index} already exists on map {map_id} (id: {query.id_})!"
+        }
+        return make_response(jsonify(error), 409)
+
+    segment_ = model(map_id=map_id, stier=stier, dtier=dtier, **{index_column: index})
+    segment_.add()
+    response = {
+        "message": f"{segment} {index} added to map {map_id}!",
+        SEGMENTS[segment].key: segment_.id_,
+    }
+    return make_response(jsonify(response), 200)
+
+
 @maps_index.route("/update/<int:map_id>", methods=["POST"])
 @validate_json(
     {
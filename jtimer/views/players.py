@@ -5,7 +5,88 @@ from flask_jwt_extended import jwt_required
 
 from jtimer.blueprints import players_index
 from jtimer.models.database import Player
-from jtimer.validation import validate_json
+from jtimer.idempotency import idempotent
+from jtimer.singleflight import coalesce
+from jtimer.validation import validate_json, list_arg
+
+# players per /players request
+MAX_PLAYERS = 100
+
+
+@players_index.route("", methods=["GET"])
+@coalesce
+def get_players():
+    """Get many players by id or steam id.
+
+    .. :quickref: Player; Get many players.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /players?ids=1,5&steam_ids=STEAM_0:0:36730682 HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "players": [
+              {
+                  "id": 1,
+                  "steam_id": "STEAM_1:1:50152141",
+                  "name": "Larry",
+                  "country": "FI",
+                  "rank_info": {
+                      "soldier_points": 4100,
+                      "demo_points": 0,
+                      "soldier_rank": 12,
+                      "demoman_rank": 0
+                  }
+              },
+              null,
+              {
+                  "id": 2,
+                  "steam_id": "STEAM_0:0:36730682",
+                  "name": "kaptain",
+                  "country": "FI",
+                  "rank_info": {
+                      "soldier_points": 3900,
+                      "demo_points": 0,
+                      "soldier_rank": 15,
+                      "demoman_rank": 0
+                  }
+              }
+          ]
+      }
+
+    :query ids: comma separated player ids. (optional)
+    :query steam_ids: comma separated steam ids. (optional)
+
+    **Note**: Players are returned in the order of ids followed by steam_ids,
+    players that don't exist are null. At most 100 ids and steam ids in total.
+
+    :status 200: Success.
+    :status 422: Invalid or too many ids.
+    :returns: Players
+    """
+    try:
+        player_ids = list_arg("ids", int)
+        steam_ids = list_arg("steam_ids")
+    except ValueError:
+        error = {"message": "ids must be comma separated integers."}
+        return make_response(jsonify(error), 422)
+
+    if len(player_ids) + len(steam_ids) > MAX_PLAYERS:
+        error = {"message": f"At most {MAX_PLAYERS} players per request."}
+        return make_response(jsonify(error), 422)
+
+    by_id, by_steam_id = Player.get_many(player_ids, steam_ids)
+    players = [by_id.get(player_id) for player_id in player_ids]
+    players += [by_steam_id.get(steam_id) for steam_id in steam_ids]
+
+    response = {"players": [None if p is None else p.json for p in players]}
+    return make_response(jsonify(response), 200)
 
 
 @players_index.route("/list", methods=["GET"])
@@ -68,6 +149,105 @@ def list_players():
     return make_response(jsonify([p.json for p in players]), 200)
 
 
+@players_index.route("/leaderboard/<int:player_class>", methods=["GET"])
+@coalesce
+def leaderboard(player_class):
+    """Return ranked players for a class.
+
+    .. :quickref: Player; Get class leaderboard.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /players/leaderboard/2?limit=2&after=10&country=FI HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "class": 2,
+          "players": [
+              {
+                  "id": 1,
+                  "name": "Larry",
+                  "country": "FI",
+                  "rank_info": {
+                      "demo_points": 0,
+                      "demo_rank": 0,
+                      "soldier_points": 4100,
+                      "soldier_rank": 12
+                  },
+                  "steamid": "STEAM_1:1:50152141"
+              },
+              {
+                  "id": 2,
+                  "name": "kaptain",
+                  "country": "FI",
+                  "rank_info": {
+                      "demo_points": 0,
+                      "demo_rank": 0,
+                      "soldier_points": 3900,
+                      "soldier_rank": 15
+                  },
+                  "steamid": "STEAM_0:0:36730682"
+              }
+          ],
+          "next": 15
+      }
+
+    :query player_class: player class. (2 or 4)
+    :query limit: amount of players to get. (default: 50, min: 1, max: 50)
+    :query after: rank to start the list after, use "next" of the previous page. (default: 0)
+    :query country: 2-character ISO country code to filter by. (optional)
+    :query player_id: list players around this player instead. (optional)
+    :query radius: amount of players to get on both sides of player_id. (default: 10, min: 1, max: 25)
+
+    **Note**: Ranks are global, filtering by country does not re-number them.
+
+    :status 200: Success.
+    :status 204: player_id not found or not ranked.
+    :status 422: Invalid player class.
+    :returns: Players
+    """
+    if Player.rank_column(player_class) is None:
+        error = {"message": "player_class must be 2 or 4."}
+        return make_response(jsonify(error), 422)
+
+    limit = request.args.get("limit", default=50, type=int)
+    after = request.args.get("after", default=0, type=int)
+    country = request.args.get("country", default=None, type=str)
+    player_id = request.args.get("player_id", default=None, type=int)
+    radius = request.args.get("radius", default=10, type=int)
+
+    limit = max(1, min(limit, 50))
+    radius = max(1, min(radius, 25))
+
+    if player_id is not None:
+        player = Player.query.filter_by(id_=player_id).first()
+        if player is None:
+            return make_response("", 204)
+
+        players = Player.leaderboard_around(player, player_class, radius, country)
+        if not players:
+            return make_response("", 204)
+    else:
+        players = Player.leaderboard(player_class, after, limit, country)
+
+    rank = Player.rank_column(player_class).key
+    next_after = None
+    if player_id is None and len(players) == limit:
+        next_after = getattr(players[-1], rank)
+
+    response = {
+        "class": player_class,
+        "players": [p.json for p in players],
+        "next": next_after,
+    }
+    return make_response(jsonify(response), 200)
+
+
 @players_index.route("/search", methods=["GET"])
 def find_player():
     """Search for a player.
@@ -150,6 +330,7 @@ def find_player():
     }
 )
 @jwt_required
+@idempotent
 def add_player():
     """Add a new player or update an existing one.
 
@@ -186,6 +367,9 @@ def add_player():
     :query username: player username.
     :query country: 2-character ISO country code.
 
+    **Note**: Send a unique "Idempotency-Key" header to make retries safe,
+    a repeated request returns the original response.
+
     :status 200: player registered or updated.
     :returns: Player
     """
@@ -205,3 +389,96 @@ def add_player():
     player.add()
 
     return make_response(jsonify(player.json), 200)
+
+
+@players_index.route("/add/bulk", methods=["POST"])
+@validate_json(
+    {
+        "players": {
+            "type": "list",
+            "minlength": 1,
+            "maxlength": 100,
+            "required": True,
+            "schema": {
+                "type": "dict",
+                "schema": {
+                    "steam_id": {
+                        "type": "string",
+                        "maxlength": 20,
+                        "empty": False,
+                        "required": True,
+                    },
+                    "username": {
+                        "type": "string",
+                        "maxlength": 32,
+                        "empty": False,
+                        "required": True,
+                    },
+                    "country": {
+                        "type": "string",
+                        "minlength": 2,
+                        "maxlength": 2,
+                        "empty": False,
+                        "required": True,
+                    },
+                },
+            },
+        }
+    }
+)
+@jwt_required
+@idempotent
+def add_players():
+    """Add new players or update existing ones in one request.
+
+    .. :quickref: Player; Add multiple players.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      POST /players/add/bulk HTTP/1.1
+      Authorization: Bearer <access_token>
+      Content-Type: application/json
+      {
+          "players": [
+              {
+                  "steam_id": "STEAM_1:1:50152141",
+                  "username": "Larry",
+                  "country": "FI"
+              },
+              {
+                  "steam_id": "STEAM_0:0:36730682",
+                  "username": "kaptain",
+                  "country": "US"
+              }
+          ]
+      }
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "ids": [1, 2]
+      }
+
+    :query players: list of players to register or update. (min: 1, max: 100)
+
+    **Note**: Send a unique "Idempotency-Key" header to make retries safe,
+    a repeated request returns the original response.
+
+    :status 200: players registered or updated.
+    :status 415: Missing 'Content-Type: application/json' header.
+    :status 422: Missing or invalid json content.
+    :returns: Player ids in the same order as the request
+    """
+    data = request.get_json()
+    players = [
+        (p.get("steam_id"), p.get("username"), p.get("country"))
+        for p in data.get("players")
+    ]
+
+    ids = Player.upsert_many(players)
+
+    return make_response(jsonify({"ids": ids}), 200)
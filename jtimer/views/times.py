@@ -1,24 +1,24 @@
 """flask views for /times endpoint"""
 
-from flask import jsonify, make_response, request
+from flask import jsonify, make_response, request, current_app
 from flask_jwt_extended import jwt_required
 
 from jtimer.blueprints import times_index
-from jtimer.models.database import (
-    Map,
-    MapTimes,
-    MapCheckpoint,
-    MapCheckpointTimes,
-    InsertResult,
-)
+from jtimer.models.database import SEGMENTS, InsertResult, RunHistory
+from jtimer.spatial import validate_run
+from jtimer.idempotency import idempotent
+from jtimer.singleflight import coalesce
 from jtimer.validation import validate_json
 
 
-@times_index.route("/map/<int:map_id>", methods=["GET"])
-def get_times(map_id):
-    """Get map times with id.
+@times_index.route(
+    "/<any(map, course, bonus):segment>/<int:segment_id>", methods=["GET"]
+)
+@coalesce
+def get_times(segment, segment_id):
+    """Get map, course or bonus times with id.
 
-    .. :quickref: Times; Get map times.
+    .. :quickref: Times; Get map, course or bonus times.
 
     **Example request**:
 
@@ -62,11 +62,15 @@ def get_times(map_id):
       ],
       "demoman": []
 
-    :query map_id: map id.
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
+    :query limit: amount of times to get per class. (default: 50, min: 1, max: 50)
+    :query start: rank to start the list from. (default: 1, min: 1)
+
+    **Note**: Course and bonus times have "course_id" or "bonus_id" instead of "map_id".
 
     :status 200: Success.
-    :status 404: Map not found.
-    :returns: Map info
+    :returns: Times by class
     """
     limit = request.args.get("limit", default=50, type=int)
     start = request.args.get("start", default=1, type=int)
@@ -74,39 +78,308 @@ def get_times(map_id):
     limit = max(1, min(limit, 50))
     start = max(1, start)
 
-    soldier_times = (
-        MapTimes.query.filter(
-            MapTimes.map_id == map_id,
-            MapTimes.rank >= start,
-            MapTimes.player_class == 2,
-        )
-        .order_by(MapTimes.rank)
-        .all()[:limit]
-    )
-    print(f"before: {soldier_times}")
-    soldier_times = [] if soldier_times is None else soldier_times
-    print(f"after: {soldier_times}")
-
-    demoman_times = (
-        MapTimes.query.filter(
-            MapTimes.map_id == map_id,
-            MapTimes.rank >= start,
-            MapTimes.player_class == 4,
-        )
-        .order_by(MapTimes.rank)
-        .all()[:limit]
-    )
-    demoman_times = [] if demoman_times is None else demoman_times
+    model = SEGMENTS[segment].times
+    soldier_times = model.get_times(segment_id, 2, start, limit)
+    demoman_times = model.get_times(segment_id, 4, start, limit)
 
     times = {
-        "soldier": [st.json for st in soldier_times],
-        "demoman": [dt.json for dt in demoman_times],
+        "soldier": model.json_many(soldier_times),
+        "demoman": model.json_many(demoman_times),
     }
 
     return make_response(jsonify(times), 200)
 
 
-@times_index.route("/insert/map/<int:map_id>", methods=["POST"])
+@times_index.route(
+    "/<any(map, course, bonus):segment>/<int:segment_id>/compare", methods=["GET"]
+)
+def compare_times(segment, segment_id):
+    """Compare checkpoint splits of a player against the record or another rank.
+
+    .. :quickref: Times; Compare map, course or bonus time splits.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /times/map/1/compare?player_id=24&class=2 HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "map_id": 1,
+          "class": 2,
+          "run": {
+              "id": 60,
+              "player_id": 24,
+              "rank": 5,
+              "time": 10624.51525167
+          },
+          "target": {
+              "id": 56,
+              "player_id": 12,
+              "rank": 1,
+              "time": 10424.51525167
+          },
+          "delta": 200.0,
+          "checkpoints": [
+              {
+                  "cp_index": 1,
+                  "time": 1100.12345,
+                  "target_time": 1000.12345,
+                  "delta": 100.0
+              },
+              {
+                  "cp_index": 2,
+                  "time": 1512.140105,
+                  "target_time": null,
+                  "delta": null
+              }
+          ]
+      }
+
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
+    :query player_id: player id.
+    :query class: player class. (2 or 4)
+    :query rank: rank to compare against. (default: 1)
+
+    :status 200: Success.
+    :status 404: Run not found.
+    :status 422: Missing or invalid parameters.
+    :returns: Split comparison
+
+    **Note**: Course and bonus comparisons have "course_id" or "bonus_id" instead of "map_id".
+    """
+    player_id = request.args.get("player_id", default=None, type=int)
+    player_class = request.args.get("class", default=None, type=int)
+    rank = request.args.get("rank", default=1, type=int)
+
+    if player_id is None:
+        error = {"message": "player_id is required."}
+        return make_response(jsonify(error), 422)
+
+    if player_class not in (2, 4):
+        error = {"message": "class must be 2 or 4."}
+        return make_response(jsonify(error), 422)
+
+    rank = max(1, rank)
+
+    model = SEGMENTS[segment].times
+    run, target = model.get_compare_runs(segment_id, player_class, player_id, rank)
+    if run is None:
+        error = {"message": "Run not found."}
+        return make_response(jsonify(error), 404)
+
+    if target is None:
+        error = {"message": f"No run with rank {rank}."}
+        return make_response(jsonify(error), 404)
+
+    splits = dict(run.get_splits())
+    target_splits = dict(target.get_splits())
+
+    checkpoints = []
+    for cp_index in sorted(splits.keys() | target_splits.keys()):
+        time = splits.get(cp_index)
+        target_time = target_splits.get(cp_index)
+        delta = None
+        if time is not None and target_time is not None:
+            delta = time - target_time
+
+        checkpoints.append(
+            {
+                "cp_index": cp_index,
+                "time": time,
+                "target_time": target_time,
+                "delta": delta,
+            }
+        )
+
+    def summary(time):
+        return {
+            "id": time.id_,
+            "player_id": time.player_id,
+            "rank": time.rank,
+            "time": time.duration,
+        }
+
+    response = {
+        SEGMENTS[segment].key: segment_id,
+        "class": player_class,
+        "run": summary(run),
+        "target": summary(target),
+        "delta": run.duration - target.duration,
+        "checkpoints": checkpoints,
+    }
+    return make_response(jsonify(response), 200)
+
+
+@times_index.route(
+    "/<any(map, course, bonus):segment>/<int:segment_id>/rank", methods=["GET"]
+)
+@coalesce
+def would_be_rank(segment, segment_id):
+    """Get the rank and points a time would get without submitting it.
+
+    .. :quickref: Times; Get rank and points of a time.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /times/map/1/rank?class=2&duration=10524.5&player_id=24 HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "map_id": 1,
+          "class": 2,
+          "duration": 10524.5,
+          "rank": 37,
+          "points": 1412,
+          "completions": 120,
+          "personal_best": 10624.51525167,
+          "improves": true,
+          "points_gained": 12
+      }
+
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
+    :query class: player class. (2 or 4)
+    :query duration: run duration in seconds.
+    :query player_id: player id, the player's current run is left out as if
+      it was replaced. (optional)
+
+    **Note**: "personal_best" is null and "points_gained" is left out if
+    player_id is not given or the player has no run. Unknown segments are
+    treated as having no runs.
+
+    :status 200: Success.
+    :status 422: Missing or invalid parameters.
+    :returns: Rank and points
+    """
+    player_class = request.args.get("class", default=None, type=int)
+    duration = request.args.get("duration", default=None, type=float)
+    player_id = request.args.get("player_id", default=None, type=int)
+
+    if player_class not in (2, 4):
+        error = {"message": "class must be 2 or 4."}
+        return make_response(jsonify(error), 422)
+
+    if duration is None or not duration > 0:
+        error = {"message": "duration must be a positive number."}
+        return make_response(jsonify(error), 422)
+
+    model = SEGMENTS[segment].times
+    rank = model.would_be_rank(segment_id, player_class, duration, player_id)
+
+    response = {
+        SEGMENTS[segment].key: segment_id,
+        "class": player_class,
+        "duration": duration,
+        **rank,
+    }
+    return make_response(jsonify(response), 200)
+
+
+@times_index.route(
+    "/<any(map, course, bonus):segment>/<int:segment_id>/progression", methods=["GET"]
+)
+def progression(segment, segment_id):
+    """Get all finished runs of a player on a map, course or bonus.
+
+    .. :quickref: Times; Get run progression of a player.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+      GET /times/map/1/progression?player_id=24&class=2&pb_only=1 HTTP/1.1
+
+    **Example response**:
+
+    .. sourcecode:: json
+
+      {
+          "map_id": 1,
+          "player_id": 24,
+          "class": 2,
+          "runs": [
+              {
+                  "id": 1040,
+                  "time": 10824.51525167,
+                  "finished_at": "2019-07-01T18:42:10",
+                  "checkpoints": [
+                      {
+                          "cp_index": 1,
+                          "time": 1100.12345
+                      }
+                  ]
+              },
+              {
+                  "id": 2211,
+                  "time": 10624.51525167,
+                  "finished_at": "2019-07-03T20:01:45",
+                  "checkpoints": [
+                      {
+                          "cp_index": 1,
+                          "time": 1012.5
+                      }
+                  ]
+              }
+          ]
+      }
+
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
+    :query player_id: player id.
+    :query class: player class. (2 or 4)
+    :query pb_only: only return runs that were personal bests when finished. (default: 0)
+    :query limit: amount of runs to get. (default: 100, min: 1, max: 1000)
+
+    **Note**: Runs are ordered by finish time and are written in batches,
+    the latest runs can take a moment to show up. On databases without
+    window functions pb_only only considers the first 10000 runs.
+
+    :status 200: Success.
+    :status 422: Missing or invalid parameters.
+    :returns: Runs
+    """
+    player_id = request.args.get("player_id", default=None, type=int)
+    player_class = request.args.get("class", default=None, type=int)
+    pb_only = request.args.get("pb_only", default=0, type=int)
+    limit = request.args.get("limit", default=100, type=int)
+
+    if player_id is None:
+        error = {"message": "player_id is required."}
+        return make_response(jsonify(error), 422)
+
+    if player_class not in (2, 4):
+        error = {"message": "class must be 2 or 4."}
+        return make_response(jsonify(error), 422)
+
+    limit = max(1, min(limit, 1000))
+
+    runs = RunHistory.progression(
+        segment, segment_id, player_id, player_class, limit, bool(pb_only)
+    )
+
+    response = {
+        SEGMENTS[segment].key: segment_id,
+        "player_id": player_id,
+        "class": player_class,
+        "runs": [run.json for run in runs],
+    }
+    return make_response(jsonify(response), 200)
+
+
+@times_index.route(
+    "/insert/<any(map, course, bonus):segment>/<int:segment_id>", methods=["POST"]
+)
 @validate_json(
     {
         "player_id": {"type": "integer", "min": 1, "required": True},
@@ -125,13 +398,15 @@ def get_times(map_id):
                 },
             },
         },
+        "trace": {"type": "string", "maxlength": 1 << 20, "required": False},
     }
 )
 @jwt_required
-def insert_map(map_id):
-    """Insert run to map with id.
+@idempotent
+def insert_time(segment, segment_id):
+    """Insert run to map, course or bonus with id.
 
-    .. :quickref: Times; Insert map time.
+    .. :quickref: Times; Insert map, course or bonus time.
 
     **Example request**:
 
@@ -178,24 +453,40 @@ def insert_map(map_id):
           }
       ]
 
-    :query map_id: map id.
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
     :query player_id: player id.
     :query player_class: player class.
     :query start_time: run start time.
     :query end_time: run end time.
     :query checkpoints: list of checkpoints.
+    :query trace: base64 encoded little-endian float32 (time, x, y, z) samples
+        of the run, times relative to start_time. (optional)
+
+    **Note**: When run validation is enabled the trace must go through
+    the start zone, all checkpoints in order and the end zone.
+    Course and bonus times don't give player points.
+
+    **Note**: Send a unique "Idempotency-Key" header to make retries safe,
+    a repeated request returns the original response with an
+    "Idempotent-Replayed: true" header. A request that never finished is
+    run again by retries after a minute, a run it already stored is then
+    reported as not improved.
 
     :status 200: Success.
-    :status 404: Map not found.
+    :status 404: Map, course or bonus not found.
+    :status 409: Request with the same Idempotency-Key is in progress,
+      retry after the Retry-After header.
     :status 415: Missing 'Content-Type: application/json' header.
-    :status 422: Missing or invalid json content.
+    :status 422: Missing or invalid json content, or Idempotency-Key reused
+      for a different request.
     :returns: Insert result
     """
 
     data = request.get_json()
 
-    if map_id < 1:
-        error = {"message": "map_id is invalid."}
+    if segment_id < 1:
+        error = {"message": f"{segment}_id is invalid."}
         return make_response(jsonify(error), 422)
 
     player_id = data.get("player_id")
@@ -208,18 +499,37 @@ def insert_map(map_id):
         error = {"message": "end_time must be greater than start_time"}
         return make_response(jsonify(error), 422)
 
-    map_ = Map.query.filter_by(id_=map_id).first()
-    if map_ is None:
-        error = {"message": f"Could not find map with id {map_id}."}
+    models = SEGMENTS[segment]
+    if models.model.query.filter_by(id_=segment_id).first() is None:
+        error = {"message": f"Could not find {segment} with id {segment_id}."}
         return make_response(jsonify(error), 404)
 
-    entry = MapTimes(
-        map_id=map_id,
+    if current_app.config["VALIDATE_RUN_TRACES"]:
+        trace = data.get("trace")
+        if trace is None and current_app.config["REQUIRE_RUN_TRACES"]:
+            error = {"message": "trace is required."}
+            return make_response(jsonify(error), 422)
+
+        if trace is not None:
+            result = validate_run(
+                segment,
+                segment_id,
+                trace,
+                end_time - start_time,
+                {cp["cp_index"]: cp["time"] - start_time for cp in checkpoints},
+                current_app.config["RUN_TRACE_TOLERANCE"],
+            )
+            if not result.valid:
+                error = {"message": f"Run rejected: {result.message}."}
+                return make_response(jsonify(error), 422)
+
+    entry = models.times(
         player_id=player_id,
         player_class=player_class,
         start_time=start_time,
         end_time=end_time,
         duration=end_time - start_time,
+        **{models.key: segment_id},
     )
     response = entry.add(checkpoints)
 
@@ -4,15 +4,17 @@ from flask import jsonify, make_response, request
 from flask_jwt_extended import jwt_required
 
 from jtimer.blueprints import zones_index
-from jtimer.models.database import Zone, Map, MapCheckpoint
+from jtimer.models.database import Zone, SEGMENTS
 from jtimer.validation import validate_json
 
 
-@zones_index.route("/map/<int:map_id>", methods=["GET"])
-def get_map_zones(map_id):
-    """Get map zones.
+@zones_index.route(
+    "/<any(map, course, bonus):segment>/<int:segment_id>", methods=["GET"]
+)
+def get_zones(segment, segment_id):
+    """Get map, course or bonus zones.
 
-    .. :quickref: Zones; Get map zones.
+    .. :quickref: Zones; Get map, course or bonus zones.
 
     **Example request**:
 
@@ -50,44 +52,149 @@ def get_map_zones(map_id):
           }
       ]
 
-    :query map_id: map id.
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
+
+    **Note**: Course and bonus checkpoints have "course_id" or "bonus_id" instead of "map_id".
 
     :status 200: Success.
-    :status 404: Map not found.
+    :status 404: Map, course or bonus not found.
 
     :returns: List of zones
     """
 
-    map_ = Map.query.filter_by(id_=map_id).first()
-    if map_ is None:
-        error = {"message": "Map not found."}
+    bundle = SEGMENTS[segment].model.get_zone_bundle(segment_id)
+    if bundle is None:
+        error = {"message": f"{segment.capitalize()} not found."}
         return make_response(jsonify(error), 404)
 
-    zones = []
-    if map_.start_zone is not None:
-        zone = Zone.query.filter_by(id_=map_.start_zone).first()
+    return make_response(bundle.json, 200, {"Content-Type": "application/json"})
+
+
+ZONE_SCHEMA = {
+    "p1": {
+        "type": "list",
+        "schema": {"type": "integer"},
+        "minlength": 3,
+        "maxlength": 3,
+        "required": True,
+    },
+    "p2": {
+        "type": "list",
+        "schema": {"type": "integer"},
+        "minlength": 3,
+        "maxlength": 3,
+        "required": True,
+    },
+    "orientation": {"type": "integer", "min": -180, "max": 180, "required": False},
+}
+
+
+@zones_index.route(
+    "/<any(map, course, bonus):segment>/<int:segment_id>", methods=["PUT"]
+)
+@validate_json(
+    {
+        "start": {"type": "dict", "nullable": True, "schema": ZONE_SCHEMA},
+        "end": {"type": "dict", "nullable": True, "schema": ZONE_SCHEMA},
+        "checkpoints": {
+            "type": "list",
+            "maxlength": 100,
+            "required": False,
+            "schema": {
+                "type": "dict",
+                "schema": {
+                    "cp_index": {"type": "integer", "min": 1, "required": True},
+                    **ZONE_SCHEMA,
+                },
+            },
+        },
+    }
+)
+@jwt_required
+def replace_zones(segment, segment_id):
+    """Replace all zones of a map, course or bonus.
 
-        if zone:
-            zone_dict = zone.json
-            zone_dict["zone_type"] = "start"
-            zones.append(zone_dict)
+    .. :quickref: Zones; Replace all zones of a map, course or bonus.
 
-    if map_.end_zone is not None:
-        zone = Zone.query.filter_by(id_=map_.end_zone).first()
-        if zone:
-            zone_dict = zone.json
-            zone_dict["zone_type"] = "end"
-            zones.append(zone_dict)
+    **Example request**:
 
-    checkpoints = MapCheckpoint.query.filter_by(map_id=map_id).all()
-    if checkpoints:
-        for checkpoint in checkpoints:
-            zones.append(checkpoint.json)
+    .. sourcecode:: http
 
-    return make_response(jsonify(zones), 200)
+      PUT /zones/map/1 HTTP/1.1
+      Authorization: Bearer <access_token>
+      {
+          "start": {
+              "p1": [0, 256, 128],
+              "p2": [256, 0, 256],
+              "orientation": 90
+          },
+          "end": {
+              "p1": [1000, 1000, 1000],
+              "p2": [1256, 1256, 1256]
+          },
+          "checkpoints": [
+              {
+                  "cp_index": 1,
+                  "p1": [500, 500, 500],
+                  "p2": [756, 756, 756]
+              }
+          ]
+      }
 
+    **Example response**:
 
-@zones_index.route("/add/map/<int:map_id>", methods=["POST"])
+    .. sourcecode:: json
+
+      {
+          "message": "zones replaced.",
+          "added": 1,
+          "updated": 1,
+          "removed": 0,
+          "unchanged": 1
+      }
+
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
+    :query start: start zone, omit or null to remove. (p1, p2, orientation)
+    :query end: end zone, omit or null to remove. (p1, p2, orientation)
+    :query checkpoints: all checkpoint zones, checkpoints not listed are removed
+        along with their times. (cp_index, p1, p2, orientation)
+
+    **Note**: All zones are replaced in a single transaction.
+    Zones that are unchanged are not rewritten.
+
+    :status 200: Success.
+    :status 404: Map, course or bonus not found.
+    :status 415: Missing 'Content-Type: application/json' header.
+    :status 422: Missing or invalid json content.
+
+    :returns: Zone replace result
+    """
+
+    model = SEGMENTS[segment].model
+    segment_ = model.query.filter_by(id_=segment_id).first()
+    if segment_ is None:
+        error = {"message": f"{segment.capitalize()} not found."}
+        return make_response(jsonify(error), 404)
+
+    data = request.get_json()
+    checkpoints = data.get("checkpoints") or []
+
+    indexes = [cp["cp_index"] for cp in checkpoints]
+    if len(indexes) != len(set(indexes)):
+        error = {"message": "cp_index values must be unique."}
+        return make_response(jsonify(error), 422)
+
+    counts = segment_.replace_zones(data.get("start"), data.get("end"), checkpoints)
+
+    response = {"message": "zones replaced.", **counts}
+    return make_response(jsonify(response), 200)
+
+
+@zones_index.route(
+    "/add/<any(map, course, bonus):segment>/<int:segment_id>", methods=["POST"]
+)
 @validate_json(
     {
         "zone_type": {
@@ -99,26 +206,26 @@ def get_map_zones(map_id):
         "cp_index": {"type": "integer", "min": 1, "required_if": ("zone_type", "cp")},
         "p1": {
             "type": "list",
-            "schema": {"type": "int"},
+            "schema": {"type": "integer"},
             "minlength": 3,
             "maxlength": 3,
             "required": True,
         },
         "p2": {
             "type": "list",
-            "schema": {"type": "int"},
+            "schema": {"type": "integer"},
             "minlength": 3,
             "maxlength": 3,
             "required": True,
         },
-        "orientation": {"type": "int", "min": -180, "max": 180, "required": False},
+        "orientation": {"type": "integer", "min": -180, "max": 180, "required": False},
     }
 )
 @jwt_required
-def add_map_zone(map_id):
-    """Add zone to a map.
+def add_zone(segment, segment_id):
+    """Add zone to a map, course or bonus.
 
-    .. :quickref: Zones; Add zone to a map.
+    .. :quickref: Zones; Add zone to a map, course or bonus.
 
     **Example request**:
 
@@ -140,7 +247,8 @@ def add_map_zone(map_id):
           "message": "zone added."
       }
 
-    :query map_id: map id.
+    :query segment: "map", "course" or "bonus".
+    :query segment_id: map, course or bonus id.
     :query zone_type: type of zone. ("start", "end", "cp")
     :query p1: first corner of the zone. (list of integers)
     :query p2: second corner of the zone. (list of integers)
@@ -148,17 +256,19 @@ def add_map_zone(map_id):
     :query orientation: rotation around z-axis, used for start zones. (optional, default: 0)
 
     :status 200: Success.
-    :status 404: Map not found.
+    :status 404: Map, course or bonus not found.
     :status 415: Missing 'Content-Type: application/json' header.
     :status 422: Missing or invalid json content.
 
     :returns: Zone add result
     """
 
-    # make sure map exists
-    map_ = Map.query.filter_by(id_=map_id).first()
-    if map_ is None:
-        error = {"message": "Map not found."}
+    models = SEGMENTS[segment]
+
+    # make sure segment exists
+    segment_ = models.model.query.filter_by(id_=segment_id).first()
+    if segment_ is None:
+        error = {"message": f"{segment.capitalize()} not found."}
         return make_response(jsonify(error), 404)
 
     data = request.get_json()
@@ -168,9 +278,12 @@ def add_map_zone(map_id):
     point2 = data.get("p2")
     orientation = data.get("orientation")
 
+    # committed along with the zone
+    segment_.invalidate_zones()
+
     if zone_type == "start":
         # check for existing start zone
-        zone = Zone.query.filter(Zone.id_ == map_.start_zone).first()
+        zone = Zone.query.filter(Zone.id_ == segment_.start_zone).first()
         if zone is None:
             zone = Zone()
 
@@ -181,12 +294,12 @@ def add_map_zone(map_id):
             zone.orientation = orientation
 
         zone.add()
-        map_.start_zone = zone.id_
-        map_.add()
+        segment_.start_zone = zone.id_
+        segment_.add()
 
     elif zone_type == "end":
         # check for existing end zone
-        zone = Zone.query.filter(Zone.id_ == map_.end_zone).first()
+        zone = Zone.query.filter(Zone.id_ == segment_.end_zone).first()
         if zone is None:
             zone = Zone()
 
@@ -194,39 +307,33 @@ def add_map_zone(map_id):
         zone.x2, zone.y2, zone.z2 = point2
 
         zone.add()
-        map_.end_zone = zone.id_
-        map_.add()
+        segment_.end_zone = zone.id_
+        segment_.add()
 
     else:
         index = data.get("cp_index")
 
         # check for existing checkpoint
-        checkpoint = MapCheckpoint.query.filter(
-            MapCheckpoint.map_id == map_id, MapCheckpoint.cp_index == index
+        checkpoint = models.checkpoint.query.filter(
+            getattr(models.checkpoint, models.key) == segment_id,
+            models.checkpoint.cp_index == index,
         ).first()
 
         if checkpoint is None:
-            zone = Zone()
-
-            zone.x1, zone.y1, zone.z1 = point1
-            zone.x2, zone.y2, zone.z2 = point2
-
-            zone.add()
-
-            checkpoint = MapCheckpoint(map_id=map_id, zone_id=zone.id_, cp_index=index)
+            checkpoint = models.checkpoint(cp_index=index, **{models.key: segment_id})
+            zone = None
         else:
             # check for existing zone
             zone = Zone.query.filter_by(id_=checkpoint.zone_id).first()
 
-            if zone is None:
-                zone = Zone()
-                checkpoint.zone_id = zone.id_
-
-            zone.x1, zone.y1, zone.z1 = point1
-            zone.x2, zone.y2, zone.z2 = point2
+        if zone is None:
+            zone = Zone()
 
-            zone.add()
+        zone.x1, zone.y1, zone.z1 = point1
+        zone.x2, zone.y2, zone.z2 = point2
 
+        zone.add()
+        checkpoint.zone_id = zone.id_
         checkpoint.add()
 
     response = {"message": "zone added."}
@@ -0,0 +1,474 @@
+"""Load test the api with simulated game servers.
+
+Seeds a database with benchmark.py's generator, launches the app in a
+separate process and runs concurrent server sessions against it over http.
+Each session authenticates, refreshes its token, adds joining players,
+submits runs with checkpoints and polls leaderboards and records.
+Afterwards leaderboards are checked for rank consistency and lost updates,
+use --hot to have all servers contend for the same leaderboard.
+
+Usage: python loadtest.py --servers 32 --duration 60 --output results.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmark import BENCHMARK_USER, generate, git_revision, setup_environment
+
+# slack for float storage when comparing durations
+EPSILON = 1e-6
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database",
+        default=None,
+        help="database uri, defaults to a temporary sqlite database",
+    )
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="drop existing tables, required for databases that have data",
+    )
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--servers", type=int, default=16, help="concurrent servers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument(
+        "--server-players", type=int, default=12, help="players on each server"
+    )
+    parser.add_argument(
+        "--poll-ratio",
+        type=float,
+        default=0.5,
+        help="leaderboard polls per run submission",
+    )
+    parser.add_argument(
+        "--map-change", type=float, default=0.05, help="map change chance per run"
+    )
+    parser.add_argument(
+        "--hot",
+        action="store_true",
+        help="all servers submit runs of the same players to one map",
+    )
+    parser.add_argument(
+        "--refresh-interval", type=float, default=10, help="token refresh seconds"
+    )
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--maps", type=int, default=100)
+    parser.add_argument("--checkpoints", type=int, default=5)
+    parser.add_argument("--completions", type=int, default=20000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--app-log", default=None, help="file for app output")
+    parser.add_argument("--output", default=None, help="json output file")
+    return parser.parse_args(argv)
+
+
+class Recorder:
+    """Thread-safe request and submission bookkeeping."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.connection_errors = 0
+        # (map_id, player_id, player_class) -> fastest accepted duration
+        self.best = {}
+
+    def request(self, operation, status, latency):
+        """Record a finished request."""
+        with self.lock:
+            self.latencies[operation].append(latency)
+            self.statuses[operation][status] += 1
+
+    def connection_error(self):
+        """Record a request that got no response."""
+        with self.lock:
+            self.connection_errors += 1
+
+    def submission(self, key, duration):
+        """Record an accepted run submission."""
+        with self.lock:
+            if key not in self.best or duration < self.best[key]:
+                self.best[key] = duration
+
+
+class Session:
+    """Simulated game server."""
+
+    def __init__(self, index, args, base_url, dataset, recorder, stop):
+        self.index = index
+        self.args = args
+        self.base_url = base_url
+        self.dataset = dataset
+        self.recorder = recorder
+        self.stop = stop
+        self.rng = np.random.default_rng(args.seed + index + 1)
+        self.access_token = None
+        self.refresh_token = None
+        self.refreshed = 0
+        self.players = []
+        self.map_id = None
+
+    def call(self, operation, method, path, data=None, token=None):
+        """Send request and record it.
+        Returns (status, json) or (None, None) without a response."""
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+
+        request = urllib.request.Request(
+            self.base_url + path, data=body, headers=headers, method=method
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.args.timeout) as response:
+                status = response.status
+                payload = response.read()
+        except urllib.error.HTTPError as error:
+            status = error.code
+            payload = error.read()
+        except (urllib.error.URLError, OSError):
+            self.recorder.connection_error()
+            return None, None
+
+        self.recorder.request(operation, status, time.perf_counter() - start)
+        try:
+            return status, json.loads(payload) if payload else None
+        except ValueError:
+            return status, None
+
+    def authenticate(self):
+        """Get access and refresh tokens."""
+        username, password = BENCHMARK_USER
+        status, response = self.call(
+            "token_auth",
+            "POST",
+            "/token/auth",
+            {"username": username, "password": password},
+        )
+        if status == 200:
+            self.access_token = response["access_token"]
+            self.refresh_token = response["refresh_token"]
+            self.refreshed = time.monotonic()
+        return status == 200
+
+    def refresh(self):
+        """Get a new access token."""
+        status, response = self.call(
+            "token_refresh", "POST", "/token/refresh", token=self.refresh_token
+        )
+        if status == 200:
+            self.access_token = response["access_token"]
+        self.refreshed = time.monotonic()
+
+    def join_players(self):
+        """Add players of this server, replacing ones that left."""
+        while len(self.players) < self.args.server_players:
+            player_id = self.dataset.random_player(self.rng)
+            if self.args.hot:
+                player_id = int(self.rng.integers(self.args.server_players)) + 1
+            status, response = self.call(
+                "player_join",
+                "POST",
+                "/players/add",
+                {
+                    "steam_id": f"STEAM_0:{(player_id - 1) % 2}:{player_id - 1}",
+                    "username": f"player{player_id - 1}",
+                    "country": "FI",
+                },
+                token=self.access_token,
+            )
+            if status != 200:
+                return
+            self.players.append(response["id"])
+
+    def submit_run(self):
+        """Submit a run of a random player on the current map."""
+        player_id = int(self.rng.choice(self.players))
+        player_class = int(self.rng.choice([2, 4]))
+        duration = self.dataset.run_duration(self.map_id, player_id, self.rng)
+        start = float(self.rng.uniform(0, 10000))
+
+        bundle_status, zones = self.call(
+            "get_zones", "GET", f"/zones/map/{self.map_id}"
+        )
+        checkpoints = []
+        if bundle_status == 200:
+            indexes = sorted(z["cp_index"] for z in zones if z["zone_type"] == "cp")
+            fractions = np.sort(self.rng.uniform(0.05, 0.95, size=len(indexes)))
+            checkpoints = [
+                {"cp_index": cp_index, "time": start + float(f) * duration}
+                for cp_index, f in zip(indexes, fractions)
+            ]
+
+        status, _ = self.call(
+            "insert_map",
+            "POST",
+            f"/times/insert/map/{self.map_id}",
+            {
+                "player_id": player_id,
+                "player_class": player_class,
+                "start_time": start,
+                "end_time": start + duration,
+                "checkpoints": checkpoints,
+            },
+            token=self.access_token,
+        )
+        if status == 200:
+            self.recorder.submission((self.map_id, player_id, player_class), duration)
+
+    def poll(self):
+        """Poll leaderboard or map records."""
+        if self.rng.random() < 0.5:
+            self.call("get_times", "GET", f"/times/map/{self.map_id}")
+        else:
+            self.call("map_info", "GET", f"/maps/{self.map_id}/info")
+
+    def run(self):
+        """Run the session until stopped."""
+        if not self.authenticate():
+            return
+
+        self.map_id = 1 if self.args.hot else self.dataset.random_map(self.rng)
+        while not self.stop.is_set():
+            if time.monotonic() - self.refreshed > self.args.refresh_interval:
+                self.refresh()
+
+            # players occasionally leave
+            if self.players and self.rng.random() < 0.05:
+                self.players.pop(int(self.rng.integers(len(self.players))))
+            self.join_players()
+            if not self.players:
+                continue
+
+            if not self.args.hot and self.rng.random() < self.args.map_change:
+                self.map_id = self.dataset.random_map(self.rng)
+
+            self.submit_run()
+            if self.rng.random() < self.args.poll_ratio:
+                self.poll()
+
+
+def launch(args, database):
+    """Start the app in a separate process and wait until it responds."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    command = [
+        sys.executable,
+        "-c",
+        "from jtimer import application; "
+        f"application.run(host='127.0.0.1', port={args.port}, threaded=True)",
+    ]
+    env = dict(os.environ, DATABASE_URI=database)
+    log = subprocess.DEVNULL
+    if args.app_log:
+        log = open(args.app_log, "w")
+    process = subprocess.Popen(
+        command, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("app exited during startup")
+        try:
+            urllib.request.urlopen(url + "/players/list?limit=1", timeout=1).close()
+            return process, url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+
+    process.terminate()
+    sys.exit("app didn't start")
+
+
+def check_consistency(recorder, limit=10):
+    """Check leaderboards for rank order and lost run updates.
+    Returns (amount of violations, examples)."""
+    from jtimer.models.database import MapTimes
+
+    violations = 0
+    examples = []
+
+    def violation(kind, **details):
+        nonlocal violations
+        violations += 1
+        if len(examples) < limit:
+            examples.append({"type": kind, **details})
+
+    times = MapTimes.query.with_entities(
+        MapTimes.map_id,
+        MapTimes.player_class,
+        MapTimes.player_id,
+        MapTimes.rank,
+        MapTimes.duration,
+    ).all()
+
+    boards = defaultdict(list)
+    stored = {}
+    for map_id, player_class, player_id, rank, duration in times:
+        boards[(map_id, player_class)].append((rank, duration))
+        key = (map_id, player_id, player_class)
+        if key in stored:
+            violation("duplicate_run", map_id=map_id, player_id=player_id)
+        stored[key] = duration if key not in stored else min(stored[key], duration)
+
+    for (map_id, player_class), runs in boards.items():
+        ranks = sorted(rank for rank, _ in runs if rank is not None)
+        if ranks != list(range(1, len(runs) + 1)):
+            violation("rank_sequence", map_id=map_id, player_class=player_class)
+            continue
+
+        durations = [duration for _, duration in sorted(runs)]
+        if any(a > b + EPSILON for a, b in zip(durations, durations[1:])):
+            violation("rank_order", map_id=map_id, player_class=player_class)
+
+    for key, best in recorder.best.items():
+        duration = stored.get(key)
+        if duration is None or duration > best + EPSILON:
+            map_id, player_id, player_class = key
+            violation(
+                "lost_update",
+                map_id=map_id,
+                player_id=player_id,
+                player_class=player_class,
+                submitted=best,
+                stored=duration,
+            )
+
+    return violations, examples
+
+
+def summarize(recorder, elapsed):
+    """Summary statistics by operation and overall."""
+    operations = {}
+    everything = []
+    for operation, latencies in sorted(recorder.latencies.items()):
+        everything.extend(latencies)
+        latencies = np.array(latencies) * 1000
+        operations[operation] = {
+            "requests": len(latencies),
+            "throughput": len(latencies) / elapsed,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)),
+                "p999": float(np.percentile(latencies, 99.9)),
+                "max": float(latencies.max()),
+            },
+            "statuses": {
+                str(status): count
+                for status, count in sorted(recorder.statuses[operation].items())
+            },
+        }
+
+    statuses = defaultdict(int)
+    for counts in recorder.statuses.values():
+        for status, count in counts.items():
+            statuses[status] += count
+
+    everything = np.array(everything or [0]) * 1000
+    return {
+        "requests": sum(statuses.values()),
+        "throughput": sum(statuses.values()) / elapsed,
+        "latency_ms": {
+            "p50": float(np.percentile(everything, 50)),
+            "p99": float(np.percentile(everything, 99)),
+            "p999": float(np.percentile(everything, 99.9)),
+        },
+        # the app answers lock wait timeouts and deadlocks with 503
+        "lock_timeouts": statuses.get(503, 0),
+        "server_errors": sum(c for s, c in statuses.items() if s >= 500 and s != 503),
+        "connection_errors": recorder.connection_errors,
+        "operations": operations,
+    }
+
+
+def main(argv=None):
+    """Seed data, run the load test and write results."""
+    args = parse_args(argv)
+    database = setup_environment(args.database)
+
+    # imported here so the app picks up DATABASE_URI
+    from jtimer import application
+    from jtimer.extensions import db
+
+    rng = np.random.default_rng(args.seed)
+    with application.app_context():
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        elif db.session.execute("SELECT COUNT(*) FROM player").scalar():
+            sys.exit("database has data, use --reset to drop it")
+
+        dataset = generate(args, rng)
+        db.session.remove()
+
+    process, url = launch(args, database)
+    recorder = Recorder()
+    stop = threading.Event()
+    try:
+        sessions = [
+            Session(i, args, url, dataset, recorder, stop) for i in range(args.servers)
+        ]
+        threads = [threading.Thread(target=s.run, daemon=True) for s in sessions]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+
+    with application.app_context():
+        violations, examples = check_consistency(recorder)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "database": database.split("://", 1)[0],
+            "elapsed_seconds": elapsed,
+            "parameters": {
+                key: value for key, value in vars(args).items() if key != "output"
+            },
+        },
+        "results": {
+            **summarize(recorder, elapsed),
+            "consistency_violations": violations,
+            "violation_examples": examples,
+        },
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
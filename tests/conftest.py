@@ -0,0 +1,93 @@
+"""Shared fixtures.
+
+The application is created when jtimer is imported, so the database is
+chosen here first: a temporary sqlite database, or TEST_DATABASE_URI to
+run the tests against another database. Its tables are dropped.
+"""
+
+import os
+import tempfile
+
+_handle, DATABASE_PATH = tempfile.mkstemp(prefix="jtimer-test-", suffix=".db")
+os.close(_handle)
+os.environ["DATABASE_URI"] = os.environ.get(
+    "TEST_DATABASE_URI", f"sqlite:///{DATABASE_PATH}"
+)
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("JWT_SECRET_KEY", "test")
+
+import pytest  # noqa: E402
+
+from jtimer import application  # noqa: E402
+from jtimer.cache import all_caches  # noqa: E402
+from jtimer.extensions import db  # noqa: E402
+from jtimer.history import history_writer  # noqa: E402
+from jtimer.models.database import Map, Player, User  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    """The application, the temporary database is removed afterwards."""
+    yield application
+
+    history_writer.flush()
+    with application.app_context():
+        db.engine.dispose()
+    os.remove(DATABASE_PATH)
+
+
+@pytest.fixture
+def database(app):
+    """Empty tables and caches, yields the app context."""
+    history_writer.flush()
+    for cache in all_caches.values():
+        cache.clear()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app, database):
+    """Test client on empty tables."""
+    return app.test_client()
+
+
+@pytest.fixture
+def auth_headers(client):
+    """Authorization header of a new user."""
+    User(username="test", password=User.generate_hash("test")).add()
+    response = client.post("/token/auth", json={"username": "test", "password": "test"})
+    return {"Authorization": f"Bearer {response.get_json()['access_token']}"}
+
+
+@pytest.fixture
+def make_map(database):
+    """Create a map, returns its id."""
+
+    def make(name="jump_test"):
+        map_ = Map(mapname=name)
+        db.session.add(map_)
+        db.session.commit()
+        return map_.id_
+
+    return make
+
+
+@pytest.fixture
+def make_players(database):
+    """Create amount players, returns their ids."""
+
+    def make(amount):
+        players = [
+            Player(steam_id=f"STEAM_{i}", username=f"player{i}", country="FI")
+            for i in range(amount)
+        ]
+        db.session.add_all(players)
+        db.session.commit()
+        return [player.id_ for player in players]
+
+    return make
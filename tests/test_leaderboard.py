@@ -0,0 +1,24 @@
+"""In-memory leaderboards keep the order of the ranks."""
+
+from jtimer.leaderboard import Leaderboard
+
+# (run id, player id, duration) ordered by (duration, run id)
+ROWS = [(4, 40, 10.0), (2, 20, 12.0), (5, 50, 12.0), (3, 30, 15.0)]
+
+
+def test_updated_run_keeps_id_among_ties():
+    board = Leaderboard(ROWS, 1)
+    # run 1 of player 10 improves to the tied duration, its id is the lowest
+    board.set(10, 12.0, 1)
+
+    assert list(board.run_ids) == [4, 1, 2, 5, 3]
+    assert list(board.player_ids) == [40, 10, 20, 50, 30]
+
+
+def test_replaced_run_moves():
+    board = Leaderboard(ROWS, 1)
+    board.set(30, 12.0, 3)
+
+    assert list(board.run_ids) == [4, 2, 3, 5]
+    assert list(board.durations) == [10.0, 12.0, 12.0, 12.0]
+    assert board.position(30) == 2
@@ -0,0 +1,37 @@
+"""Schema migrations of existing databases."""
+
+from sqlalchemy import inspect
+
+from jtimer.extensions import db
+from jtimer.migrations import migrate
+from jtimer.models.database import MapTimes
+
+INDEX = "ix_map_times_map_player_class"
+
+
+def test_migrate_removes_duplicate_runs(database, make_map, make_players):
+    map_id = make_map()
+    (player_id,) = make_players(1)
+
+    # database from before the unique index, with duplicate runs
+    index = next(i for i in MapTimes.__table__.indexes if i.name == INDEX)
+    index.drop(bind=db.engine)
+    db.session.add_all(
+        MapTimes(
+            map_id=map_id,
+            player_id=player_id,
+            player_class=2,
+            start_time=0,
+            end_time=duration,
+            duration=duration,
+        )
+        for duration in (30.0, 20.0, 25.0)
+    )
+    db.session.commit()
+
+    migrate()
+
+    runs = MapTimes.query.filter(MapTimes.map_id == map_id).all()
+    assert [(run.duration, run.rank) for run in runs] == [(20.0, 1)]
+    indexes = {index["name"] for index in inspect(db.engine).get_indexes("map_times")}
+    assert INDEX in indexes
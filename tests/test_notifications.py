@@ -0,0 +1,52 @@
+"""Record notifications are queued for runs that beat the record."""
+
+import pytest
+
+from jtimer.models.database import NotificationOutbox
+
+
+@pytest.fixture
+def submit(app, monkeypatch, client, auth_headers, make_map):
+    """Submit a soldier run of player_id with duration."""
+    monkeypatch.setitem(app.config, "NOTIFICATION_WEBHOOKS", ["http://example.com"])
+    map_id = make_map()
+
+    def submit(player_id, duration):
+        data = {
+            "player_id": player_id,
+            "player_class": 2,
+            "start_time": 100,
+            "end_time": 100 + duration,
+            "checkpoints": [],
+        }
+        response = client.post(
+            f"/times/insert/map/{map_id}", json=data, headers=auth_headers
+        )
+        assert response.status_code == 200
+        return NotificationOutbox.query.count()
+
+    return submit
+
+
+def test_first_completion(submit, make_players):
+    (player_id,) = make_players(1)
+
+    assert submit(player_id, 20) == 0
+
+
+def test_new_player_beats_record(submit, make_players):
+    first, second, third = make_players(3)
+    submit(first, 20)
+
+    assert submit(second, 25) == 0
+    # an improved run and a first run of another player both taking the record
+    assert submit(second, 15) == 1
+    assert submit(third, 10) == 2
+
+
+def test_record_holder_improves(submit, make_players):
+    (player_id,) = make_players(1)
+    submit(player_id, 20)
+
+    assert submit(player_id, 30) == 0
+    assert submit(player_id, 18) == 1
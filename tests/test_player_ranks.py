@@ -0,0 +1,45 @@
+"""Player ranks are updated after a stored map run."""
+
+import sqlite3
+
+from sqlalchemy.exc import OperationalError
+
+from jtimer.models.database import MapTimes, Player
+
+
+def locked(*args):
+    """Raise the sqlite lock error."""
+    raise OperationalError(
+        "UPDATE player", {}, sqlite3.OperationalError("database is locked")
+    )
+
+
+def test_lock_error_keeps_run(
+    app, monkeypatch, auth_headers, client, make_map, make_players
+):
+    map_id = make_map()
+    (player_id,) = make_players(1)
+    calls = []
+
+    def calculate_ranks():
+        calls.append(1)
+        locked()
+
+    monkeypatch.setattr(Player, "calculate_ranks", calculate_ranks)
+    monkeypatch.setitem(app.config, "RUN_INSERT_RETRY_DELAY", 0)
+
+    data = {
+        "player_id": player_id,
+        "player_class": 2,
+        "start_time": 100,
+        "end_time": 120,
+        "checkpoints": [],
+    }
+    response = client.post(
+        f"/times/insert/map/{map_id}", json=data, headers=auth_headers
+    )
+
+    # retried, then logged instead of answering 503 for a stored run
+    assert response.status_code == 200
+    assert len(calls) == app.config["RUN_INSERT_RETRIES"] + 1
+    assert MapTimes.query.filter(MapTimes.map_id == map_id).count() == 1
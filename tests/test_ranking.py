@@ -0,0 +1,99 @@
+"""Window function and Python ranking give identical ranks and points."""
+
+import pytest
+
+from jtimer.extensions import db
+from jtimer.models.database import ROUND_POINTS, MapTimes, supports_window_ranking
+from jtimer.points import round_points
+
+# (class, duration), soldier has ties on the record and below it,
+# demoman has a single completion
+RUNS = [
+    (2, 12.5),
+    (2, 10.0),
+    (2, 33.3),
+    (2, 12.5),
+    (2, 10.0),
+    (2, 13.0),
+    (2, 20.0),
+    (4, 15.0),
+]
+
+
+@pytest.fixture
+def sql_ranking(database):
+    """Skip if the database can't rank with window functions."""
+    if not supports_window_ranking(db.session.get_bind()):
+        pytest.skip("database doesn't support window function ranking")
+
+
+@pytest.fixture
+def ranked_map(make_map, make_players):
+    """Map with RUNS by different players, returns the map id."""
+    map_id = make_map()
+    player_ids = make_players(len(RUNS))
+    db.session.add_all(
+        MapTimes(
+            map_id=map_id,
+            player_id=player_id,
+            player_class=player_class,
+            start_time=0,
+            end_time=duration,
+            duration=duration,
+        )
+        for player_id, (player_class, duration) in zip(player_ids, RUNS)
+    )
+    db.session.commit()
+    return map_id
+
+
+def rank(map_id, backend):
+    """Rank with backend, returns (completions, {run id: (rank, points)})."""
+    if backend == "sql" and not supports_window_ranking(db.session.get_bind()):
+        pytest.skip("database doesn't support window function ranking")
+
+    MapTimes.query.filter(MapTimes.map_id == map_id).update(
+        {"rank": None, "points": None}
+    )
+    completions = MapTimes.rank_segment(map_id, backend)
+    db.session.commit()
+
+    runs = MapTimes.query.filter(MapTimes.map_id == map_id).all()
+    return completions, {run.id_: (run.rank, run.points) for run in runs}
+
+
+def test_backends_agree(ranked_map):
+    python_completions, python_ranks = rank(ranked_map, "python")
+    sql_completions, sql_ranks = rank(ranked_map, "sql")
+
+    assert python_completions == sql_completions == {"soldier": 7, "demoman": 1}
+    assert python_ranks == sql_ranks
+
+
+@pytest.mark.parametrize("backend", ["python", "sql"])
+def test_ties(ranked_map, backend):
+    _, ranks = rank(ranked_map, backend)
+
+    # ids follow RUNS, ties are ranked by id and get the same points
+    assert ranks[2] == (1, 1389)
+    assert ranks[5] == (2, 1389)
+    assert ranks[1][0] == 3 and ranks[4][0] == 4
+    assert ranks[1][1] == ranks[4][1]
+    assert [ranks[i][0] for i in (6, 7, 3)] == [5, 6, 7]
+
+
+@pytest.mark.parametrize("backend", ["python", "sql"])
+def test_single_completion(ranked_map, backend):
+    _, ranks = rank(ranked_map, backend)
+
+    # LN(1) is 0, the only run gets 200 * 5 points
+    assert ranks[8] == (1, 1000)
+
+
+@pytest.mark.parametrize("points", [0.5, 1.5, 2.5, 3.5, 999.5, 1000.4999, 1000.5001])
+def test_half_way_rounding(sql_ranking, points):
+    statement = "SELECT " + ROUND_POINTS.format(points=":points")
+    rounded = db.session.execute(statement, {"points": points}).scalar()
+
+    assert rounded == round_points(points)
+    assert round_points(points) == int(points) + (points - int(points) >= 0.5)
@@ -0,0 +1,64 @@
+"""Run trace validation against zones."""
+
+import numpy as np
+
+from jtimer.models.database import ZoneBundle
+from jtimer.spatial import ZoneIndex, validate_trace
+
+# zones along the x axis, checkpoint 2 lies between start and checkpoint 1
+START = (0, 0, 0, 1, 1, 1, 0)
+CHECKPOINT_1 = (10, 0, 0, 11, 1, 1, 0)
+CHECKPOINT_2 = (5, 0, 0, 6, 1, 1, 0)
+END = (20, 0, 0, 21, 1, 1, 0)
+
+TOLERANCE = 0.1
+
+
+def zone_index():
+    """Index of the test zones."""
+    bundle = ZoneBundle(
+        version=1,
+        start=START,
+        end=END,
+        checkpoints=((1, 1, CHECKPOINT_1), (2, 2, CHECKPOINT_2)),
+        json=None,
+    )
+    return ZoneIndex(bundle)
+
+
+def trace(xs):
+    """Trace visiting x positions one second apart, starting at time 0."""
+    return np.array([(t, x, 0.5, 0.5) for t, x in enumerate(xs)], dtype=np.float64)
+
+
+def test_checkpoints_in_order():
+    # start, checkpoint 1, checkpoint 2 on the way back, end
+    samples = trace([0.5, 10.5, 5.5, 20.5])
+    result = validate_trace(zone_index(), samples, 3, {1: 1, 2: 2}, TOLERANCE)
+
+    assert result.valid, result.message
+
+
+def test_checkpoint_revisited():
+    # passes through checkpoint 2 before checkpoint 1 and again after it
+    samples = trace([0.5, 5.5, 10.5, 5.5, 20.5])
+    result = validate_trace(zone_index(), samples, 4, {1: 2, 2: 3}, TOLERANCE)
+
+    assert result.valid, result.message
+
+
+def test_checkpoint_out_of_order():
+    # checkpoint 2 only before checkpoint 1
+    samples = trace([0.5, 5.5, 10.5, 20.5])
+    result = validate_trace(zone_index(), samples, 3, {}, TOLERANCE)
+
+    assert not result.valid
+    assert result.message == "checkpoint 2 reached out of order"
+
+
+def test_checkpoint_missed():
+    samples = trace([0.5, 10.5, 20.5])
+    result = validate_trace(zone_index(), samples, 2, {}, TOLERANCE)
+
+    assert not result.valid
+    assert result.message == "trace misses checkpoint 2"
@@ -0,0 +1,70 @@
+"""Local webhook stand-in for testing record notifications.
+
+Prints every received request body as a json line and fails a share of
+requests to exercise the dispatcher's retries.
+
+Usage:
+    python webhook_stub.py --port 7020 --fail-rate 0.3
+    NOTIFICATION_WEBHOOKS=http://127.0.0.1:7020/hook python application.py
+    python -m jtimer.notifications
+"""
+
+import argparse
+import json
+import random
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept or fail POST requests."""
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if random.random() < self.server.fail_rate:
+            self.send_response(self.server.fail_status)
+            if self.server.fail_status == 429:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            print(json.dumps({"path": self.path, "status": self.server.fail_status}))
+            return
+
+        try:
+            document = json.loads(body)
+        except ValueError:
+            document = body.decode(errors="replace")
+
+        self.send_response(204)
+        self.end_headers()
+        print(json.dumps({"path": self.path, "status": 204, "body": document}))
+        sys.stdout.flush()
+
+    def log_message(self, format, *args):
+        # requests are printed as json lines instead
+        pass
+
+
+def main(argv=None):
+    """Command line interface."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7020)
+    parser.add_argument(
+        "--fail-rate", type=float, default=0.0, help="share of requests to fail"
+    )
+    parser.add_argument(
+        "--fail-status", type=int, default=500, help="status of failed requests"
+    )
+    args = parser.parse_args(argv)
+
+    server = ThreadingHTTPServer((args.host, args.port), WebhookHandler)
+    server.fail_rate = args.fail_rate
+    server.fail_status = args.fail_status
+    print(f"listening on http://{args.host}:{args.port}", file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()